@@ -46,7 +46,8 @@ ERR_REGISTER_UNKNOWN = ("Ouch, cannot register user. Try again "
 def org_before_insert(mapper, connection, target):
     try:
         ccont = CertController(conf.cr_config, db=connection)
-        ccont.create_ca(target.name)
+        # Key generation is left to the refill thread of the pool
+        ccont.create_ca(target.name, key=ccont.key_pool.take())
 
         ca_dir = path.join(ccont.ca_path, 'org')
 
@@ -22,6 +22,7 @@ import os
 from cloudrunner import CONFIG_LOCATION
 from cloudrunner.util.config import Config
 from cloudrunner_server.util import timestamp, MAX_TS
+from cloudrunner_server.util.lru import LRUCache
 
 CR_CONFIG = Config(CONFIG_LOCATION)
 as_host, as_port = CR_CONFIG.AS_URL or '127.0.0.1', CR_CONFIG.AS_PORT or 3000
@@ -58,6 +59,11 @@ OUTPUT_SET = "output"
 INDEX_SET = "time-index"
 AUTH_TOKEN_SET = "tokens"
 
+# Sessions whose log id is kept in memory
+META_CACHE_SIZE = 10000
+# session id -> log id (autoid), shared by the writers of the process
+SESSION_IDS = LRUCache(META_CACHE_SIZE)
+
 LOG.debug("AEROSPIKE CONFIG: %s" % config)
 
 
@@ -212,6 +218,7 @@ class RegWriter(RegBase):
 
         ttl = {'ttl': ttl or DAYS30}
         self.client.put(key, rec, ttl)
+        SESSION_IDS.set(self.id, inc)
 
         # Store indexed value
         index_key = dict(key=inc, ts=ts, uuid=self.id)
@@ -233,9 +240,13 @@ class RegWriter(RegBase):
             if l:
                 lines.append(str(l))
 
-        ind_key = self.key(LOGS_NS, META_SET, self.id)
-        k, m, v = self.client.get(ind_key)
-        index = v.get("id", 0)
+        index = SESSION_IDS.get(self.id)
+        if index is None:
+            # Prepared by another process, or evicted
+            ind_key = self.key(LOGS_NS, META_SET, self.id)
+            k, m, v = self.client.get(ind_key)
+            index = v.get("id", 0)
+            SESSION_IDS.set(self.id, index)
 
         ts = int(ts * 1000)
         rec = dict(ts=ts, uuid=self.id, lines=lines, io=io,
@@ -245,6 +256,10 @@ class RegWriter(RegBase):
         key = (LOGS_NS, OUTPUT_SET, "%s-%s" % (self.id, ts))
         self.client.put(key, rec, ttl)
 
+    def end_log(self):
+        # No more output for the session
+        SESSION_IDS.pop(self.id)
+
     def store_meta(self, result, ts, ttl=None):
         key = self.key(LOGS_NS, OUTPUT_SET, "%s-meta" % self.id)
         ttl = {'ttl': ttl or DAYS30}
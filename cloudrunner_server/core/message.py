@@ -1,6 +1,33 @@
+import struct
+
 from cloudrunner.core.message import *  # noqa
 
 
+class Envelope(object):
+
+    """
+    Fixed routing envelope, sent as a separate frame ahead of a packed
+    message. Routers read it instead of unpacking the message itself.
+    """
+
+    _lens = struct.Struct('!HHHH')
+
+    @classmethod
+    def pack(cls, dest, peer='', org='', ident=''):
+        return cls._lens.pack(len(dest), len(peer), len(org),
+                              len(ident)) + dest + peer + org + ident
+
+    @classmethod
+    def unpack(cls, frame):
+        """ Returns (dest, peer, org, ident) """
+        pos = cls._lens.size
+        fields = []
+        for length in cls._lens.unpack_from(frame):
+            fields.append(frame[pos:pos + length])
+            pos += length
+        return tuple(fields)
+
+
 class NodeRegistration(M):
     fields = ['org', 'name']
 
@@ -27,6 +54,15 @@ class Fwd(M):
 
     fields = ['fwd_data']
 
+
+class GetBlob(M):
+    # Node -> session, asks for the script body of a Job with script_hash
+    fields = ['dest', 'hash']
+
+
+class Blob(M):
+    fields = ['hash', 'content']
+
     # Transport
 
 
@@ -39,7 +75,7 @@ class InitialMessage(M):
 class PipeMessage(M):
     status = StatusCodes.PIPEOUT
     fields = ["type", "session_id", "ts", "seq_no", "org",
-              "user", "run_as", "node", "stdout", "stderr"]
+              "user", "run_as", "node", "stdout", "stderr", "last_ts"]
 
     type = "PARTIAL"
 
@@ -60,6 +96,14 @@ class FinishedMessage(M):
     type = "FINISHED"
 
 
+class NodeResults(M):
+    # Results of the nodes finished so far, sent in chunks ahead of
+    # the FinishedMessage of the session
+    fields = ["type", "session_id", "ts", "user", "org", "results"]
+
+    type = "RESULTS"
+
+
 class EndMessage(M):
     status = StatusCodes.FINISHED
     fields = ["type", "session_id"]
@@ -12,6 +12,10 @@
 #  * without the express permission of CloudRunner.io
 #  *******************************************************/
 
+import heapq
+from threading import Lock
+import time
+
 ADMIN_TOWER = 'cloudrunner-control'
 
 
@@ -26,20 +30,23 @@ SCHEDULER_URI_TEMPLATE = "ipc://%(sock_dir)s/scheduler.sock"
 
 class TaskQueue(object):
 
-    def __init__(self):
+    def __init__(self, engine=None):
+        self.engine = engine
         self.tasks = []
-        self._callback = None
-        self._prepare = None
+        self.prepare_task = None
         self.owner = None
+        self.task_id = None
+        self.org = None
+        self.start_args = ({}, None)
+        # Restored from the session journal
+        self.restored = False
+        self.spool = None
 
     def push(self, task):
         self.tasks.append(task)
 
-    def callback(self, task):
-        self._callback = task
-
     def prepare(self, prepare):
-        self._prepare = prepare
+        self.prepare_task = prepare
 
     def find(self, task_id):
         return filter(lambda x: x.session_id == task_id, self.tasks)
@@ -51,15 +58,81 @@ class TaskQueue(object):
     def process(self):
         if not self.tasks:
             return
-        if self._prepare:
-            self._prepare.start()
-        for task in self.tasks:
-            task.start()
-        if self._callback:
-            self._callback.start()
+        self.engine.submit(self)
 
     def __str__(self):
         return "%s (%s)" % (self.task_ids, self.owner)
 
     def __repr__(self):
         return "%s (%s)" % (self.task_ids, self.owner)
+
+
+class SessionRegistry(object):
+
+    """
+    Task queues of the dispatcher, indexed by task id/session id and
+    by owner. Finished queues are kept for `ttl` seconds, so term and
+    notify can still tell the owner, then evicted.
+    Shared between the dispatcher and the session loop threads.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        # task id/session id -> TaskQueue
+        self.queues = {}
+        # owner -> set of task ids
+        self.owners = {}
+        # (evict time, task id, queue id) min-heap of finished queues
+        self._expiry = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return sum(len(task_ids) for task_ids in self.owners.values())
+
+    def _keys(self, queue):
+        return [queue.task_id] + queue.task_ids
+
+    def add(self, queue, now=None):
+        with self._lock:
+            self._expire(now or time.time())
+            for key in self._keys(queue):
+                self.queues[key] = queue
+            self.owners.setdefault(queue.owner, set()).add(queue.task_id)
+
+    def get(self, session_id, owner=None):
+        queue = self.queues.get(session_id)
+        if queue is not None and owner is not None and queue.owner != owner:
+            return None
+        return queue
+
+    def by_owner(self, owner):
+        with self._lock:
+            return [self.queues[task_id]
+                    for task_id in self.owners.get(owner, ())]
+
+    def finish(self, queue, now=None):
+        now = now or time.time()
+        with self._lock:
+            heapq.heappush(self._expiry,
+                           (now + self.ttl, queue.task_id, id(queue)))
+            self._expire(now)
+
+    def expire(self, now=None):
+        with self._lock:
+            self._expire(now or time.time())
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, task_id, queue_id = heapq.heappop(self._expiry)
+            queue = self.queues.get(task_id)
+            if queue is None or id(queue) != queue_id:
+                # Already evicted, or the task id was reused
+                continue
+            for key in self._keys(queue):
+                if self.queues.get(key) is queue:
+                    del self.queues[key]
+            owned = self.owners.get(queue.owner)
+            if owned is not None:
+                owned.discard(task_id)
+                if not owned:
+                    del self.owners[queue.owner]
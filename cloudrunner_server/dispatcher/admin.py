@@ -15,8 +15,11 @@
 from datetime import datetime
 import json
 import logging
-from threading import Thread
-from sqlalchemy import create_engine, event
+from M2Crypto import threading as m2threading
+from Queue import Queue, Empty
+from threading import Thread, Event, Lock
+import time
+from sqlalchemy import bindparam, create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import IntegrityError
 
@@ -28,31 +31,156 @@ from cloudrunner_server.api.model import (metadata, Node, NodeTag,
 from cloudrunner_server.api.model.exceptions import QuotaExceeded
 from cloudrunner_server.master.functions import (CertController,
                                                  CertificateExists)
-from cloudrunner_server.plugins.auth.base import NodeVerifier
+from cloudrunner_server.plugins.auth.base import NodeVerifier, TTLCache
 
 LOG = logging.getLogger('Control Tower')
 
+# REGISTER requests verified and signed in parallel
+REGISTER_WORKERS = 4
+# Requests waiting for a worker, receiving blocks when full
+REGISTER_QUEUE_SIZE = 1000
+# Max DB writes committed together
+COMMIT_BATCH = 100
+# Max wait for requests, before sending the replies of the workers
+POLL_TIMEOUT = 20  # ms
+# Seconds a resolved API key is used without checking the DB
+KEY_TTL = 60
+# Seconds between the batched last_used writes, which also drop
+# the cached keys disabled or deleted in the meantime
+KEY_FLUSH_INTERVAL = 10
+
 
 class ApiKeyVerifier(NodeVerifier):
 
+    """
+    Resolves the org from the API key in the CSR subject.
+    Keys are cached for KEY_TTL, last_used is written by flush().
+    """
+
+    keys = TTLCache(KEY_TTL)
+    # key -> last use, not written yet
+    _used = {}
+    _lock = Lock()
+
     def __init__(self, config):
         pass
 
     def verify(self, node, subject, **kwargs):
-        org = self.db.query(Org).join(User, ApiKey).filter(
-            ApiKey.value == subject.OU, ApiKey.enabled == True).first()  # noqa
-        if org:
-            key = self.db.query(ApiKey).join(User, Org).filter(
-                ApiKey.value == subject.OU).one()
-            key.last_used = datetime.utcnow()
-            self.db.add(key)
-            return org.name
+        key = subject.OU
+        org = self.keys.get(key)
+        if not org:
+            org = self.db.query(Org.name).join(User, ApiKey).filter(
+                ApiKey.value == key, ApiKey.enabled == True).scalar()  # noqa
+            if not org:
+                return None
+            self.keys.set(key, org)
+        with self._lock:
+            self._used[key] = datetime.utcnow()
+        return org
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            used, cls._used = cls._used, {}
+        if used:
+            cls.db.execute(
+                ApiKey.__table__.update().where(
+                    ApiKey.value == bindparam('_key')).values(
+                    last_used=bindparam('_ts')),
+                [dict(_key=key, _ts=ts) for key, ts in used.items()])
+        cached = cls.keys.keys()
+        if cached:
+            enabled = set(key for (key,) in cls.db.query(ApiKey.value).filter(
+                ApiKey.value.in_(cached), ApiKey.enabled == True))  # noqa
+            for key in set(cached) - enabled:
+                LOG.info("API key %s... disabled" % key[:8])
+                cls.keys.pop(key)
+
+
+class CommitQueue(Thread):
+
+    """
+    Runs the DB writes of the registration workers on one thread and
+    commits them in batches. Each write runs in a savepoint, so a failing
+    write (existing node, quota) only fails its own request.
+    """
+
+    def __init__(self, db, batch_size=COMMIT_BATCH):
+        super(CommitQueue, self).__init__()
+        self.db = db
+        self.batch_size = batch_size
+        self.daemon = True
+        self._ops = Queue()
+
+    def call(self, func, *args):
+        # Blocks until the batch with the write is committed,
+        # returns the result of func or raises its error
+        op = [func, args, Event(), None, None]
+        self._ops.put(op)
+        op[2].wait()
+        if op[4] is not None:
+            raise op[4]
+        return op[3]
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch = [self._ops.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._ops.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                stopped = True
+                batch = [op for op in batch if op is not None]
+            if batch:
+                self._commit(batch)
+        self.db.remove()
+
+    def _commit(self, batch):
+        try:
+            for op in batch:
+                savepoint = self.db.begin_nested()
+                try:
+                    op[3] = op[0](*op[1])
+                    savepoint.commit()
+                except Exception, ex:
+                    savepoint.rollback()
+                    op[4] = ex
+            self.db.commit()
+        except Exception, ex:
+            # The whole batch is lost
+            LOG.exception(ex)
+            self.db.rollback()
+            for op in batch:
+                if op[4] is None:
+                    op[4] = ex
+        finally:
+            for op in batch:
+                op[2].set()
+
+    def post(self, func, *args):
+        # Does not wait for the commit, errors are only logged
+        self._ops.put([self._logged, (func,) + args, Event(), None, None])
+
+    def _logged(self, func, *args):
+        try:
+            return func(*args)
+        except Exception, ex:
+            LOG.exception(ex)
+            raise
+
+    def stop(self):
+        self._ops.put(None)
 
 
 class Admin(Thread):
 
     """
     Admin class to process control requests like Register, etc.
+    REGISTER requests are verified and signed by a pool of workers,
+    replies are sent from this thread, routed by the request ident.
     """
 
     def __init__(self, config, backend):
@@ -61,19 +189,25 @@ class Admin(Thread):
         self.backend = backend
         self.db_path = config.db
         self.ccont = CertController(config)
+        self.workers = int(config.register_workers or REGISTER_WORKERS)
+        self.requests = Queue(REGISTER_QUEUE_SIZE)
+        self.replies = Queue()
+        # node -> (csr, [idents]) of the requests in progress
+        self.in_flight = {}
 
     def set_context_from_config(self, recreate=None, **configuration):
-        session = scoped_session(sessionmaker())
         engine = create_engine(self.db_path, **configuration)
         if 'mysql+pymysql://' in self.db_path:
             event.listen(engine, 'checkout', checkout_listener)
-        session.bind = engine
-        metadata.bind = session.bind
+        # Bound for the sessions of the worker threads too
+        session = scoped_session(sessionmaker(bind=engine))
+        metadata.bind = engine
         if recreate:
             # For tests: re-create tables
             metadata.create_all(engine)
         self.db = session
         ApiKeyVerifier.db = session
+        self.commits = CommitQueue(session)
 
     def run(self):
         # Endpoint to receive commands from nodes
@@ -81,10 +215,23 @@ class Admin(Thread):
                                                      ident=ADMIN_TOWER)
         self.node_reply_queue = self.backend.publish_queue('out_messages')
 
-        packets = []
+        m2threading.init()
+        self.commits.start()
+        workers = []
+        for i in range(self.workers):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        flush_at = time.time() + KEY_FLUSH_INTERVAL
         while True:
             try:
-                packed = self.admin_endp.recv(100)
+                self._send_replies()
+                if time.time() >= flush_at:
+                    self.commits.post(ApiKeyVerifier.flush)
+                    flush_at = time.time() + KEY_FLUSH_INTERVAL
+                packed = self.admin_endp.recv(POLL_TIMEOUT)
                 if packed:
                     req = M.build(packed[0])
                     if not req:
@@ -92,16 +239,8 @@ class Admin(Thread):
                                  packed)
                         continue
                     LOG.debug("ADMIN_TOWER recv: %s" % req)
-                    rep = self.process(req)
-                    if not rep:
-                        continue
-                    LOG.info("ADMIN_TOWER reply: %s:%s" %
-                             (rep.control, rep.status))
-                    rep.hdr.ident = req.hdr.ident
-                    packets.append(rep)
-                while packets:
-                    msg = packets.pop(0)
-                    self.node_reply_queue.send(msg._)
+                    if req.control == 'REGISTER':
+                        self._register(req)
             except ConnectionError:
                 break
             except KeyboardInterrupt:
@@ -109,32 +248,78 @@ class Admin(Thread):
             except Exception, ex:
                 LOG.exception(ex)
 
+        for worker in workers:
+            self.requests.put(None)
+        self.commits.post(ApiKeyVerifier.flush)
+        self.commits.stop()
         self.close()
         LOG.info("Exiting Admin thread")
 
+    def _register(self, req):
+        pending = self.in_flight.get(req.node)
+        if pending:
+            csr, idents = pending
+            if csr != req.data:
+                self._reply(req.hdr.ident,
+                            Control(req.node, 'REJECTED', 'PENDING'))
+            elif req.hdr.ident not in idents:
+                # Repeated request, gets the reply of the first one
+                idents.append(req.hdr.ident)
+            return
+        self.in_flight[req.node] = (req.data, [req.hdr.ident])
+        self.requests.put(req)
+
+    def _send_replies(self):
+        while True:
+            try:
+                req, rep = self.replies.get_nowait()
+            except Empty:
+                break
+            _, idents = self.in_flight.pop(req.node,
+                                           (None, [req.hdr.ident]))
+            if not rep:
+                continue
+            LOG.info("ADMIN_TOWER reply: %s:%s" % (rep.control, rep.status))
+            for ident in idents:
+                self._reply(ident, rep)
+
+    def _reply(self, ident, rep):
+        rep.hdr.ident = ident
+        self.node_reply_queue.send(rep._)
+
+    def _work(self):
+        while True:
+            req = self.requests.get()
+            if req is None:
+                break
+            rep = None
+            try:
+                rep = self.process(req)
+            except Exception, ex:
+                LOG.exception(ex)
+            self.replies.put((req, rep))
+        self.db.remove()
+
     def process(self, req):
         LOG.info("Received admin req: %s %s" % (req.control, req.node))
 
         if req.control == 'REGISTER':
             try:
                 tags = []
-                node = None
+                node_id = None
                 try:
                     valid, msg, org, tags = self.ccont.validate_request(
                         req.node, req.data)
-                    LOG.info("Validate req: %s:%s" % (org, valid))
-                    _org = self.db.query(Org).filter(Org.name == org).one()
-                    node = Node(name=req.node, meta=json.dumps(req.meta),
-                                approved=False, org=_org,
-                                auto_cleanup=bool(req.auto_cleanup))
-                    self.db.add(node)
+                    # End the read transaction of the verifiers
                     self.db.commit()
+                    LOG.info("Validate req: %s:%s" % (org, valid))
+                    if valid:
+                        node_id = self.commits.call(self._add_node, req,
+                                                    org, tags)
                 except IntegrityError, iex:
-                    self.db.rollback()
                     LOG.warn(iex.orig)
                     return Control(req.node, 'REJECTED', 'ERR_CRT_EXISTS')
                 except QuotaExceeded, qex:
-                    self.db.rollback()
                     LOG.error(qex)
                     self.ccont.revoke(req.node, ca=org)
                     return Control(req.node, 'REJECTED', 'QUOTA_FAIL')
@@ -144,56 +329,39 @@ class Admin(Thread):
                     valid, cert_or_msg = self.ccont.build_cert_chain(
                         req.node, cex.org, req.data)
                     if valid:
-                        node = self.db.query(Node).join(Org).filter(
-                            Node.name == req.node, Org.name == cex.org).one()
-                        if node.approved:
-                            self.db.commit()
-                            return Control(req.node, 'APPROVED', cert_or_msg)
-                        node.approved = True
-                        node.approved_at = datetime.now()
-                        self.db.commit()
+                        self.commits.call(self._approve_existing, req.node,
+                                          cex.org)
                         return Control(req.node, 'APPROVED', cert_or_msg)
                     else:
-                        self.db.rollback()
                         return Control(req.node, 'REJECTED', cert_or_msg)
                 except Exception, ex:
                     LOG.exception(ex)
 
                 if not valid:
                     LOG.info("Request validation result: %s" % msg)
-                    self.db.rollback()
                     return Control(req.node, 'REJECTED', "INV_CSR")
-
-                if node:
-                    for tag in tags:
-                        t = NodeTag(value=tag)
-                        self.db.add(t)
-                        node.tags.append(t)
+                if not node_id:
+                    return Control(req.node, 'REJECTED', 'APPR_FAIL')
 
                 if not self.ccont.can_approve(req.node):
                     return Control(req.node, 'REJECTED', 'PENDING')
 
-                msgs, cert_file = self.ccont.sign_node(req.node, ca=org)
+                # Approved below, with the other nodes in the batch
+                msgs, cert_file = self.ccont.sign_node(req.node, ca=org,
+                                                       approve=False)
                 approved = bool(cert_file)
-                node.approved = approved
-                node.approved_at = datetime.now()
-                self.db.commit()
+                self.commits.call(self._set_approved, node_id, approved)
                 if not approved:
                     LOG.warn(msgs)
-                else:
-                    LOG.info("Request approved")
+                    return Control(req.node, 'REJECTED', "APPR_FAIL")
 
-                if approved:
-                    success, cert_or_msg = self.ccont.build_cert_chain(
-                        req.node, org, req.data)
-                    if success:
-                        return Control(req.node, 'APPROVED', cert_or_msg)
-                    else:
-                        return Control(req.node, 'REJECTED', cert_or_msg)
+                LOG.info("Request approved")
+                success, cert_or_msg = self.ccont.build_cert_chain(
+                    req.node, org, req.data)
+                if success:
+                    return Control(req.node, 'APPROVED', cert_or_msg)
                 else:
-                    self.db.delete(node)
-                    self.db.commit()
-                    return Control(req.node, 'REJECTED', "APPR_FAIL")
+                    return Control(req.node, 'REJECTED', cert_or_msg)
             except Exception, ex:
                 self.db.rollback()
                 LOG.exception(ex)
@@ -201,6 +369,36 @@ class Admin(Thread):
 
         return None
 
+    # DB writes, run by the CommitQueue
+
+    def _add_node(self, req, org, tags):
+        _org = self.db.query(Org).filter(Org.name == org).one()
+        node = Node(name=req.node, meta=json.dumps(req.meta),
+                    approved=False, org=_org,
+                    auto_cleanup=bool(req.auto_cleanup))
+        self.db.add(node)
+        for tag in tags:
+            t = NodeTag(value=tag)
+            self.db.add(t)
+            node.tags.append(t)
+        self.db.flush()
+        return node.id
+
+    def _approve_existing(self, name, org):
+        node = self.db.query(Node).join(Org).filter(
+            Node.name == name, Org.name == org).one()
+        if not node.approved:
+            node.approved = True
+            node.approved_at = datetime.now()
+
+    def _set_approved(self, node_id, approved):
+        node = self.db.query(Node).filter(Node.id == node_id).one()
+        if approved:
+            node.approved = True
+            node.approved_at = datetime.now()
+        else:
+            self.db.delete(node)
+
     def close(self, *args):
         LOG.info("Stopping Admin Process")
         self.admin_endp.close()
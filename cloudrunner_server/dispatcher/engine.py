@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import heapq
+from itertools import count
+import logging
+from Queue import Queue, Empty
+from threading import Thread, Event
+import time
+
+from cloudrunner.core.exceptions import ConnectionError
+from cloudrunner_server.core.message import (M, InitialMessage, EndMessage,
+                                             SysMessage)
+from cloudrunner_server.util import timestamp
+
+LOG = logging.getLogger('SessionEngine')
+
+# Max time to block in poll, calls from other threads wait at most that much
+POLL_TIMEOUT = 50  # ms
+# Max node replies processed in one go, before running timers
+DRAIN_SIZE = 1000
+
+
+class SessionEngine(Thread):
+
+    """
+    Event loop, which runs job sessions as state machines.
+    All sessions of the loop share its in_messages/out_messages/logger
+    sockets, node replies are routed to the sessions by session id.
+    """
+
+    def __init__(self, manager, ident):
+        super(SessionEngine, self).__init__()
+        self.manager = manager
+        self.queue_ident = ident
+        # session_id -> JobSession
+        self.sessions = {}
+        self.stopped = Event()
+        self._calls = Queue()
+        # (time, seq, func, args) min-heap
+        self._timers = []
+        self._seq = count()
+        self.job_queue = None
+        self.job_reply = None
+        self.job_done = None
+
+    def call_soon(self, func, *args):
+        # Thread safe, func is run from the loop
+        self._calls.put((func, args))
+
+    def call_later(self, delay, func, *args):
+        # Loop thread only
+        heapq.heappush(self._timers, (time.time() + delay, next(self._seq),
+                                      func, args))
+
+    def submit(self, queue):
+        self.call_soon(self._start_queue, queue)
+
+    def add(self, session):
+        self.sessions[session.session_id] = session
+        session.start(self)
+
+    def remove(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    def _start_queue(self, queue):
+        if not queue.restored:
+            message = InitialMessage(session_id=queue.task_id,
+                                     ts=timestamp(), org=queue.org,
+                                     user=queue.owner)
+            self.job_done.send(message._)
+        for session in queue.tasks:
+            self.add(session)
+        if queue.prepare_task:
+            # Creates cloud machines, calls back when done
+            queue.prepare_task.start()
+        else:
+            queue.tasks[0].resume(*queue.start_args)
+
+    def end_queue(self, queue, *args):
+        message = SysMessage(session_id=queue.task_id, ts=timestamp(),
+                             org=queue.org, user=queue.owner,
+                             stdout="Finished processing tasks")
+        self.job_done.send(message._)
+        message = EndMessage(session_id=queue.tasks[-1].session_id,
+                             org=queue.org)
+        self.job_done.send(message._)
+
+    def _run_calls(self):
+        while True:
+            try:
+                func, args = self._calls.get_nowait()
+            except Empty:
+                break
+            self._call(func, args)
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, func, args = heapq.heappop(self._timers)
+            self._call(func, args)
+
+    def _call(self, func, args):
+        try:
+            func(*args)
+        except ConnectionError:
+            raise
+        except Exception, ex:
+            LOG.exception(ex)
+
+    def _timeout(self):
+        if not self._calls.empty():
+            return 0
+        if not self._timers:
+            return POLL_TIMEOUT
+        wait = int((self._timers[0][0] - time.time()) * 1000)
+        return max(0, min(wait, POLL_TIMEOUT))
+
+    def _dispatch(self, frames):
+        job_rep = M.build(frames[0])
+        if not job_rep:
+            LOG.error("Invalid reply from node: %s" % frames)
+            return
+        session = self.sessions.get(job_rep.hdr.dest)
+        if not session:
+            LOG.debug("Reply for inactive session %s" % job_rep.hdr.dest)
+            return
+        session.on_message(job_rep)
+
+    def run(self):
+        backend = self.manager.backend
+        self.job_queue = backend.consume_queue('in_messages',
+                                               ident=self.queue_ident)
+        self.job_reply = backend.publish_queue('out_messages')
+        self.job_done = backend.publish_queue('logger')
+        poller = backend.create_poller(self.job_queue)
+
+        try:
+            while not self.stopped.is_set():
+                self._run_calls()
+                self._run_timers()
+                if self.job_queue not in poller.poll(self._timeout()):
+                    continue
+                for i in range(DRAIN_SIZE):
+                    frames = self.job_queue.recv(0)
+                    if not frames:
+                        break
+                    self._call(self._dispatch, (frames,))
+        except ConnectionError:
+            # Transport died
+            pass
+
+        for session in self.sessions.values():
+            session.session_event.set()
+        self.job_queue.close()
+        self.job_reply.close()
+        self.job_done.close()
+        LOG.info("Session engine %s exited" % self.queue_ident)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import json
+import logging
+import os
+from threading import Lock
+import time
+
+LOG = logging.getLogger('SessionJournal')
+
+# Records written before an fsync
+BATCH_SIZE = 100
+# Max seconds a record waits for the fsync
+FLUSH_INTERVAL = .2
+# Compact when the file grew that much since the last compaction
+COMPACT_RATIO = 2
+COMPACT_MIN_SIZE = 1024 * 1024
+
+
+class SessionJournal(object):
+
+    """
+    Append-only journal of task queue and session transitions, one
+    JSON record per line:
+
+        ["queue", task_id, {owner, org, env, sessions}]
+        ["start", session_id, start_at]
+        ["node", session_id, node, state]
+        ["end", session_id, env]
+        ["done", task_id]
+
+    Records are buffered and fsync'd in batches. The journal keeps
+    the state of the live queues in memory, which is what load()
+    returns after a restart and what compact() writes back.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE,
+                 interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        # task_id -> queue state
+        self.queues = {}
+        # session_id -> task_id
+        self.index = {}
+        self._buffer = []
+        self._flushed = time.time()
+        self._compacted_size = 0
+        self._lock = Lock()
+        self._file = None
+
+    def _apply(self, record):
+        verb = record[0]
+        if verb == 'queue':
+            task_id, queue = record[1], record[2]
+            queue['task_id'] = task_id
+            queue.setdefault('started', [])
+            queue.setdefault('start_at', {})
+            queue.setdefault('nodes', {})
+            queue.setdefault('ended', {})
+            self.queues[task_id] = queue
+            for session in queue['sessions']:
+                self.index[session['session_id']] = task_id
+        elif verb == 'done':
+            queue = self.queues.pop(record[1], None)
+            if queue:
+                for session in queue['sessions']:
+                    self.index.pop(session['session_id'], None)
+        else:
+            session_id = record[1]
+            queue = self.queues.get(self.index.get(session_id))
+            if queue is None:
+                return
+            if verb == 'start':
+                if session_id not in queue['started']:
+                    queue['started'].append(session_id)
+                if len(record) > 2:
+                    queue['start_at'][session_id] = record[2]
+            elif verb == 'node':
+                queue['nodes'].setdefault(session_id, {})[record[2]] = \
+                    record[3]
+            elif verb == 'end':
+                queue['ended'][session_id] = record[2]
+
+    def record(self, *record):
+        try:
+            line = json.dumps(record)
+        except (TypeError, ValueError), ex:
+            LOG.error("Cannot journal %s record: %s" % (record[0], ex))
+            return
+        with self._lock:
+            self._apply(json.loads(line))
+            self._buffer.append(line)
+            if len(self._buffer) >= self.batch_size:
+                self._flush()
+
+    def queue(self, task_id, owner, org, env, sessions):
+        self.record('queue', task_id, dict(owner=owner, org=org, env=env,
+                                           sessions=sessions))
+
+    def load(self):
+        """
+        Replays the journal, returns the state of the queues,
+        which were not done
+        """
+        with self._lock:
+            self.queues.clear()
+            self.index.clear()
+            try:
+                data = open(self.path).read()
+            except IOError:
+                data = ''
+            # A partially written last line is dropped
+            for line in data.split('\n')[:-1]:
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, IndexError, KeyError, TypeError):
+                    LOG.error("Invalid journal record: %r" % line[:100])
+            return [self.queues[task_id]
+                    for task_id in sorted(self.queues)]
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        return self._file
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        journal = self._open()
+        journal.write(''.join('%s\n' % line for line in self._buffer))
+        journal.flush()
+        os.fsync(journal.fileno())
+        self._buffer = []
+        self._flushed = time.time()
+        size = journal.tell()
+        if size > max(COMPACT_MIN_SIZE,
+                      self._compacted_size * COMPACT_RATIO):
+            self._compact()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _compact(self):
+        tmp_file = '%s.compact' % self.path
+        with open(tmp_file, 'w') as tmp:
+            for task_id in sorted(self.queues):
+                for record in self._records(task_id, self.queues[task_id]):
+                    tmp.write('%s\n' % json.dumps(record))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            self._compacted_size = tmp.tell()
+        os.rename(tmp_file, self.path)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _records(self, task_id, queue):
+        yield ['queue', task_id, dict(owner=queue['owner'],
+                                      org=queue['org'], env=queue['env'],
+                                      sessions=queue['sessions'])]
+        for session_id in queue['started']:
+            if session_id in queue['start_at']:
+                yield ['start', session_id, queue['start_at'][session_id]]
+            else:
+                yield ['start', session_id]
+        for session_id, nodes in queue['nodes'].items():
+            for node, state in nodes.items():
+                yield ['node', session_id, node, state]
+        for session_id, env in queue['ended'].items():
+            yield ['end', session_id, env]
+
+    def compact(self):
+        # Rewrite the journal with the live queues only
+        with self._lock:
+            self._flush()
+            self._compact()
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            stop_event.wait(self.interval)
+            with self._lock:
+                if self._buffer and \
+                        time.time() - self._flushed >= self.interval:
+                    try:
+                        self._flush()
+                    except Exception, ex:
+                        LOG.exception(ex)
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
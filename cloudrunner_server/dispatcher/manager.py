@@ -17,18 +17,20 @@ import logging
 from os import path
 from threading import Thread, Event
 import time
-from Queue import Queue, Empty
 import uuid
+from zlib import crc32
 
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from cloudrunner import LIB_DIR
-from cloudrunner_server.api.model import (CloudProfile, NodeGroup, User,
-                                          TaskGroup, Resource, metadata)
-from cloudrunner_server.core.message import (SafeDictWrapper, InitialMessage,
-                                             EndMessage, SysMessage)
-from cloudrunner_server.dispatcher import TaskQueue
+from cloudrunner_server.api.model import (CloudProfile, NodeGroup, Org,
+                                          User, TaskGroup, Resource, metadata)
+from cloudrunner_server.core.message import SysMessage
+from cloudrunner_server.dispatcher import SessionRegistry, TaskQueue
+from cloudrunner_server.dispatcher.engine import SessionEngine
+from cloudrunner_server.dispatcher.journal import SessionJournal
+from cloudrunner_server.dispatcher.spool import Spool
 from cloudrunner_server.dispatcher.session import JobSession
 from cloudrunner_server.plugins.clouds.base import BaseCloudProvider
 from cloudrunner_server.util import timestamp
@@ -46,22 +48,30 @@ class SessionManager(object):
         self.discovery_timeout = int(self.config.discovery_timeout or 2)
         self.wait_timeout = int(self.config.wait_timeout or 300)
         self.sessions = {}
-        self.subscriptions = []
+        self.subscriptions = SessionRegistry(
+            ttl=int(self.config.session_ttl or 300))
+        self.spool_dir = self.config.spool_dir or path.join(LIB_DIR,
+                                                            "spool")
 
         self.publisher = self.backend.create_fanout('publisher')
 
-        # Restore jobs
-        self.cache = self.config.session_cache or path.join(
-            LIB_DIR, "session.cache")
-        if path.exists(self.cache):
-            cached = open(self.cache).read().strip()
-            if cached:
-                try:
-                    sessions = json.loads(cached, encoding='latin-1')
-                    self.resume_sessions(*sessions)
+        # Session loops, all sessions of a task run in the same loop
+        self.engines = []
+        for i in range(int(self.config.session_loops or 1)):
+            engine = SessionEngine(self, 'sessions-%s' % uuid.uuid4().hex)
+            engine.start()
+            self.engines.append(engine)
 
-                except Exception, ex:
-                    LOG.exception(ex)
+        # Restore jobs
+        self.journal = SessionJournal(
+            self.config.session_journal or path.join(LIB_DIR,
+                                                     "session.journal"))
+        self.journal_stop = Event()
+        try:
+            self.resume_sessions()
+        except Exception, ex:
+            LOG.exception(ex)
+        Thread(target=self.journal.run, args=(self.journal_stop,)).start()
 
     def set_context_from_config(self, recreate=None, **configuration):
         session = scoped_session(sessionmaker())
@@ -75,117 +85,157 @@ class SessionManager(object):
             metadata.create_all(engine)
         self.db = session
 
-    def _expand_target(self, targets):
+    def _expand_target(self, targets, org):
         possible_groups = [t for t in targets if not isinstance(t, dict)
                            and "=" not in t]
         expanded_nodes = []
         if possible_groups:
-            groups = self.db.query(NodeGroup).filter(
-                NodeGroup.name.in_(targets)).all()
+            groups = self.db.query(NodeGroup).join(Org).filter(
+                NodeGroup.name.in_(possible_groups),
+                Org.name == org).all()
             for g in groups:
                 for n in g.nodes:
                     expanded_nodes.append(n.name)
 
         return targets + expanded_nodes
 
+    def _engine(self, task_id):
+        return self.engines[crc32(str(task_id)) % len(self.engines)]
+
     def prepare_session(self, user, task_id, tasks,
                         remote_user_map, **kwargs):
-        queue = TaskQueue()
+        engine = self._engine(task_id)
+        queue = TaskQueue(engine)
         queue.owner = user
+        queue.task_id = task_id
+        queue.org = remote_user_map['org']
+        queue.start_args = (kwargs.get('env', {}), kwargs.get('attachments'))
+        queue.spool = Spool(self.spool_dir, task_id)
         timeout = 0
-        env_in = Queue()
-        start_args = (kwargs.get('env', {}), kwargs.get('attachments'))
-        # env_in.put()
-        env_out = Queue()
         global_job_event = Event()
         for task in tasks:
-            task['targets'] = self._expand_target(task['targets'])
+            task['targets'] = self._expand_target(task['targets'],
+                                                  remote_user_map['org'])
 
-        prepare_thread = PrepareThread(self, task_id, user, task_id,
-                                       tasks, remote_user_map['org'],
-                                       env_in, start_args,
-                                       global_job_event)
-        queue.prepare(prepare_thread)
+        if any(isinstance(target, dict) for task in tasks
+               for target in task['targets']):
+            # Cloud machines to be created first
+            prepare_thread = PrepareThread(self, task_id, user, task_id,
+                                           tasks, remote_user_map['org'],
+                                           queue, global_job_event)
+            queue.prepare(prepare_thread)
 
         prev = None
         for step_id, task in enumerate(tasks):
 
             session_id = uuid.uuid4().hex
             LOG.info("Enqueue new session %s" % session_id)
-            sess_thread = JobSession(self, user, session_id, task_id, step_id,
-                                     task, remote_user_map, env_in, env_out,
-                                     timeout, prev,
-                                     stop_event=global_job_event, **kwargs)
-            timeout += sess_thread.timeout + 2
-            env_in = env_out
-            env_out = Queue()
-            queue.push(sess_thread)
-            self.sessions[session_id] = sess_thread
+            session = JobSession(self, user, session_id, task_id, step_id,
+                                 task, remote_user_map, timeout, prev,
+                                 stop_event=global_job_event, **kwargs)
+            timeout += session.timeout + 2
+            session.spool = queue.spool
+            if prev:
+                queue.tasks[-1].on_finish = session.resume
+            queue.push(session)
+            self.sessions[session_id] = session
             prev = session_id
         if queue.tasks:
-            end_thread = EndThread(self, session_id, task_id, user,
-                                   remote_user_map['org'],
-                                   queue.tasks[-1].env_out,
-                                   timeout)
-            queue.callback(end_thread)
-        self.subscriptions.append(queue)
+            queue.tasks[-1].on_finish = lambda *args: self._end_queue(queue)
+        self.subscriptions.add(queue)
+        self.journal.queue(task_id, user, queue.org, queue.start_args[0],
+                           [task.serialize() for task in queue.tasks])
         return queue
 
-    def resume_sessions(self, *sessions):
-        return
-        queue = TaskQueue()
-        timeout = 0
-        sessions = sorted(sessions, key=lambda s: bool(s.get('parent')))
-        env_out = Queue()
-        for session in sessions:
+    def _end_queue(self, queue):
+        queue.engine.end_queue(queue)
+        queue.spool.cleanup()
+        self.subscriptions.finish(queue)
+        self.journal.record('done', queue.task_id)
+
+    def resume_sessions(self):
+        # Rebuild the queues, which were running when the dispatcher
+        # stopped, from the session journal
+        states = self.journal.load()
+        for state in states:
             try:
-                s = SafeDictWrapper(session)
-                session_id = s['session_id']
-                LOG.info("Resume session %s" % session_id)
-
-                env_in = None
-                restore = True
-                if s.parent:
-                    parent = any([sess for sess in sessions
-                                  if sess['session_id'] == s.parent])
-                    if parent:
-                        parent_thread = queue.find(s.parent)
-                        if parent_thread:
-                            env_in = parent_thread[0].env_out
-
-                env_out = Queue()
-                sess_thread = JobSession(self, s.user, s.task_id, session_id,
-                                         s.step_id, s.task, s.remote_user_map,
-                                         env_in, env_out, s.timeout, s.parent,
-                                         node_map=s.node_map,
-                                         **s.kwargs)
-                sess_thread.restore = restore
-                queue.push(sess_thread)
-                self.sessions[session_id] = sess_thread
+                self._resume_queue(state)
             except Exception, ex:
                 LOG.exception(ex)
-        if queue.tasks:
-            end_thread = EndThread(self, session_id, s.task_id, s.user,
-                                   s.remote_user_map['org'],
-                                   queue.tasks[-1].env_out,
-                                   timeout)
-            queue.callback(end_thread)
-        self.subscriptions.append(queue)
+        self.journal.compact()
+        LOG.info("Resumed %s task queues" % len(states))
+
+    def _resume_queue(self, state):
+        task_id = state['task_id']
+        engine = self._engine(task_id)
+        queue = TaskQueue(engine)
+        queue.owner = state['owner']
+        queue.task_id = task_id
+        queue.org = state['org']
+        queue.restored = True
+        queue.spool = Spool(self.spool_dir, task_id)
+        env = state['env']
+        global_job_event = Event()
+        prev = None
+        for ser in state['sessions']:
+            session_id = ser['session_id']
+            if session_id in state['ended']:
+                # Next session continues with the env of this one
+                env = state['ended'][session_id]
+                prev = session_id
+                continue
+            LOG.info("Resume session %s" % session_id)
+            session = JobSession(self, ser['user'], session_id, task_id,
+                                 ser['step_id'], ser['task'],
+                                 ser['remote_user_map'], ser['timeout'],
+                                 prev, stop_event=global_job_event,
+                                 node_map=state['nodes'].get(session_id, {}),
+                                 **ser['kwargs'])
+            if session_id in state['started']:
+                # Still running on the nodes
+                session.restore = True
+                session.start_at = state['start_at'].get(session_id, 0)
+                session.env = env
+                session.request['env'] = env
+            session.spool = queue.spool
+            if queue.tasks:
+                queue.tasks[-1].on_finish = session.resume
+            queue.push(session)
+            self.sessions[session_id] = session
+            prev = session_id
+
+        if not queue.tasks:
+            # Finished, but not marked as done
+            self.journal.record('done', task_id)
+            return
+        queue.start_args = (env, None)
+        queue.tasks[-1].on_finish = lambda *args: self._end_queue(queue)
+        self.subscriptions.add(queue)
         queue.process()
 
-    def register_session(self, session_id):
-        self.backend.register_session(session_id)
+    def register_session(self, session_id, ident=None):
+        self.backend.register_session(session_id, ident)
+
+    def resolve_targets(self, org, targets):
+        try:
+            return self.backend.resolve_targets(org, targets)
+        except Exception, ex:
+            LOG.exception(ex)
+            return None
 
     def delete_session(self, session_id):
         self.backend.unregister_session(session_id)
-        try:
-            del self.subscriptions[self.session_id]
-        except:
-            pass
-        try:
-            del self.sessions[session_id]
-        except:
-            pass
+        self.sessions.pop(session_id, None)
+
+    def stop_session(self, session_id, reason='term'):
+        session = self.sessions.get(session_id)
+        if not session:
+            return False
+        session.stop_reason = reason
+        session.session_event.set()
+        if session.engine:
+            session.engine.call_soon(session.check)
+        return True
 
     def notify(self, session_id, job_id, payload, targets,
                remote_user_map, **kwargs):
@@ -195,17 +245,12 @@ class SessionManager(object):
 
     def stop(self):
         LOG.info("Stopping Publisher")
-        open(self.cache, 'w').write(json.dumps(
-            [sess.serialize() for sess in self.sessions.values()],
-            ensure_ascii=False))
-        for session in self.sessions.values():
-            session.session_event.set()
-        # self.transport.destroy_jobs()
-        for session in self.sessions.values():
-            if session.is_alive():
-                session.session_event.set()
-                session.env_in.put({})
-                session.join(.2)
+        # Running sessions are left in the journal and resumed on start
+        for engine in self.engines:
+            engine.stop()
+        for engine in self.engines:
+            engine.join(1)
+        self.journal_stop.set()
 
         LOG.info("Stopped Publisher")
 
@@ -213,15 +258,14 @@ class SessionManager(object):
 class PrepareThread(Thread):
 
     def __init__(self, manager, session_id, user, task_id, tasks,
-                 org, out_queue, start_args, job_event):
+                 org, queue, job_event):
         super(PrepareThread, self).__init__()
         self.session_id = str(session_id)
         self.user = user
         self.task_id = task_id
         self.tasks = tasks
         self.org = org
-        self.out_queue = out_queue
-        self.start_args = start_args
+        self.queue = queue
         self.manager = manager
         self.job_event = job_event
         self.job_done = self.manager.backend.publish_queue('logger')
@@ -238,12 +282,6 @@ class PrepareThread(Thread):
         self.node_connected = self.manager.backend.subscribe_fanout(
             'admin_fwd', sub_patterns=[self.org])
 
-        message = InitialMessage(session_id=self.session_id,
-                                 ts=timestamp(),
-                                 org=self.org,
-                                 user=self.user)
-        self.job_done.send(message._)
-
         wait_for_machines = []
         for task in self.tasks:
             for target in task['targets']:
@@ -337,36 +375,8 @@ class PrepareThread(Thread):
                 LOG.exception(ex)
                 self.log(stderr=ex.message)
 
-        self.out_queue.put(self.start_args)
+        # Start the first task
+        self.queue.engine.call_soon(self.queue.tasks[0].resume,
+                                    *self.queue.start_args)
         self.node_connected.close()
         self.job_done.close()
-
-
-class EndThread(Thread):
-
-    def __init__(self, manager, session_id, task_id, user, org, event,
-                 timeout):
-        super(EndThread, self).__init__()
-        self.session_id = str(session_id)
-        self.task_id = str(task_id)
-        self.org = org
-        self.user = user
-        self.event = event
-        self.timeout = timeout
-        self.job_done = manager.backend.publish_queue('logger')
-
-    def log(self, stdout=None, stderr=None):
-        message = SysMessage(session_id=self.task_id, ts=timestamp(),
-                             org=self.org, user=self.user,
-                             stdout=stdout, stderr=stderr)
-        self.job_done.send(message._)
-
-    def run(self):
-        try:
-            self.event.get(True, self.timeout)
-        except Empty:
-            pass
-        self.log(stdout="Finished processing tasks")
-        message = EndMessage(session_id=self.session_id, org=self.org)
-        self.job_done.send(message._)
-        self.job_done.close()
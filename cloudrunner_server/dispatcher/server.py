@@ -48,7 +48,8 @@ from cloudrunner_server.dispatcher import (TaskQueue)
 from cloudrunner_server.dispatcher.admin import Admin
 from cloudrunner_server.dispatcher.manager import SessionManager
 from cloudrunner_server.plugins import PLUGIN_BASES
-from cloudrunner_server.plugins.logs.base import LoggerPluginBase
+from cloudrunner_server.plugins.logs.base import (LoggerPluginBase,
+                                                  LogPartitions)
 
 LOG = logging.getLogger("Dispatcher")
 
@@ -177,9 +178,8 @@ class Dispatcher(Daemon):
         job_id = str(kwargs.pop('job_id'))
 
         targets = str(kwargs.pop('targets', '*'))
-        session = [sess for sess in self.manager.subscriptions.get(
-            session_id, []) if sess.owner == self.user_id]
-        if not session:
+        if not self.manager.subscriptions.get(session_id,
+                                              owner=self.user_id):
             return [False, "You are not the owner of the session"]
         job_queue = self.manager.backend.publish_queue('user_input')
         job_queue.send(job_id, '', 'INPUT', session_id, self.user_id,
@@ -190,15 +190,12 @@ class Dispatcher(Daemon):
     def term(self, payload, remote_user_map, **kwargs):
         session_id = str(kwargs.pop('session_id'))
 
-        session_sub = [sess for sess in self.manager.subscriptions.get(
-            session_id, []) if sess.owner == self.user_id]
-        if not session_sub:
+        if not self.manager.subscriptions.get(session_id,
+                                              owner=self.user_id):
             return [False, "You are not the owner of the session"]
 
-        session = self.manager.sessions.get(session_id)
-        if session:
-            session.stop_reason = str(kwargs.get('action', 'term'))
-            session.session_event.set()
+        if self.manager.stop_session(session_id,
+                                     str(kwargs.get('action', 'term'))):
             return [True, "Session terminated"]
         else:
             return [False, "Session not found"]
@@ -277,6 +274,7 @@ class Dispatcher(Daemon):
         LOG.info('Server worker exited')
 
     def logger_worker(self, *args):
+        # Single reader, keeps the order of the messages of a session
         log_queue = self.backend.consume_queue('logger')
 
         while not self.stopping.is_set():
@@ -284,10 +282,11 @@ class Dispatcher(Daemon):
                 frames = log_queue.recv(timeout=500)
                 if not frames:
                     continue
-                try:
-                    self.logger.log(M.build(frames[0]))
-                except Exception, err:
-                    LOG.exception(err)
+                msg = M.build(frames[0])
+                if not msg:
+                    LOG.error("Invalid log message: %s" % frames)
+                    continue
+                self.log_partitions.put(msg)
             except ConnectionError:
                 break
             except Exception, err:
@@ -295,6 +294,7 @@ class Dispatcher(Daemon):
                 continue
 
         log_queue.close()
+        self.log_partitions.stop()
         LOG.info('Logger worker exited')
 
     def choose(self):
@@ -336,10 +336,12 @@ class Dispatcher(Daemon):
 
         self.logger_threads = []
         if self.logger:
-            for i in range(LOG_WORKER_COUNT):
-                thread = threading.Thread(target=self.logger_worker, args=[])
-                thread.start()
-                self.logger_threads.append(thread)
+            # Sessions are logged in parallel by the partitions
+            self.log_partitions = LogPartitions(self.logger, LOG_WORKER_COUNT)
+            self.log_partitions.start()
+            thread = threading.Thread(target=self.logger_worker, args=[])
+            thread.start()
+            self.logger_threads.append(thread)
 
         signal.signal(signal.SIGINT, self._handle_terminate)
         signal.signal(signal.SIGTERM, self._handle_terminate)
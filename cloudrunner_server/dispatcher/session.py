@@ -13,40 +13,73 @@
 #  *******************************************************/
 
 from datetime import datetime
+from hashlib import sha1
 import logging
+import msgpack
 import re
-from Queue import Empty
 from sys import maxint as MAX_INT
-from threading import (Thread, Event)
+from threading import Event
 import time
 
 from cloudrunner.core.parser import has_params, is_script
-from cloudrunner.core.exceptions import (ConnectionError, InterruptExecution,
+from cloudrunner.core.exceptions import (InterruptExecution,
                                          InterruptStep)
-from cloudrunner_server.core.message import (M, Ready, StdOut, StdErr,
+from cloudrunner_server.core.message import (Ready, StdOut, StdErr,
                                              FileExport, Finished, Events, Job,
                                              Term, JobTarget, SafeDictWrapper,
                                              PipeMessage, FinishedMessage,
                                              InitialMessage, SysMessage,
-                                             StatusCodes)
+                                             StatusCodes, GetBlob, Blob,
+                                             NodeResults)
 from cloudrunner.util.string import stringify
 from cloudrunner.util.string import stringify1
 
+from cloudrunner_server.plugins.transport.base import TARGET_SPLIT
 from cloudrunner_server.util import timestamp
+from cloudrunner_server.util.lru import LRUCache
 LOG = logging.getLogger('ServerSession')
 
+# Node output is merged in one PipeMessage for that long,
+# or until the buffer reaches the size
+OUTPUT_WINDOW = .1
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# Scripts from that size are sent by hash to nodes supporting blobs
+BLOB_MIN_SIZE = 4096
+# Node results are sent to the logger in chunks of that many nodes,
+# or after the window since the first pending result
+RESULT_CHUNK = 500
+RESULT_WINDOW = 1
 
-class JobSession(Thread):
+NODE_NAME = re.compile(r'^[\w\.\-]+$')
+
+
+def expected_nodes(target_str):
+    """
+    Returns the set of (lower case) node names, when the target
+    lists nodes by name only, or None for selectors and patterns
+    """
+    names = set()
+    for target in TARGET_SPLIT.split(target_str):
+        if not target:
+            continue
+        if not NODE_NAME.match(target):
+            return None
+        names.add(target.lower())
+    return names or None
+
+
+class JobSession(object):
 
     """
     Starts a session on the server, which is responsible for
-    communication with nodes and for processing and agregating results
+    communication with nodes and for processing and agregating results.
+    Sessions are driven by a SessionEngine loop:
+    start() -> resume(env) -> on_message(reply)* -> on_finish(env)
     """
 
     def __init__(self, manager, user, session_id, task_id, step_id, task,
-                 remote_user_map, env_in, env_out, timeout, parent,
+                 remote_user_map, timeout, parent,
                  stop_event=None, **kwargs):
-        super(JobSession, self).__init__()
         self.session_id = str(session_id)
         self.user = user
         self.step_id = step_id
@@ -62,8 +95,6 @@ class JobSession(Thread):
                         or self.manager.wait_timeout)
         if self.timeout:
             self.timeout = int(self.timeout)
-        self.env_in = env_in
-        self.env_out = env_out
         self.global_timeout = self.timeout
         self.parent = parent
         self.env = {}
@@ -71,7 +102,31 @@ class JobSession(Thread):
         self.restore = False
         self.user_org = (self.user, self.remote_user_map['org'])
         self.attachments = []
+        # Spool of the task queue for the exported files
+        self.spool = None
         self.start_at = kwargs.get('start_at', 0)
+        # Called with (env, file_exports) when the session is finished
+        self.on_finish = None
+        self.engine = None
+        self.started = False
+        self.finished = False
+        self.user_map = None
+        self.discovery_period = 0
+        self.total_wait = 0
+        # Nodes named in the target, None if not known in advance
+        self.expected = None
+        # Nodes, which replied but are not allowed to run the job
+        self.rejected = set()
+        self.stopping = False
+        # node -> [io, run_as, first ts, last ts, chunks, size]
+        self._output = {}
+        # (remote_user, by hash) -> packed Job body
+        self._jobs = {}
+        self._script_hash = None
+        # Results not sent to the logger yet, and the env merged so far
+        self._results = []
+        self._node_env = {}
+        self.summary = dict(nodes=0, failed=0, exit_code=0, total_time=0)
 
         if not is_script(self.task.body):
             # If lang not explicitly set - set from task.lang
@@ -87,7 +142,8 @@ class JobSession(Thread):
 
     def serialize(self):
         ser = dict(task=self.task, session_id=self.session_id,
-                   timeout=self.timeout, parent=self.parent,
+                   task_id=self.task_id, timeout=self.timeout,
+                   parent=self.parent,
                    task_name=self.task_name, user=self.user,
                    remote_user_map=self.remote_user_map,
                    node_map=self.node_map, start_at=self.start_at,
@@ -98,38 +154,140 @@ class JobSession(Thread):
     def _reply(self, message):
         seq = timestamp()
         message.seq_no = seq
-        self.job_done.send(message._)
+        self.engine.job_done.send(message._)
+
+    def _journal(self, *record):
+        if self.manager.journal:
+            self.manager.journal.record(*record)
+
+    def _pipe(self, session_id, ts, run_as, node, stdout, stderr,
+              last_ts=None):
+        message = PipeMessage(user=self.user,
+                              org=self.remote_user_map['org'],
+                              session_id=session_id, ts=ts,
+                              last_ts=last_ts or ts, run_as=run_as,
+                              node=node, stdout=stdout, stderr=stderr)
+        self._reply(message)
 
-    def run(self):
-        try:
-            self._run()
-        except Exception, ex:
-            LOG.exception(ex)
-            self.env_out.put((self.env, None))
+    def _buffer_output(self, node, run_as, io, output, ts):
+        buf = self._output.get(node)
+        if buf is not None and (buf[0] != io or buf[1] != run_as):
+            # Keep the order of stdout/stderr chunks
+            self._flush_output(node)
+            buf = None
+        if buf is None:
+            buf = self._output[node] = [io, run_as, ts, ts, [], 0]
+            self.engine.call_later(OUTPUT_WINDOW, self._flush_output,
+                                   node, buf)
+        buf[3] = ts
+        buf[4].append(output)
+        buf[5] += len(output)
+        if buf[5] >= OUTPUT_BUFFER_SIZE:
+            self._flush_output(node)
+
+    def _flush_output(self, node, buf=None):
+        current = self._output.get(node)
+        if current is None or (buf is not None and current is not buf):
+            # Already flushed
+            return
+        del self._output[node]
+        # Sent with the times of the first and the last chunk
+        io, run_as, ts, last_ts, chunks, _ = current
+        output = ''.join(chunks)
+        if io == 'O':
+            self._pipe(self.session_id, ts, run_as, node, output, '',
+                       last_ts)
+        else:
+            self._pipe(self.session_id, ts, run_as, node, '', output,
+                       last_ts)
+
+    @property
+    def script_hash(self):
+        if self._script_hash is None:
+            self._script_hash = sha1(self.request['script']).hexdigest()
+        return self._script_hash
+
+    def _job(self, remote_user, ident, caps):
+        # The Job body is packed once for all nodes with the same user,
+        # nodes supporting blobs get the script hash only
+        by_hash = 'blobs' in caps and \
+            len(self.request['script']) >= BLOB_MIN_SIZE
+        key = (remote_user, by_hash)
+        body = self._jobs.get(key)
+        if body is None:
+            request = self.request
+            if by_hash:
+                request = dict(request, script_hash=self.script_hash)
+                del request['script']
+            job_msg = Job(self.session_id, remote_user, request)
+            body = self._jobs[key] = msgpack.packb(job_msg.values())
+        # Same layout as M.pack(), with a per node header
+        return msgpack.packb(dict(ident=ident, dest=self.session_id)) + body
+
+    def _send_blob(self, job_rep):
+        if job_rep.hash != self.script_hash:
+            LOG.warn("Unknown blob %s requested by %s" % (
+                job_rep.hash, job_rep.hdr.peer))
+            return
+        blob = Blob(self.script_hash, self.request['script'])
+        blob.hdr.ident = job_rep.hdr.ident
+        blob.hdr.dest = self.session_id
+        self.engine.job_reply.send(blob._)
+
+    def start(self, engine):
+        self.engine = engine
+        self.manager.register_session(self.session_id, engine.queue_ident)
+        if self.restore:
+            self.started = True
+            if not self.start_at:
+                # Journaled without the start time
+                self.start_at = timestamp()
+            for name, node in self.node_map.items():
+                if node['status'] == StatusCodes.FINISHED:
+                    # Sent again, the logger skips the stored ones
+                    self._add_result(name, node)
+            self._listen()
+            return
 
-    def _execute(self):
         message = InitialMessage(session_id=self.session_id,
                                  ts=self._create_ts(),
                                  org=self.user_org[1],
                                  user=self.user_org[0])
         self._reply(message)
+        if self.global_timeout:
+            engine.call_later(self.global_timeout, self._env_timeout)
 
-        try:
-            env, self.file_exports = self.env_in.get(True, self.global_timeout)
-        except Empty:
-            _msg = "Timeout waiting for previous task to finish"
-            message = SysMessage(session_id=self.task_id,
-                                 ts=self._create_ts(),
-                                 org=self.user_org[1],
-                                 user=self.user_org[0],
-                                 stdout=_msg)
-            self._reply(message)
-            LOG.warn(_msg)
+    def _env_timeout(self):
+        if self.started:
             return
+        self.started = True
+        _msg = "Timeout waiting for previous task to finish"
+        message = SysMessage(session_id=self.task_id,
+                             ts=self._create_ts(),
+                             org=self.user_org[1],
+                             user=self.user_org[0],
+                             stdout=_msg)
+        self._reply(message)
+        LOG.warn(_msg)
+        self._finish()
 
-        if self.session_event.is_set():
+    def resume(self, env, file_exports=None):
+        # Previous task finished, start this one
+        if self.started or self.finished:
             return
+        self.started = True
+        self.file_exports = file_exports or {}
+        # Restored after a restart, for the elapsed time of the nodes
+        self.start_at = timestamp()
+        self._journal('start', self.session_id, self.start_at)
+        try:
+            if not self.session_event.is_set():
+                self._execute(env)
+        except Exception, ex:
+            LOG.exception(ex)
+        self._listen()
 
+    def _execute(self, env):
         self.env = env
         if not env:
             env = {}
@@ -195,98 +353,6 @@ class JobSession(Thread):
         except Exception, ex:
             LOG.exception(ex)
 
-    def _run(self):
-        self.manager.register_session(self.session_id)
-        self.job_done = self.manager.backend.publish_queue('logger')
-
-        if not self.restore:
-            self._execute()
-
-        result = {}
-        env = self.env or {}
-        msg_ret = []
-
-        try:
-            for _reply in self.read():
-                if _reply[0] == 'PIPE':
-                    # reply: 'PIPE', self.session_id, ts, run_as, node_id,
-                    # stdout, stderr
-                    names = ("session_id", "ts", "run_as", "node",
-                             "stdout", "stderr")
-                    message = PipeMessage(user=self.user,
-                                          org=self.remote_user_map['org'],
-                                          **dict(zip(names, _reply[1:])))
-                    self._reply(message)
-                else:
-                    self.session_id, msg_ret, file_exports = _reply
-                    break
-
-            new_env = {}
-            # [{'node': 'yoga', 'remote_user': '@', 'env': {},
-            # 'stderr': '', 'stdout': '', 'ret_code': 0}]
-
-            for _ret in msg_ret:
-                _env = _ret.pop('env', {})
-                _stdout = _ret.get('stdout', '')
-                _stderr = _ret.pop('stderr', '')
-                _node = _ret.pop('node')
-
-                if _stdout or _stderr:
-                    ts = self._create_ts()
-                    message = PipeMessage(user=self.user,
-                                          org=self.remote_user_map['org'],
-                                          ts=ts,
-                                          session_id=self.session_id,
-                                          run_as=_ret.get('run_as'),
-                                          node=_node,
-                                          stdout=_stdout,
-                                          stderr=_stderr)
-                    self._reply(message)
-
-                result[_node] = _ret
-                for k, v in _env.items():
-                    if k in new_env:
-                        if not isinstance(new_env[k], list):
-                            new_env[k] = [new_env[k]]
-                        if isinstance(v, list):
-                            new_env[k].extend(list(stringify(*v)))
-                        else:
-                            new_env[k].append(stringify1(v))
-                    else:
-                        new_env[k] = v
-
-            env.update(new_env)
-            if self.task.post_conditions:
-                for condition in self.task.post_conditions:
-                    try:
-                        pass
-                    except InterruptStep:
-                        LOG.warn("BEFORE: Step execution interrupted by %s" %
-                                 condition)
-                        raise
-                    except InterruptExecution:
-                        LOG.warn(
-                            "BEFORE: Session execution interrupted by %s" %
-                            condition)
-                        raise
-        except Exception, ex:
-            LOG.exception(ex)
-        finally:
-            time.sleep(.5)
-            ts = self._create_ts()
-            message = FinishedMessage(ts=ts,
-                                      session_id=self.session_id,
-                                      user=self.user,
-                                      org=self.remote_user_map['org'],
-                                      result=result,
-                                      env=env)
-            self._reply(message)
-            self.env_out.put((env, self.file_exports))
-
-        # Wait for all other threads to finish consuming session data
-        time.sleep(.5)
-        self.job_done.close()
-
     def run_script(self, targets):
         """
         Send request to nodes
@@ -314,214 +380,309 @@ class JobSession(Thread):
 
         remote_user_map = self.request.pop('remote_user_map')
 
-        target = JobTarget(self.session_id, str(" ".join(targets)))
+        target_str = str(" ".join(targets))
+        nodes = self.manager.resolve_targets(remote_user_map['org'],
+                                             target_str)
+        if not nodes:
+            # Selectors or no live match, matched by the nodes.
+            # An empty match must not finish the session right away
+            self.expected = expected_nodes(target_str)
+            target = JobTarget(self.session_id, target_str)
+        else:
+            # Published to the matching nodes only
+            self.expected = set(node.lower() for node in nodes)
+            target = JobTarget(self.session_id, target_str,
+                               nodes=sorted(nodes))
         target.hdr.org = remote_user_map['org']
-        self.start_at = timestamp()
         self.manager.publisher.send(target._)
 
-    def read(self):
-        job_event = Event()
-        user_map = UserMap(self.remote_user_map['roles'], self.user)
-        node_map = self.node_map
+    def _listen(self):
+        # Wait for node replies
+        self.user_map = UserMap(self.remote_user_map['roles'], self.user)
+        now = time.time()
+        self.discovery_period = now + self.manager.discovery_timeout
+        self.total_wait = now + (self.timeout or self.manager.wait_timeout)
+        if self.expected is None:
+            self.engine.call_later(self.manager.discovery_timeout, self.check)
+        else:
+            # Finish early, if no node is left to reply
+            self.engine.call_later(
+                min(1, self.manager.discovery_timeout), self.check)
+
+    def _pending(self):
+        # Nodes are counted in the summary as they finish
+        return self.summary['nodes'] < len(self.node_map)
+
+    def _complete(self):
+        # All nodes finished and no more nodes are expected to reply
+        if self._pending():
+            return False
+        if time.time() > self.discovery_period:
+            return True
+        if self.expected is None:
+            return False
+        replied = set(n.lower() for n in self.node_map) | self.rejected
+        return self.expected <= replied
+
+    def check(self):
+        # Runs every second while the session is active
+        if self.finished:
+            return
+        if self.session_event.is_set():
+            self._stop()
+            return
+        now = time.time()
+        if self._complete():
+            self._finish()
+            return
+        if now > self.total_wait:
+            _msg = 'Timeout waiting for response from nodes'
+            LOG.warn(_msg)
+            message = SysMessage(session_id=self.task_id,
+                                 ts=self._create_ts(),
+                                 org=self.user_org[1],
+                                 user=self.user_org[0],
+                                 stdout=_msg)
+            self._reply(message)
 
-        job_reply = self.manager.backend.publish_queue('out_messages')
-        job_queue = self.manager.backend.consume_queue('in_messages',
-                                                       ident=self.session_id)
-        user_input_queue = self.manager.backend.consume_queue(
-            'user_input',
-            ident=self.session_id)
+            for node in self.node_map.values():
+                if node['status'] != StatusCodes.FINISHED:
+                    node['data']['stderr'] = \
+                        node['data'].setdefault('stderr', '') + \
+                        'Timeout waiting response from node'
+            LOG.debug(self.node_map)
+            self._stop()
+            return
+        self.engine.call_later(1, self.check)
 
-        poller = self.manager.backend.create_poller(job_queue,
-                                                    user_input_queue)
-        discovery_period = time.time() + self.manager.discovery_timeout
-        total_wait = time.time() + (self.timeout or self.manager.wait_timeout)
+    def on_message(self, job_rep):
+        if self.finished or not self.started:
+            return
+        # Assert we have rep from the same organization
+        if job_rep.hdr.org != self.remote_user_map['org']:
+            return
 
-        try:
-            while not self.session_event.is_set() and not job_event.is_set():
-                ready = poller.poll()
-
-                if user_input_queue in ready:
-                    frames = user_input_queue.recv()
-
-                    # input from user -> node
-                    """
-                    input_req = JobInput.build(*frames)
-                    if not input_req:
-                        LOG.warn("Invalid request %s" % frames)
-                        continue
-
-                    for node, data in node_map.items():
-                        if input_req.cmd == 'INPUT' and \
-                            (input_req.targets == '*' or
-                                node in input_req.targets):
-                            job_reply.send(
-                                R(data['router_id'],
-                                  Input.build(self.session_id,
-                                              input_req.cmd,
-                                              input_req.data)._)._)
-                    """
-                    continue
-
-                frames = None
-                if job_queue in ready:
-                    frames = job_queue.recv()
-
-                if not frames:
-                    if time.time() > discovery_period:
-                        # Discovery period ended, check for results
-                        if not any([n['status'] in StatusCodes.pending()
-                                    for n in node_map.values()]):
-                            break
-
-                    if time.time() > total_wait:
-                        _msg = 'Timeout waiting for response from nodes'
-                        LOG.warn(_msg)
-                        message = SysMessage(session_id=self.task_id,
-                                             ts=self._create_ts(),
-                                             org=self.user_org[1],
-                                             user=self.user_org[0],
-                                             stdout=_msg)
-                        self._reply(message)
-
-                        for node in node_map.values():
-                            if node['status'] != StatusCodes.FINISHED:
-                                node['data']['stderr'] = \
-                                    node['data'].setdefault('stderr',
-                                                            '') + \
-                                    'Timeout waiting response from node'
-                        LOG.debug(node_map)
-                        job_event.set()
-                        break
-
-                    continue
-
-                job_rep = M.build(frames[0])
-                if not job_rep:
-                    LOG.error("Invalid reply from node: %s" % frames)
-                    continue
-
-                # Assert we have rep from the same organization
-                if job_rep.hdr.org != self.remote_user_map['org']:
-                    continue
-
-                state = node_map.setdefault(
-                    job_rep.hdr.peer, dict(status=StatusCodes.STARTED,
-                                           data={},
-                                           stdout='',
-                                           stderr=''))
+        node_map = self.node_map
+        state = node_map.setdefault(
+            job_rep.hdr.peer, dict(status=StatusCodes.STARTED,
+                                   data={},
+                                   stdout='',
+                                   stderr=''))
 
-                ts = self._create_ts()
-                node_map[job_rep.hdr.peer]['router_id'] = job_rep.hdr.ident
-                if isinstance(job_rep, Ready):
-                    remote_user = user_map.select(job_rep.hdr.peer)
-                    if not remote_user:
-                        LOG.info("Node %s not allowed for user %s" % (
-                            job_rep.hdr.peer,
-                            self.user))
-                        node_map.pop(job_rep.hdr.peer)
-                        continue
-                    if job_rep.hdr.peer.lower() in self.disabled_nodes:
-                        LOG.info("Node %s is disabled" % job_rep.hdr.peer)
-                        node_map.pop(job_rep.hdr.peer)
-                        continue
-                    # Send task to attached node
-                    node_map[job_rep.hdr.peer]['remote_user'] = remote_user
-                    _msg = "Sending job to %s" % job_rep.hdr.peer
-                    LOG.info(_msg)
-                    message = SysMessage(session_id=self.task_id,
-                                         ts=self._create_ts(),
-                                         org=self.user_org[1],
-                                         user=self.user_org[0],
-                                         stdout=_msg)
-
-                    job_msg = Job(self.session_id, remote_user, self.request)
-                    job_msg.hdr.ident = job_rep.hdr.ident
-                    job_msg.hdr.dest = self.session_id
-                    job_reply.send(job_msg._)
-                    continue
-
-                state['status'] = job_rep.control
-                if isinstance(job_rep, Finished):
-                    state['data']['elapsed'] = int(timestamp() - self.start_at)
-                    state['data']['ret_code'] = job_rep.result['ret_code']
-                    state['data']['env'] = job_rep.result['env']
-                    if job_rep.result['stdout'] or job_rep.result['stderr']:
-                        yield ('PIPE', self.session_id, ts,
-                               job_rep.run_as,
-                               job_rep.hdr.peer,
-                               job_rep.result['stdout'],
-                               job_rep.result['stderr'])
-                elif isinstance(job_rep, StdOut):
-                    yield ('PIPE', self.session_id, ts,
-                           job_rep.run_as,
-                           job_rep.hdr.peer,
-                           job_rep.output, '')
-                elif isinstance(job_rep, StdErr):
-                    yield ('PIPE', self.session_id, ts,
+        ts = self._create_ts()
+        node_map[job_rep.hdr.peer]['router_id'] = job_rep.hdr.ident
+        if isinstance(job_rep, Ready):
+            remote_user = self.user_map.select(job_rep.hdr.peer)
+            if not remote_user:
+                LOG.info("Node %s not allowed for user %s" % (
+                    job_rep.hdr.peer,
+                    self.user))
+                node_map.pop(job_rep.hdr.peer)
+                self._rejected(job_rep.hdr.peer)
+                return
+            if job_rep.hdr.peer.lower() in self.disabled_nodes:
+                LOG.info("Node %s is disabled" % job_rep.hdr.peer)
+                node_map.pop(job_rep.hdr.peer)
+                self._rejected(job_rep.hdr.peer)
+                return
+            # Send task to attached node
+            node_map[job_rep.hdr.peer]['remote_user'] = remote_user
+            LOG.info("Sending job to %s" % job_rep.hdr.peer)
+
+            self.engine.job_reply.send(
+                self._job(remote_user, job_rep.hdr.ident,
+                          getattr(job_rep, 'caps', None) or ()))
+            self._journal('node', self.session_id, job_rep.hdr.peer, state)
+            return
+        if isinstance(job_rep, GetBlob):
+            self._send_blob(job_rep)
+            return
+
+        state['status'] = job_rep.control
+        if isinstance(job_rep, Finished):
+            self._flush_output(job_rep.hdr.peer)
+            state['data']['elapsed'] = int(timestamp() - self.start_at)
+            state['data']['ret_code'] = job_rep.result['ret_code']
+            state['data']['env'] = job_rep.result['env']
+            self._journal('node', self.session_id, job_rep.hdr.peer, state)
+            self._add_result(job_rep.hdr.peer, state)
+            if job_rep.result['stdout'] or job_rep.result['stderr']:
+                self._pipe(self.session_id, ts,
                            job_rep.run_as,
                            job_rep.hdr.peer,
-                           '', job_rep.output)
-                elif isinstance(job_rep, FileExport):
-                    file_name = '%s_%s' % (job_rep.hdr.peer, job_rep.file_name)
-                    self.file_exports[file_name] = job_rep.content
-                elif isinstance(job_rep, Events):
-                    LOG.info("Polling events for %s" % self.session_id)
-                # else:
-                #    job_reply.send(job_rep.ident, job_rep.peer,
-                #    self.session_id,'UNKNOWN')
-
-                LOG.debug('Resp[%s]:: [%s][%s]' % (self.session_id,
-                                                   job_rep.hdr.peer,
-                                                   job_rep.control))
-        except ConnectionError:
-            # Transport died
-            self.session_event.set()
+                           job_rep.result['stdout'],
+                           job_rep.result['stderr'])
+            if self.stopping and not self._pending():
+                self._finish()
+            elif self._complete():
+                self._finish()
+        elif isinstance(job_rep, StdOut):
+            self._buffer_output(job_rep.hdr.peer, job_rep.run_as, 'O',
+                                job_rep.output, ts)
+        elif isinstance(job_rep, StdErr):
+            self._buffer_output(job_rep.hdr.peer, job_rep.run_as, 'E',
+                                job_rep.output, ts)
+        elif isinstance(job_rep, FileExport):
+            file_name = '%s_%s' % (job_rep.hdr.peer, job_rep.file_name)
+            if self.spool:
+                # Next steps get the path of the spooled file
+                self.file_exports[file_name] = self.spool.write(
+                    file_name, job_rep.content)
+            else:
+                self.file_exports[file_name] = job_rep.content
+        elif isinstance(job_rep, Events):
+            LOG.info("Polling events for %s" % self.session_id)
+
+        LOG.debug('Resp[%s]:: [%s][%s]' % (self.session_id,
+                                           job_rep.hdr.peer,
+                                           job_rep.control))
+
+    def _rejected(self, node):
+        self.rejected.add(node.lower())
+        if self._complete():
+            self._finish()
+
+    def _stop(self):
+        # Forced stop ?
+        # ToDo: check arg flag to keep task running
+        if self.finished or self.stopping:
+            return
+        self.stopping = True
+        if not self._pending():
+            self._finish(True)
+            return
+        for name, node in self.node_map.items():
+            try:
+                job_msg = Term(self.session_id, self.stop_reason)
+                job_msg.hdr.ident = node['router_id']
+                job_msg.hdr.dest = self.session_id
+                self.engine.job_reply.send(job_msg._)
+            except:
+                continue
+
+        # Finish when the nodes report back, or force after 1 sec
+        self.engine.call_later(1, self._finish, True)
+
+    def _finish(self, forced=False):
+        if self.finished:
+            return
+        self.finished = True
+        for node in self._output.keys():
+            self._flush_output(node)
+        node_map = self.node_map
+        if forced:
+            for name, node in node_map.items():
+                if node['status'] != StatusCodes.FINISHED:
+                    node['status'] = StatusCodes.FINISHED
+                    node['stderr'] = \
+                        node['data'].setdefault('stderr', '') + \
+                        '\nJob execution stopped: [%s]' % self.stop_reason
+
+                    ts = self._create_ts()
+                    self._pipe(self.session_id, ts, '', name,
+                               node['stdout'], node['stderr'])
+        self.manager.delete_session(self.session_id)
+
+        for name, node in node_map.items():
+            # Forced, or finished before a restart
+            self._add_result(name, node)
+        self._flush_results()
+        env = self.env or {}
+        try:
+            self._collect(env)
         except Exception, ex:
             LOG.exception(ex)
-        finally:
-            # LOG.warning(node_map)
-            if self.session_event.is_set() or job_event.is_set():
-                # Forced stop ?
-                # ToDo: check arg flag to keep task running
-                for name, node in node_map.items():
-                    try:
-                        job_msg = Term(self.session_id, self.stop_reason)
-                        job_msg.hdr.ident = node['router_id']
-                        job_msg.hdr.dest = self.session_id
-                        job_reply.send(job_msg._)
-                    except:
-                        continue
-
-                # Wait for jobs to finalize
-                job_event.wait(1)
-                for name, node in node_map.items():
-                    if node['status'] != StatusCodes.FINISHED:
-                        node['status'] = StatusCodes.FINISHED
-                        node['stderr'] = \
-                            node['data'].setdefault('stderr', '') + \
-                            '\nJob execution stopped: [%s]' % self.stop_reason
-
-                        ts = self._create_ts()
-                        yield ('PIPE', self.session_id, ts, '', name,
-                               node['stdout'], node['stderr'])
+        # No wait for the output sent above: the messages of a session
+        # leave on the engine's logger socket in order, are read by one
+        # logger thread and logged by the LogPartitions thread of the
+        # session, so the FinishedMessage is logged after them
+        self._finished(dict(self.summary), env)
+
+    def _add_result(self, node, state):
+        if state.get('reported'):
+            return
+        state['reported'] = True
+        data = state['data']
+        ret_code = data.get('ret_code', -255)
+        elapsed = data.get('elapsed', 0)
+        summary = self.summary
+        summary['nodes'] += 1
+        if str(ret_code) != '0':
+            summary['failed'] += 1
+            summary['exit_code'] = 1
+        summary['total_time'] = max(summary['total_time'], elapsed)
+        # Only the merged env is kept, the journal has the node env
+        self._merge_env(data.pop('env', None) or {})
+
+        if not self._results:
+            self.engine.call_later(RESULT_WINDOW, self._flush_results)
+        self._results.append(dict(node=node,
+                                  remote_user=state.get('remote_user'),
+                                  ret_code=ret_code, elapsed=elapsed))
+        if len(self._results) >= RESULT_CHUNK:
+            self._flush_results()
+
+    def _flush_results(self):
+        if not self._results:
+            return
+        message = NodeResults(ts=self._create_ts(),
+                              session_id=self.session_id,
+                              user=self.user,
+                              org=self.remote_user_map['org'],
+                              results=self._results)
+        self._results = []
+        self._reply(message)
 
-            job_event.set()
+    def _merge_env(self, _env):
+        new_env = self._node_env
+        for k, v in _env.items():
+            if k in new_env:
+                if not isinstance(new_env[k], list):
+                    new_env[k] = [new_env[k]]
+                if isinstance(v, list):
+                    new_env[k].extend(list(stringify(*v)))
+                else:
+                    new_env[k].append(stringify1(v))
+            else:
+                new_env[k] = v
 
-        user_input_queue.close()
-        job_queue.close()
-        job_reply.close()
-        self.manager.delete_session(self.session_id)
+    def _collect(self, env):
+        for name, node in self.node_map.items():
+            _stdout = node['data'].get('stdout', '')
+            _stderr = node['data'].get('stderr', '')
+            if _stdout or _stderr:
+                ts = self._create_ts()
+                self._pipe(self.session_id, ts, None, name,
+                           _stdout, _stderr)
 
-        yield (self.session_id,
-               [dict(node=k,
-                     remote_user=n['remote_user'],
-                     env=n['data'].get('env', {}),
-                     stdout=n['data'].get('stdout', ''),
-                     stderr=n['data'].get('stderr', ''),
-                     elapsed=n['data'].get('elapsed', 0),
-                     ret_code=n['data'].get('ret_code', -255))
-                for k, n in node_map.items()],
-               self.file_exports)
+        env.update(self._node_env)
+        if self.task.post_conditions:
+            for condition in self.task.post_conditions:
+                try:
+                    pass
+                except InterruptStep:
+                    LOG.warn("BEFORE: Step execution interrupted by %s" %
+                             condition)
+                    raise
+                except InterruptExecution:
+                    LOG.warn(
+                        "BEFORE: Session execution interrupted by %s" %
+                        condition)
+                    raise
+
+    def _finished(self, result, env):
+        ts = self._create_ts()
+        message = FinishedMessage(ts=ts,
+                                  session_id=self.session_id,
+                                  user=self.user,
+                                  org=self.remote_user_map['org'],
+                                  result=result,
+                                  env=env)
+        self._reply(message)
+        self._journal('end', self.session_id, env)
+        self.engine.remove(self.session_id)
+        if self.on_finish:
+            self.on_finish(env, self.file_exports)
 
     def _create_ts(self):
         ts = timestamp()
@@ -530,30 +691,100 @@ class JobSession(Thread):
         return ts
 
 
+class RoleMatcher(object):
+
+    """
+    Role rules of a role map {node pattern: remote user}, compiled once
+    and shared by the sessions with the same map.
+    Rules are tried from the longest pattern, ties ordered by pattern,
+    the first one matching the node name gives the remote user, '*' is
+    the default. Before, the order was the dict order of the remote
+    users.
+    Patterns without groups and flags are matched in one alternation.
+    re tries the branches from left to right, so the first match is
+    the same as trying the rules one by one.
+    """
+
+    # re supports up to 100 groups in a pattern
+    GROUP_SIZE = 90
+    CACHE_SIZE = 256
+
+    # role map items -> RoleMatcher, the least recently used is dropped
+    _cache = LRUCache(CACHE_SIZE)
+
+    @classmethod
+    def get(cls, role_map):
+        key = tuple(sorted(role_map.items()))
+        matcher = cls._cache.get(key)
+        if matcher is None:
+            matcher = cls(role_map)
+            cls._cache.set(key, matcher)
+        return matcher
+
+    def __init__(self, role_map):
+        self.default = role_map.get('*') or None
+        rules = []
+        for pattern, role in role_map.items():
+            if pattern == '*':
+                continue
+            try:
+                rules.append((pattern, role, re.compile(pattern)))
+            except re.error:
+                LOG.warn("Invalid role pattern: %s" % pattern)
+        rules.sort(key=lambda rule: (-len(rule[0]), rule[0]))
+
+        # [(regex, roles, combined)]
+        self.segments = []
+        batch = []
+        for pattern, role, regex in rules:
+            if regex.groups or '(?' in pattern:
+                # Own groups would shift the group numbers
+                self._combine(batch)
+                batch = []
+                self.segments.append((regex, [role], False))
+                continue
+            batch.append((pattern, role))
+            if len(batch) == self.GROUP_SIZE:
+                self._combine(batch)
+                batch = []
+        self._combine(batch)
+
+    def _combine(self, batch):
+        if not batch:
+            return
+        try:
+            regex = re.compile('|'.join('(%s)' % pattern
+                                        for pattern, _ in batch))
+        except re.error:
+            for pattern, role in batch:
+                self.segments.append((re.compile(pattern), [role], False))
+            return
+        self.segments.append((regex, [role for _, role in batch], True))
+
+    def match(self, node):
+        for regex, roles, combined in self.segments:
+            m = regex.match(node)
+            if m:
+                if combined:
+                    return roles[m.lastindex - 1]
+                return roles[0]
+        return self.default
+
+
 class UserMap(object):
 
     def __init__(self, role_map, user):
-        self.rules = {}
-        self.default = None
+        self.matcher = RoleMatcher.get(role_map)
         self.user = user
-        for k, v in role_map.items():
-            if k == '*':
-                self.default = v
-            else:
-                try:
-                    self.rules[v] = re.compile(k)
-                except:
-                    pass
+        # node -> remote user, for the nodes seen by the session
+        self.selected = {}
 
     def select(self, node):
-        for role, rule in self.rules.items():
-            if rule.match(node):
-                LOG.info("Rule %s applied for user %s" % (node, self.user))
-                return role
-
-        if self.default:
-            LOG.info("Default rule for %s applied for user %s" % (node,
-                                                                  self.user))
-            return self.default
-
-        return None
+        try:
+            return self.selected[node]
+        except KeyError:
+            pass
+        role = self.selected[node] = self.matcher.match(node)
+        LOG.debug("Role %s selected for %s, user %s" % (role, node,
+                                                        self.user))
+        return role
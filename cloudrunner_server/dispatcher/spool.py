@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import logging
+import os
+import re
+import shutil
+
+LOG = logging.getLogger('Spool')
+
+SAFE_NAME = re.compile(r'[^\w\.\-]')
+
+
+class Spool(object):
+
+    """
+    On disk store for the files exported by the nodes during a task
+    queue. Sessions pass file references to the next step, the
+    directory is removed when the queue is finished.
+    """
+
+    def __init__(self, root, task_id):
+        self.path = os.path.join(root, SAFE_NAME.sub('_', str(task_id)))
+        # name -> path
+        self.files = {}
+
+    def _file_path(self, name):
+        # Prefixed, as different names can map to the same safe name
+        return os.path.join(self.path, '%s_%s' % (
+            len(self.files), SAFE_NAME.sub('_', name)))
+
+    def write(self, name, content):
+        """
+        Writes a chunk of the export `name`, the first chunk creates
+        the file, the next ones are appended. Returns the file path
+        """
+        path = self.files.get(name)
+        if path is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            path = self.files[name] = self._file_path(name)
+            mode = 'wb'
+        else:
+            mode = 'ab'
+        with open(path, mode) as export:
+            export.write(content)
+        return path
+
+    def cleanup(self):
+        self.files.clear()
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from mock import Mock, patch
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+import sqlite3
+import time
+
+from cloudrunner.core.exceptions import ConnectionError
+from cloudrunner_server.api.model import (ApiKey, Node, Org, UsageTier,
+                                          User)
+from cloudrunner_server.core.message import M, Register
+from cloudrunner_server.dispatcher import admin
+from cloudrunner_server.tests import base
+
+
+class Queue(object):
+
+    def __init__(self, requests, expected):
+        self.requests = list(requests)
+        self.expected = expected
+        self.sent = []
+
+    def recv(self, timeout):
+        if self.requests:
+            return [self.requests.pop(0)._]
+        if len(self.sent) >= self.expected:
+            raise ConnectionError()
+        time.sleep(timeout / 1000.)
+
+    def send(self, packed):
+        self.sent.append(packed)
+
+    def close(self):
+        pass
+
+
+def register(node, csr='CSR', ident=None):
+    req = Register(node, csr)
+    req.hdr.ident = ident or 'ident-%s' % node
+    return req
+
+
+class TestAdmin(base.BaseTestCase):
+
+    def setUp(self):
+        self.patcher = patch.object(admin, 'CertController')
+        self.patcher.start()
+        config = Mock(db='sqlite://', register_workers=4)
+        self.admin = admin.Admin(config, Mock())
+        # Savepoints need the transactions handled by SQLAlchemy
+        self.admin.set_context_from_config(
+            recreate=True, poolclass=StaticPool,
+            creator=lambda: sqlite3.connect(':memory:', isolation_level=None,
+                                            check_same_thread=False))
+        for name in ('begin', 'commit', 'rollback'):
+            event.listen(self.admin.db.bind, name,
+                         lambda conn, stmt=name.upper(): conn.execute(stmt))
+
+        tier = UsageTier(name="Free", title="Free", nodes=3, users=1,
+                         api_keys=1)
+        org = Org(name='org1', enabled=True, tier=tier)
+        user = User(username='user1', email='user1@org1', org=org)
+        self.admin.db.add(ApiKey(value='key1', user=user, enabled=True))
+        self.admin.db.commit()
+        admin.ApiKeyVerifier.keys.clear()
+
+        ccont = self.admin.ccont
+        ccont.validate_request.side_effect = lambda node, csr: (
+            True, node, 'org1', ['tag1'])
+        ccont.sign_node.side_effect = lambda node, **kw: ([], 'crt')
+        ccont.build_cert_chain.side_effect = lambda node, org, csr: (
+            True, 'chain-%s' % node)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _run(self, requests, expected):
+        queue = Queue(requests, expected)
+        self.admin.backend.consume_queue.return_value = queue
+        self.admin.backend.publish_queue.return_value = queue
+        self.admin.run()
+        replies = []
+        for packed in queue.sent:
+            rep = M.build(packed)
+            replies.append((rep.hdr.ident, rep.status, rep.message))
+        return sorted(replies)
+
+    def test_register(self):
+        replies = self._run([register('node1'), register('node2')], 2)
+        self.assertEqual(replies,
+                         [('ident-node1', 'APPROVED', 'chain-node1'),
+                          ('ident-node2', 'APPROVED', 'chain-node2')])
+        nodes = self.admin.db.query(Node).order_by(Node.name).all()
+        self.assertEqual([(n.name, n.approved) for n in nodes],
+                         [('node1', True), ('node2', True)])
+        self.assertEqual([t.value for t in nodes[0].tags], ['tag1'])
+
+    def test_quota(self):
+        replies = self._run([register('node%s' % i) for i in range(5)], 5)
+        statuses = [status for _, status, _ in replies]
+        # The other writes in the batch are committed
+        self.assertEqual(sorted(statuses), ['APPROVED'] * 3 +
+                         ['REJECTED'] * 2)
+        self.assertEqual([m for _, _, m in replies].count('QUOTA_FAIL'), 2)
+        self.assertEqual(self.admin.db.query(Node).count(), 3)
+        self.assertEqual(self.admin.ccont.revoke.call_count, 2)
+
+    def test_sign_failure(self):
+        self.admin.ccont.sign_node.side_effect = lambda node, **kw: (
+            [], None if node == 'node2' else 'crt')
+        replies = self._run([register('node1'), register('node2')], 2)
+        self.assertEqual(replies,
+                         [('ident-node1', 'APPROVED', 'chain-node1'),
+                          ('ident-node2', 'REJECTED', 'APPR_FAIL')])
+        self.assertEqual([n.name for n in self.admin.db.query(Node)],
+                         ['node1'])
+
+    def test_repeated_requests(self):
+        validate = self.admin.ccont.validate_request
+        validated = validate.side_effect
+
+        def slow_validate(node, csr):
+            time.sleep(.1)
+            return validated(node, csr)
+        validate.side_effect = slow_validate
+
+        replies = self._run([register('node1'),
+                             register('node1', ident='ident-2'),
+                             register('node1'),
+                             register('node1', csr='OTHER', ident='ident-3')],
+                            3)
+        self.assertEqual(replies,
+                         [('ident-2', 'APPROVED', 'chain-node1'),
+                          ('ident-3', 'REJECTED', 'PENDING'),
+                          ('ident-node1', 'APPROVED', 'chain-node1')])
+        self.assertEqual(validate.call_count, 1)
+
+    def test_api_key_cache(self):
+        verifier = admin.ApiKeyVerifier(None)
+        self.assertEqual(verifier.verify('node1', Mock(OU='key1')), 'org1')
+        self.assertIsNone(verifier.verify('node1', Mock(OU='key2')))
+        self.assertEqual(admin.ApiKeyVerifier.keys.keys(), ['key1'])
+
+        key = self.admin.db.query(ApiKey).one()
+        self.assertIsNone(key.last_used)
+        key.enabled = False
+        self.admin.db.commit()
+        # Served from the cache until the next flush
+        self.assertEqual(verifier.verify('node2', Mock(OU='key1')), 'org1')
+
+        admin.ApiKeyVerifier.flush()
+        self.admin.db.commit()
+        self.assertIsNotNone(self.admin.db.query(ApiKey.last_used).scalar())
+        self.assertEqual(len(admin.ApiKeyVerifier.keys), 0)
+        self.assertIsNone(verifier.verify('node3', Mock(OU='key1')))
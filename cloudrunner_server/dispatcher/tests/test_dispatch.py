@@ -12,14 +12,23 @@
 #  * without the express permission of CloudRunner.io
 #  *******************************************************/
 
-from contextlib import nested
 from mock import call, Mock, patch
 
+from cloudrunner_server.core.message import (Blob, Finished, GetBlob, Job,
+                                             JobTarget, Ready, StdErr, StdOut)
 from cloudrunner_server.tests import base
 
 SESSION = "1234-5678-9012"
 
 
+def reply(msg, peer, org='DEFAULT'):
+    msg.hdr.peer = peer
+    msg.hdr.org = org
+    msg.hdr.ident = 'ident-%s' % peer
+    msg.hdr.dest = SESSION
+    return msg
+
+
 class TestDispatch(base.BaseTestCase):
 
     def test_session(self):
@@ -27,99 +36,358 @@ class TestDispatch(base.BaseTestCase):
         class Ctx(object):
 
             def __init__(self):
-                self.plugins_ctx = Mock()
-                self.plugins_ctx.args_plugins = Mock()
-                self.plugins_ctx.args_plugins.parse_known_args = Mock(
-                    return_value=([], []))
-                self.plugins_ctx.job_plugins = []
-                self.plugins_ctx.lib_plugins = []
-                self.job_done_uri = "job_done"
-                self.context = Mock()
-
                 self.discovery_timeout = 120
                 self.wait_timeout = 120
-                self.subscriptions = {SESSION: []}
                 self.sessions = {SESSION: []}
-                self.transport = Mock()
-                job = Mock()
-                job.receive = Mock(side_effect=[("READY",)])
-                self.transport.create_job = Mock(return_value=job)
                 self.backend = Mock()
 
                 self.config = Mock()
                 self.publisher = Mock()
                 self.register_session = Mock()
+                self.delete_session = Mock()
+                self.resolve_targets = Mock(return_value=None)
+                self.journal = None
 
-        remote_user_map = {'org': 'DEFAULT', 'roles': {'*': '@'}}
+        remote_user_map = {'org': 'DEFAULT', 'roles': {'*': 'root'}}
 
         ctx = Ctx()
-
-        class PluginCtx(object):
-
-            def __init__(self):
-                self.args_plugins = []
-                self.lib_plugins = []
-                self.job_plugins = []
+        engine = Mock(queue_ident='engine-1')
 
         env = {'NEXT_NODE': ['host2', 'host9']}
-        queue = Mock(return_value=Mock(get=lambda *args: [env, None]))
         task_id = 101
         step_id = 0
         from cloudrunner_server.dispatcher.session import JobSession
         session = JobSession(
             ctx, 'user', SESSION, task_id, step_id,
             {'target': '*', 'body': "\ntest_1\nexport NEXT_NODE='host2'\n\n"},
-            remote_user_map, queue(), queue(), None, None)
+            remote_user_map, None, None)
 
         session._reply = Mock()
         session._create_ts = Mock(return_value=123456789.101)
-        ret_data1 = [
-            ['PIPE', 'JOB_ID', 123456789.101, 'admin',
-                'NODE1', '["STDOUT", "BLA"]'],
-            [
-                'JOB_ID', [{'node': "NODE1",
-                            'remote_user': 'root',
-                            'ret_code': 1,
-                            'env': {'NEXT_NODE': "host2"}},
-                           {'node': "NODE6",
-                            'remote_user': 'root',
-                            'ret_code': 1,
-                            'env': {'NEXT_NODE': "host9"}}],
-                []
-            ]
+        on_finish = session.on_finish = Mock()
+
+        session.start(engine)
+        self.assertEqual(
+            ctx.register_session.call_args_list,
+            [call("1234-5678-9012", 'engine-1')])
+        session.resume(env, None)
+        self.assertEqual(ctx.publisher.send.call_count, 1)
+
+        session.on_message(reply(Ready(SESSION), 'NODE1'))
+        session.on_message(reply(Ready(SESSION), 'NODE6'))
+        # Job is sent to each node
+        self.assertEqual(engine.job_reply.send.call_count, 2)
+
+        session.on_message(reply(StdOut(SESSION, SESSION, 'admin',
+                                        '["STDOUT", "BLA"]'), 'NODE1'))
+        # Other orgs are ignored
+        session.on_message(reply(StdOut(SESSION, SESSION, 'admin',
+                                        'OTHER'), 'NODE1', org='ORG2'))
+        for node, value in (('NODE1', 'host2'), ('NODE6', 'host9')):
+            session.on_message(reply(Finished(
+                SESSION, SESSION, 'root',
+                dict(ret_code=1, env={'NEXT_NODE': value},
+                     stdout='', stderr='')), node))
+
+        # Still in discovery period
+        self.assertFalse(session.finished)
+        session.discovery_period = 0
+        session.check()
+        self.assertTrue(session.finished)
+        ctx.delete_session.assert_called_once_with(SESSION)
+
+        expected = [
+            {'hdr': {}, 'ts': 123456789.101, 'session_id': '1234-5678-9012',  # noqa
+            'kw': ['org', 'user', 'session_id', 'ts'], 'user': 'user', 'org': 'DEFAULT'},  # noqa
+            {'hdr': {}, 'stdout': '-- Starting task #1',
+                'ts': 123456789.101, 'session_id': 101,
+                'kw': ['org', 'stdout', 'user', 'session_id', 'ts'], 'user': 'user', 'org': 'DEFAULT'},  # noqa
+            {'node': 'NODE1', 'hdr': {}, 'stdout': '["STDOUT", "BLA"]', 'run_as': 'admin',  # noqa
+                'ts': 123456789.101, 'last_ts': 123456789.101,
+                'session_id': SESSION, 'stderr': '',
+                'kw': ['node', 'stdout', 'run_as', 'stderr', 'ts', 'last_ts', 'session_id', 'user', 'org'], 'user': 'user', 'org': 'DEFAULT'},  # noqa
+            {'hdr': {}, 'ts': 123456789.101, 'session_id': SESSION,
+                'kw': ['ts', 'session_id', 'user', 'org', 'results'],
+                'user': 'user', 'org': 'DEFAULT', 'results': [
+                {'node': 'NODE1', 'remote_user': 'root', 'ret_code': 1,
+                 'elapsed': 0},
+                {'node': 'NODE6', 'remote_user': 'root', 'ret_code': 1,
+                 'elapsed': 0}]
+             },
+            {'hdr': {}, 'ts': 123456789.101, 'session_id': SESSION,
+                'kw': ['ts', 'session_id', 'user', 'env', 'org', 'result'],
+                'user': 'user', 'env': {'NEXT_NODE': ['host2', 'host9']},
+                'org': 'DEFAULT', 'result': {
+                'nodes': 2, 'failed': 2, 'exit_code': 1, 'total_time': 0}
+             }
         ]
-        with nested(
-                patch.multiple(session,
-                               read=Mock(side_effect=[iter(ret_data1)]))):
-            session.run()
-
-            expected = [
-                {'hdr': {}, 'ts': 123456789.101, 'session_id': '1234-5678-9012',  # noqa
-                'kw': ['org', 'user', 'session_id', 'ts'], 'user': 'user', 'org': 'DEFAULT'},  # noqa
-                {'hdr': {}, 'stdout': '-- Starting task #1',
-                    'ts': 123456789.101, 'session_id': 101,
-                    'kw': ['org', 'stdout', 'user', 'session_id', 'ts'], 'user': 'user', 'org': 'DEFAULT'},  # noqa
-                {'node': 'NODE1', 'hdr': {}, 'stdout': '["STDOUT", "BLA"]', 'run_as': 'admin',  # noqa
-                    'ts': 123456789.101, 'session_id': 'JOB_ID',
-                    'kw': ['node', 'stdout', 'run_as', 'ts', 'session_id', 'user', 'org'], 'user': 'user', 'org': 'DEFAULT'},  # noqa
-                {'hdr': {}, 'ts': 123456789.101, 'session_id': 'JOB_ID',
-                    'kw': ['ts', 'session_id', 'user', 'env', 'org', 'result'],
-                    'user': 'user', 'env': {'NEXT_NODE': ['host2', 'host9']},
-                    'org': 'DEFAULT', 'result': {
-                    'NODE1': {'remote_user': 'root', 'ret_code': 1},
-                    'NODE6': {'remote_user': 'root', 'ret_code': 1}}
-                }
-            ]
-            self.assertEqual(
-                ctx.register_session.call_args_list, [call("1234-5678-9012")])
-
-            session._reply.call_args_list[1][0][0].stdout = \
-                '--' + session._reply.call_args_list[1][0][0].stdout[26:]
-            self.assertEqual(
-                vars(session._reply.call_args_list[0][0][0]), expected[0])
-            self.assertEqual(
-                vars(session._reply.call_args_list[1][0][0]), expected[1])
-            self.assertEqual(
-                vars(session._reply.call_args_list[2][0][0]), expected[2])
-            self.assertEqual(
-                vars(session._reply.call_args_list[3][0][0]), expected[3])
+
+        replies = [vars(c[0][0]) for c in session._reply.call_args_list]
+        self.assertEqual(len(replies), 5)
+        replies[1]['stdout'] = '--' + replies[1]['stdout'][26:]
+        replies[4]['env']['NEXT_NODE'].sort()
+        for i in range(5):
+            replies[i]['kw'].sort()
+            expected[i]['kw'].sort()
+            self.assertEqual(replies[i], expected[i])
+        on_finish.assert_called_once_with(replies[4]['env'], {})
+
+    def _session(self, targets, resolved=None, body="hostname", **kwargs):
+        ctx = Mock(discovery_timeout=120, wait_timeout=120)
+        ctx.resolve_targets.return_value = resolved
+        from cloudrunner_server.dispatcher.session import JobSession
+        session = JobSession(
+            ctx, 'user', SESSION, 101, 0,
+            {'targets': targets, 'body': body},
+            {'org': 'DEFAULT', 'roles': {'*': 'root'}}, None, None,
+            **kwargs)
+        session._reply = Mock()
+        session.on_finish = Mock()
+        session.start(Mock(queue_ident='engine-1'))
+        session.resume({}, None)
+        return session
+
+    def _finished(self, session, node):
+        session.on_message(reply(Finished(
+            SESSION, SESSION, 'root',
+            dict(ret_code=0, env={}, stdout='', stderr='')), node))
+
+    @patch('cloudrunner_server.dispatcher.session.timestamp')
+    def test_resumed_elapsed(self, timestamp):
+        timestamp.return_value = 1000
+        session = self._session(['node1'])
+        self.assertEqual(session.start_at, 1000)
+        journal = session.manager.journal
+        journal.record.assert_any_call('start', SESSION, 1000)
+
+        # Restored from the journal after a restart
+        from cloudrunner_server.dispatcher.session import JobSession
+        ser = session.serialize()
+        restored = JobSession(
+            session.manager, 'user', SESSION, 101, 0, ser['task'],
+            ser['remote_user_map'], None, None,
+            node_map={'node1': {'status': 'STARTED', 'data': {}}})
+        restored.restore = True
+        restored.start_at = 1000
+        restored._reply = Mock()
+        timestamp.return_value = 1030
+        restored.start(Mock(queue_ident='engine-1'))
+        self._finished(restored, 'node1')
+        self.assertEqual(restored.node_map['node1']['data']['elapsed'], 30)
+        restored.discovery_period = 0
+        restored.check()
+        self.assertTrue(restored.finished)
+        self.assertEqual(restored.summary['total_time'], 30)
+
+    def test_named_targets(self):
+        session = self._session(['node1', 'NODE6'])
+        self.assertEqual(session.expected, set(['node1', 'node6']))
+
+        session.on_message(reply(Ready(SESSION), 'NODE1'))
+        session.on_message(reply(Ready(SESSION), 'NODE6'))
+        self._finished(session, 'NODE1')
+        self.assertFalse(session.finished)
+        # Finishes before the end of the discovery period
+        self._finished(session, 'NODE6')
+        self.assertTrue(session.finished)
+        self.assertEqual(session.on_finish.call_count, 1)
+
+    def test_rejected_targets(self):
+        session = self._session(['NODE1', 'NODE6'],
+                                disabled_nodes=['node6'])
+        session.on_message(reply(Ready(SESSION), 'NODE1'))
+        self._finished(session, 'NODE1')
+        self.assertFalse(session.finished)
+        session.on_message(reply(Ready(SESSION), 'NODE6'))
+        self.assertTrue(session.finished)
+
+    def test_selector_targets(self):
+        session = self._session(['os=linux', 'NODE1'])
+        self.assertEqual(session.expected, None)
+        session.on_message(reply(Ready(SESSION), 'NODE1'))
+        self._finished(session, 'NODE1')
+        # Wait for discovery period
+        self.assertFalse(session.finished)
+
+    def test_stop(self):
+        session = self._session(['os=linux'])
+        session.on_message(reply(Ready(SESSION), 'NODE1'))
+        session.session_event.set()
+        session.check()
+        self.assertEqual(session.engine.job_reply.send.call_count, 2)
+        self.assertFalse(session.finished)
+        # No need to wait for the forced stop
+        self._finished(session, 'NODE1')
+        self.assertTrue(session.finished)
+
+    def test_resolved_targets(self):
+        session = self._session(['web*'], resolved=set(['web1', 'Web2']))
+        self.assertEqual(session.expected, set(['web1', 'web2']))
+        packed = session.manager.publisher.send.call_args[0][0]
+        target = JobTarget.build(packed)
+        self.assertEqual(target.nodes, ['Web2', 'web1'])
+
+        session.on_message(reply(Ready(SESSION), 'web1'))
+        session.on_message(reply(Ready(SESSION), 'Web2'))
+        self._finished(session, 'web1')
+        self._finished(session, 'Web2')
+        self.assertTrue(session.finished)
+
+    def test_no_matching_nodes(self):
+        # Nodes may not have reported yet, the target is broadcast
+        session = self._session(['web*'], resolved=set())
+        self.assertIsNone(session.expected)
+        packed = session.manager.publisher.send.call_args[0][0]
+        self.assertIsNone(getattr(JobTarget.build(packed), 'nodes', None))
+        self.assertEqual(session.engine.call_later.call_args[0][0], 120)
+        session.check()
+        self.assertFalse(session.finished)
+
+        session = self._session(['node1'], resolved=set())
+        self.assertEqual(session.expected, set(['node1']))
+        session.check()
+        self.assertFalse(session.finished)
+
+    def _results(self, session):
+        return [m for m in [c[0][0] for c in session._reply.call_args_list]
+                if m.control == 'NODERESULTS']
+
+    @patch('cloudrunner_server.dispatcher.session.RESULT_CHUNK', 3)
+    def test_result_chunks(self):
+        names = ['node%s' % i for i in range(7)]
+        session = self._session(names)
+        for name in names:
+            session.on_message(reply(Ready(SESSION), name))
+        for name in names[:5]:
+            self._finished(session, name)
+        # Sent as soon as the chunk is full
+        chunks = self._results(session)
+        self.assertEqual([[r['node'] for r in m.results] for m in chunks],
+                         [names[:3]])
+        self.assertEqual(len(session._results), 2)
+
+        # The rest is sent on finish, with the summary
+        session.session_event.set()
+        session.check()
+        session._finish(True)
+        chunks = self._results(session)
+        self.assertEqual([[r['node'] for r in m.results] for m in chunks],
+                         [names[:3], names[3:6], names[6:]])
+        self.assertEqual([r['ret_code'] for m in chunks for r in m.results],
+                         [0] * 5 + [-255] * 2)
+        finished = session._reply.call_args[0][0]
+        self.assertEqual(finished.control, 'FINISHEDMESSAGE')
+        self.assertEqual(finished.result, dict(nodes=7, failed=2,
+                                               exit_code=1, total_time=0))
+
+    def test_result_window(self):
+        session = self._session(['node1', 'node2'])
+        session.on_message(reply(Ready(SESSION), 'node1'))
+        session.on_message(reply(Ready(SESSION), 'node2'))
+        self._finished(session, 'node1')
+        self.assertEqual(self._results(session), [])
+        delay, func = [c[0] for c in session.engine.call_later.call_args_list
+                       if c[0][1] == session._flush_results][0]
+        self.assertEqual(delay, 1)
+        func()
+        self.assertEqual(len(self._results(session)), 1)
+        # Results are sent once
+        self._finished(session, 'node1')
+        self._finished(session, 'node2')
+        self.assertEqual([[r['node'] for r in m.results]
+                          for m in self._results(session)],
+                         [['node1'], ['node2']])
+        self.assertEqual(session._reply.call_args[0][0].result['nodes'], 2)
+
+    def _pipes(self, session):
+        return [(m.node, m.ts, m.last_ts, m.stdout, m.stderr)
+                for m in [c[0][0] for c in session._reply.call_args_list]
+                if m.control == 'PIPEMESSAGE']
+
+    def test_output_coalescing(self):
+        session = self._session(['node1', 'node2'])
+        session._create_ts = Mock(side_effect=range(1, 100))
+        session.on_message(reply(Ready(SESSION), 'node1'))
+        session.on_message(reply(Ready(SESSION), 'node2'))
+
+        for line in ('a\n', 'b\n', 'c\n'):
+            session.on_message(reply(StdOut(SESSION, SESSION, 'root',
+                                            line), 'node1'))
+        session.on_message(reply(StdOut(SESSION, SESSION, 'root',
+                                        'x\n'), 'node2'))
+        session.on_message(reply(StdErr(SESSION, SESSION, 'root',
+                                        'err\n'), 'node1'))
+        session.on_message(reply(StdOut(SESSION, SESSION, 'root',
+                                        'd\n'), 'node1'))
+        # Switching streams flushes the previous chunks, sent with
+        # the times of the first and the last chunk
+        self.assertEqual(self._pipes(session),
+                         [('node1', 3, 5, 'a\nb\nc\n', ''),
+                          ('node1', 7, 7, '', 'err\n')])
+
+        # Time window
+        timers = [c[0] for c in session.engine.call_later.call_args_list
+                  if c[0][1] == session._flush_output]
+        self.assertEqual(len(timers), 4)
+        for delay, func, node, buf in timers:
+            self.assertEqual(delay, .1)
+            func(node, buf)
+        self.assertEqual(self._pipes(session)[2:],
+                         [('node2', 6, 6, 'x\n', ''),
+                          ('node1', 8, 8, 'd\n', '')])
+
+    def test_output_flush(self):
+        session = self._session(['node1'])
+        session.on_message(reply(Ready(SESSION), 'node1'))
+        chunk = 'x' * 1000
+        for i in range(70):
+            session.on_message(reply(StdOut(SESSION, SESSION, 'root',
+                                            chunk), 'node1'))
+        # Size threshold
+        pipes = self._pipes(session)
+        self.assertEqual([len(p[3]) for p in pipes], [66000])
+
+        # Output is flushed before the node result
+        session.on_message(reply(Finished(
+            SESSION, SESSION, 'root',
+            dict(ret_code=0, env={}, stdout='', stderr='')), 'node1'))
+        pipes = self._pipes(session)
+        self.assertEqual([len(p[3]) for p in pipes], [66000, 4000])
+        self.assertTrue(session.finished)
+
+    def test_script_blobs(self):
+        body = "#! /bin/bash\n" + "echo 1\n" * 1000
+        session = self._session(['node1', 'node2', 'node3'], body=body)
+        sent = session.engine.job_reply.send
+
+        session.on_message(reply(Ready(SESSION, 'READY', caps=['blobs']),
+                                 'node1'))
+        session.on_message(reply(Ready(SESSION, 'READY', caps=['blobs']),
+                                 'node2'))
+        session.on_message(reply(Ready(SESSION, 'READY'), 'node3'))
+        jobs = [Job.build(c[0][0]) for c in sent.call_args_list]
+        self.assertEqual([j.hdr.ident for j in jobs],
+                         ['ident-node1', 'ident-node2', 'ident-node3'])
+        self.assertEqual(set(j.hdr.dest for j in jobs), set([SESSION]))
+        # Older agents get the body inline
+        self.assertEqual(jobs[2].request['script'], body)
+        self.assertNotIn('script', jobs[0].request)
+        script_hash = jobs[0].request['script_hash']
+        self.assertEqual(jobs[1].request, jobs[0].request)
+
+        session.on_message(reply(GetBlob(SESSION, script_hash), 'node1'))
+        blob = Blob.build(sent.call_args[0][0])
+        self.assertEqual(blob.hdr.ident, 'ident-node1')
+        self.assertEqual((blob.hash, blob.content), (script_hash, body))
+        # Does not change the node status
+        self.assertEqual(session.node_map['node1']['status'], 'STARTED')
+
+        session.on_message(reply(GetBlob(SESSION, 'other'), 'node1'))
+        self.assertEqual(sent.call_count, 4)
+
+    def test_small_script_inline(self):
+        session = self._session(['node1'])
+        session.on_message(reply(Ready(SESSION, 'READY', caps=['blobs']),
+                                 'node1'))
+        job = Job.build(session.engine.job_reply.send.call_args[0][0])
+        self.assertEqual(job.request['script'], session.request['script'])
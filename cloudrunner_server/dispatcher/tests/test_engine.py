@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from mock import call, Mock
+
+from cloudrunner_server.core.message import StdOut
+from cloudrunner_server.dispatcher.engine import SessionEngine
+from cloudrunner_server.tests import base
+
+
+class TestEngine(base.BaseTestCase):
+
+    def test_dispatch(self):
+        engine = SessionEngine(Mock(), 'sessions-1')
+        session1 = Mock(session_id='session-1')
+        session2 = Mock(session_id='session-2')
+        engine.add(session1)
+        engine.add(session2)
+        session1.start.assert_called_once_with(engine)
+
+        msg = StdOut(output='out')
+        msg.hdr.dest = 'session-2'
+        engine._dispatch([msg._])
+        self.assertFalse(session1.on_message.called)
+        self.assertEqual(session2.on_message.call_count, 1)
+        self.assertEqual(
+            session2.on_message.call_args[0][0].output, 'out')
+
+        engine.remove('session-2')
+        engine._dispatch([msg._])
+        self.assertEqual(session2.on_message.call_count, 1)
+
+    def test_timers(self):
+        engine = SessionEngine(Mock(), 'sessions-1')
+        calls = []
+        engine.call_later(0, calls.append, 2)
+        engine.call_later(-1, calls.append, 1)
+        engine.call_later(60, calls.append, 3)
+        engine.call_soon(calls.append, 0)
+        self.assertEqual(engine._timeout(), 0)
+
+        engine._run_calls()
+        engine._run_timers()
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(engine._timeout(), 50)
+
+    def test_start_queue(self):
+        engine = SessionEngine(Mock(), 'sessions-1')
+        engine.job_done = Mock()
+        tasks = [Mock(session_id='s1'), Mock(session_id='s2')]
+        queue = Mock(tasks=tasks, prepare_task=None, task_id=11,
+                     org='DEFAULT', owner='user', start_args=[{}, None],
+                     restored=False)
+
+        engine._start_queue(queue)
+        self.assertEqual(engine.job_done.send.call_count, 1)
+        self.assertEqual(sorted(engine.sessions), ['s1', 's2'])
+        self.assertEqual(tasks[0].resume.call_args_list, [call({}, None)])
+        self.assertFalse(tasks[1].resume.called)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+from cloudrunner_server.dispatcher import SessionRegistry
+from cloudrunner_server.dispatcher.journal import SessionJournal
+from cloudrunner_server.dispatcher.manager import SessionManager
+from cloudrunner_server.tests import base
+
+USER_MAP = {'org': 'DEFAULT', 'roles': {'*': 'root'}}
+
+
+def session(session_id, step_id):
+    return dict(session_id=session_id, task_id=7, step_id=step_id,
+                user='user', task={'targets': ['node1'], 'body': 'hostname'},
+                remote_user_map=USER_MAP, timeout=60, parent=None,
+                kwargs={'disabled_nodes': []})
+
+
+class TestSessionJournal(base.BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _journal(self, **kwargs):
+        journal = SessionJournal(self.path, **kwargs)
+        journal.queue(7, 'user', 'DEFAULT', {'A': '1'},
+                      [session('s1', 0), session('s2', 1),
+                       session('s3', 2)])
+        journal.record('start', 's1')
+        journal.record('node', 's1', 'node1', {'status': 'FINISHED'})
+        journal.record('end', 's1', {'A': '2'})
+        journal.record('start', 's2', 1000)
+        journal.record('node', 's2', 'node1', {'status': 'STARTED'})
+        return journal
+
+    def test_load(self):
+        journal = self._journal()
+        journal.queue(8, 'user', 'DEFAULT', {}, [session('s4', 0)])
+        journal.record('done', 8)
+        journal.close()
+
+        queues = SessionJournal(self.path).load()
+        self.assertEqual(len(queues), 1)
+        queue = queues[0]
+        self.assertEqual(queue['task_id'], 7)
+        self.assertEqual(queue['started'], ['s1', 's2'])
+        self.assertEqual(queue['start_at'], {'s2': 1000})
+        self.assertEqual(queue['ended'], {'s1': {'A': '2'}})
+        self.assertEqual(queue['nodes']['s2'],
+                         {'node1': {'status': 'STARTED'}})
+
+    def test_batches(self):
+        journal = self._journal(batch_size=7)
+        # Nothing is written before the batch is full
+        self.assertFalse(os.path.exists(self.path))
+        journal.record('start', 's3')
+        self.assertEqual(len(open(self.path).readlines()), 7)
+        journal.record('end', 's2', {})
+        journal.flush()
+        self.assertEqual(len(open(self.path).readlines()), 8)
+
+    def test_partial_line(self):
+        self._journal().close()
+        with open(self.path, 'a') as f:
+            f.write('["end", "s2"')
+        queue = SessionJournal(self.path).load()[0]
+        self.assertEqual(queue['ended'].keys(), ['s1'])
+
+    def test_compact(self):
+        journal = self._journal()
+        for i in range(100):
+            journal.queue(100 + i, 'user', 'DEFAULT', {},
+                          [session('x%s' % i, 0)])
+            journal.record('done', 100 + i)
+        journal.compact()
+        self.assertEqual(len(open(self.path).readlines()), 6)
+
+        journal.record('start', 's3')
+        journal.close()
+        queue = SessionJournal(self.path).load()[0]
+        self.assertEqual(queue['started'], ['s1', 's2', 's3'])
+        self.assertEqual(queue['start_at'], {'s2': 1000})
+        self.assertEqual(queue['ended'], {'s1': {'A': '2'}})
+
+    def test_resume(self):
+        self._journal().close()
+
+        manager = SessionManager.__new__(SessionManager)
+        manager.journal = SessionJournal(self.path)
+        manager.engines = [Mock()]
+        manager.sessions = {}
+        manager.subscriptions = SessionRegistry()
+        manager.discovery_timeout = 2
+        manager.wait_timeout = 60
+        manager.spool_dir = self.dir
+        manager.resume_sessions()
+
+        # s1 finished before the restart
+        self.assertEqual(sorted(manager.sessions), ['s2', 's3'])
+        queue = manager.subscriptions.get(7)
+        self.assertTrue(queue.restored)
+        self.assertEqual(queue.task_ids, ['s2', 's3'])
+        self.assertEqual(queue.start_args, ({'A': '2'}, None))
+        manager.engines[0].submit.assert_called_once_with(queue)
+
+        s2, s3 = queue.tasks
+        self.assertTrue(s2.restore)
+        self.assertEqual(s2.start_at, 1000)
+        self.assertEqual(s2.node_map, {'node1': {'status': 'STARTED'}})
+        self.assertEqual(s2.on_finish, s3.resume)
+        self.assertFalse(s3.restore)
+        self.assertEqual(s3.parent, 's2')
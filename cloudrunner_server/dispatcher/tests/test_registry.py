@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from cloudrunner_server.dispatcher import SessionRegistry, TaskQueue
+from cloudrunner_server.tests import base
+
+
+class Task(object):
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+
+def make_queue(task_id, owner, steps=2):
+    queue = TaskQueue()
+    queue.task_id = task_id
+    queue.owner = owner
+    for step in range(steps):
+        queue.push(Task('%s-%s' % (task_id, step)))
+    return queue
+
+
+class TestSessionRegistry(base.BaseTestCase):
+
+    def test_lookup(self):
+        registry = SessionRegistry(ttl=10)
+        queue1 = make_queue(1, 'user1')
+        queue2 = make_queue(2, 'user2')
+        registry.add(queue1, now=100)
+        registry.add(queue2, now=100)
+
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.get(1), queue1)
+        self.assertEqual(registry.get('2-1'), queue2)
+        self.assertEqual(registry.get('2-1', owner='user2'), queue2)
+        self.assertIsNone(registry.get('2-1', owner='user1'))
+        self.assertIsNone(registry.get('missing'))
+        self.assertEqual(registry.by_owner('user1'), [queue1])
+        self.assertEqual(registry.by_owner('user3'), [])
+
+    def test_expire(self):
+        registry = SessionRegistry(ttl=10)
+        queue1 = make_queue(1, 'user1')
+        queue2 = make_queue(2, 'user1')
+        registry.add(queue1, now=100)
+        registry.add(queue2, now=100)
+        registry.finish(queue1, now=105)
+
+        # Kept for ttl after finish
+        registry.expire(now=114)
+        self.assertEqual(registry.get('1-0'), queue1)
+        registry.expire(now=115)
+        self.assertIsNone(registry.get(1))
+        self.assertIsNone(registry.get('1-0'))
+        self.assertEqual(registry.by_owner('user1'), [queue2])
+        self.assertEqual(len(registry), 1)
+
+        # Running queues are never evicted
+        registry.expire(now=10000)
+        self.assertEqual(registry.get(2), queue2)
+
+    def test_reused_task_id(self):
+        registry = SessionRegistry(ttl=10)
+        queue1 = make_queue(1, 'user1')
+        registry.add(queue1, now=100)
+        registry.finish(queue1, now=100)
+        queue2 = make_queue(1, 'user1')
+        registry.add(queue2, now=101)
+        registry.expire(now=200)
+        self.assertEqual(registry.get(1), queue2)
+
+    def test_soak(self):
+        # Memory stays flat with the dispatch count
+        registry = SessionRegistry(ttl=300)
+        sizes = []
+        for i in range(100000):
+            queue = make_queue(i, 'user%s' % (i % 50))
+            registry.add(queue, now=i)
+            registry.finish(queue, now=i + 5)
+            if i in (50000 - 1, 100000 - 1):
+                sizes.append((len(registry), len(registry.queues),
+                              len(registry.owners), len(registry._expiry)))
+        self.assertEqual(sizes[0], sizes[1])
+        self.assertTrue(len(registry) <= 306)
+        self.assertTrue(len(registry.queues) <= 306 * 3)
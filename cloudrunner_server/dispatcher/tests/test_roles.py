@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import re
+
+from cloudrunner_server.dispatcher.session import RoleMatcher, UserMap
+from cloudrunner_server.tests import base
+from cloudrunner_server.util.lru import LRUCache
+
+
+class TestRoleMatcher(base.BaseTestCase):
+
+    def test_precedence(self):
+        matcher = RoleMatcher({'*': 'nobody', 'web.*': 'www',
+                               'web-db.*': 'postgres', 'db': 'mysql'})
+        self.assertEqual(matcher.match('web-db1'), 'postgres')
+        self.assertEqual(matcher.match('web1'), 'www')
+        self.assertEqual(matcher.match('db2'), 'mysql')
+        self.assertEqual(matcher.match('app1'), 'nobody')
+        # Equal length, ordered by pattern
+        matcher = RoleMatcher({'node[12]': 'a', 'node[13]': 'b'})
+        self.assertEqual(matcher.match('node1'), 'a')
+        self.assertEqual(matcher.match('node3'), 'b')
+        self.assertEqual(matcher.match('host'), None)
+
+    def test_special_patterns(self):
+        matcher = RoleMatcher({'(web|app)(\\d)\\2': 'grouped',
+                               '(?i)DB.*': 'flags',
+                               'a|b': 'alt', '[': 'invalid',
+                               '\\1': 'backref', 'c.*': 'plain'})
+        self.assertEqual(matcher.match('web11'), 'grouped')
+        self.assertEqual(matcher.match('web12'), None)
+        self.assertEqual(matcher.match('db1'), 'flags')
+        self.assertEqual(matcher.match('b1'), 'alt')
+        self.assertEqual(matcher.match('c1'), 'plain')
+
+    def test_large_map(self):
+        role_map = dict(('node%03d$' % i, 'user%s' % i) for i in range(250))
+        matcher = RoleMatcher(role_map)
+        self.assertEqual(len(matcher.segments), 3)
+        for i in range(250):
+            self.assertEqual(matcher.match('node%03d' % i), 'user%s' % i)
+        self.assertEqual(matcher.match('node1000'), None)
+
+    def test_batch_order(self):
+        # Overlapping rules across alternations and own group segments
+        # match as if tried one by one, longest pattern first
+        role_map = dict(('n.{%s}' % i, 'len%s' % i) for i in range(1, 200))
+        role_map['(n)(\\d+)'] = 'grouped'
+        role_map['n1.*'] = 'n1'
+        matcher = RoleMatcher(role_map)
+        self.assertTrue(len(matcher.segments) > 3)
+
+        rules = sorted(role_map.items(),
+                       key=lambda rule: (-len(rule[0]), rule[0]))
+        for node in ['n' + '1' * i for i in range(1, 210)] + ['n', 'x1']:
+            expected = None
+            for pattern, role in rules:
+                if re.match(pattern, node):
+                    expected = role
+                    break
+            self.assertEqual(matcher.match(node), expected)
+        # Longest pattern text first, not the longest match
+        self.assertEqual(matcher.match('n1'), 'grouped')
+        self.assertEqual(matcher.match('nx'), 'len1')
+        self.assertEqual(matcher.match('n' + 'x' * 12), 'len10')
+
+    def test_cache(self):
+        RoleMatcher._cache = LRUCache(2)
+        try:
+            first = RoleMatcher.get({'*': 'a'})
+            second = RoleMatcher.get({'*': 'b'})
+            self.assertTrue(RoleMatcher.get({'*': 'a'}) is first)
+            RoleMatcher.get({'*': 'c'})
+            # Only the least recently used map is dropped
+            self.assertTrue(RoleMatcher.get({'*': 'a'}) is first)
+            self.assertFalse(RoleMatcher.get({'*': 'b'}) is second)
+        finally:
+            RoleMatcher._cache = LRUCache(RoleMatcher.CACHE_SIZE)
+
+    def test_shared(self):
+        role_map = {'*': 'root', 'web.*': 'www'}
+        map1 = UserMap(role_map, 'user1')
+        map2 = UserMap(dict(role_map), 'user2')
+        self.assertTrue(map1.matcher is map2.matcher)
+        self.assertFalse(map1.matcher is UserMap({'*': 'root'},
+                                                 'user1').matcher)
+
+        self.assertEqual(map1.select('web1'), 'www')
+        self.assertEqual(map1.select('app1'), 'root')
+        self.assertEqual(map1.selected, {'web1': 'www', 'app1': 'root'})
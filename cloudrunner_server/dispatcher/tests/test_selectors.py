@@ -113,6 +113,8 @@ whoami
                 job.receive = Mock(side_effect=[("READY",)])
                 self.backend = Mock()
                 self.register_session = Mock()
+                self.resolve_targets = Mock(return_value=None)
+                self.journal = None
                 self.config = Mock()
 
         remote_user_map = {'org': 'DEFAULT', 'roles': {'*': '@'}}
@@ -126,49 +128,18 @@ whoami
                 self.job_plugins = []
 
         env = {'NEXT_NODE': ['host2', 'host9']}
-        queue = Mock(return_value=Mock(get=lambda *args: [env, None]))
         task_id = 101
         step_id = 0
         from cloudrunner_server.dispatcher.session import JobSession
         session = JobSession(
             ctx, 'user', SESSION, task_id, step_id,
             {'target': '*', 'body': "\ntest_1\nexport NEXT_NODE='host2'\n\n"},
-            remote_user_map, queue(), queue(), None, None)
+            remote_user_map, None, None)
         session._reply = Mock()
 
-        ret_data1 = [
-            ['PIPE', 'JOB_ID', 123456789.101, 'admin',
-                'NODE1', '["STDOUT", "BLA"]'],
-            [
-                'JOB_ID', [{'node': "NODE1",
-                            'remote_user': 'root',
-                            'ret_code': 1,
-                            'env': {'NEXT_NODE': "host2"}},
-                           {'node': "NODE6",
-                            'remote_user': 'root',
-                            'ret_code': 1,
-                            'env': {'NEXT_NODE': "host9"}}],
-                []
-            ]
-        ]
-
-        with nested(
-                patch.multiple(session,
-                               read=Mock(side_effect=[iter(ret_data1)]))):
-            session.run()
-
-            """
-            expected = [
-                call('*',
-                     {'remote_user_map': remote_user_map,
-                      'attachments': [],
-                      'env': {'NEXT_NODE': ['host2', 'host9']},
-                      'script': "\ntest_1\nexport NEXT_NODE='host2'\n\n"},
-                     timeout=120)]
-
-            self.assertEqual(
-                ctx.register_session.call_args_list, [call("1234-5678-9012")])
-
-            #self.assertEqual(
-            #    session._reply.call_args_list[0], expected[0])
-            """
+        engine = Mock(queue_ident='engine-1')
+        with nested(patch.object(session, 'run_script')):
+            session.start(engine)
+            session.resume(env, None)
+            session.run_script.assert_called_once_with('')
+            self.assertEqual(session.request['env'], env)
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+from cloudrunner_server.core.message import FileExport, Ready
+from cloudrunner_server.dispatcher.session import JobSession
+from cloudrunner_server.dispatcher.spool import Spool
+from cloudrunner_server.tests import base
+
+SESSION = 'session-1'
+
+
+class TestSpool(base.BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        spool = Spool(self.dir, 101)
+        path = spool.write('node1_out.log', 'part1\n')
+        self.assertEqual(spool.write('node1_out.log', 'part2\n'), path)
+        self.assertEqual(os.path.dirname(path), os.path.join(self.dir, '101'))
+        self.assertEqual(open(path).read(), 'part1\npart2\n')
+
+        empty = spool.write('node1_empty', '')
+        self.assertEqual(open(empty).read(), '')
+
+        spool.cleanup()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, '101')))
+
+    def test_names(self):
+        spool = Spool(self.dir, '../101')
+        path1 = spool.write('node1_../../etc/passwd', 'x')
+        path2 = spool.write('node1_.._.._etc_passwd', 'y')
+        self.assertNotEqual(path1, path2)
+        for path in (path1, path2):
+            self.assertEqual(os.path.dirname(path), spool.path)
+            self.assertEqual(os.path.dirname(spool.path), self.dir)
+
+    def test_session_exports(self):
+        ctx = Mock(discovery_timeout=120, wait_timeout=120)
+        ctx.resolve_targets.return_value = None
+        session = JobSession(ctx, 'user', SESSION, 101, 0,
+                             {'targets': ['node1'], 'body': 'hostname'},
+                             {'org': 'DEFAULT', 'roles': {'*': 'root'}},
+                             None, None)
+        session._reply = Mock()
+        session.spool = Spool(self.dir, 101)
+        session.start(Mock(queue_ident='engine-1'))
+        session.resume({}, None)
+
+        export = FileExport(SESSION, SESSION, 'out.log', 'data')
+        for msg in (Ready(SESSION), export):
+            msg.hdr.peer = 'node1'
+            msg.hdr.org = 'DEFAULT'
+            session.on_message(msg)
+        path = session.file_exports['node1_out.log']
+        self.assertEqual(open(path).read(), 'data')
@@ -133,6 +133,9 @@ def main():
                              help='Node organization/Sub-CA name').\
         completer = _list_sub_ca
 
+    c_subcmd.add_parser('compact_crl',
+                        help='Remove duplicate entries from the CRL file')
+
     cert_revoke_ca = c_subcmd.add_parser('revoke_ca',
                                          help='Revoke existing Sub-CA')
     cert_revoke_ca.add_argument('ca',
@@ -30,8 +30,10 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 
 from cloudrunner import VAR_DIR, LOG_DIR, TMP_DIR
 from cloudrunner_server.core.message import TOKEN_SEPARATOR
+from cloudrunner_server.master.keypool import KeyPool, POOL_SIZE
 from cloudrunner_server.plugins.auth.base import NodeVerifier
 from cloudrunner_server.api.model import *  # noqa
+from cloudrunner_server.util.crl import CrlJournal
 from cloudrunner_server.util.db import checkout_listener
 from cloudrunner_server.util.validator import valid_node_name
 
@@ -109,6 +111,14 @@ class CertController(DbMixin):
     def pass_cb(self, *args):
         return self.config.security.cert_pass
 
+    @property
+    def key_pool(self):
+        # Pre-generated org CA keys, see create_ca(key=...)
+        return KeyPool.get(
+            os.path.join(self.ca_path, 'org', 'pool'),
+            size=int(self.config.security.ca_key_pool or POOL_SIZE),
+            passphrase=self.config.security.cert_pass)
+
     @property
     def serial_no(self):
         serial_fn = os.path.join(self.ca_path, 'serial')
@@ -118,20 +128,17 @@ class CertController(DbMixin):
 
     def serial_no_inc(self):
         serial_fn = os.path.join(self.ca_path, 'serial')
-        current = None
-        if not os.path.exists(serial_fn):
-            serial = open(serial_fn, 'w')
-        else:
-            serial = os.open(serial_fn, os.O_RDWR)
-            current = os.read(serial, 1000)
+        serial = os.open(serial_fn, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Lock before reading, nodes are signed in parallel
+            fcntl.flock(serial, fcntl.LOCK_EX)
+            current = os.read(serial, 1000).strip() or 0
+            new_serial = int(current) + 1
             os.ftruncate(serial, 0)
             os.lseek(serial, 0, 0)
-        if not current:
-            current = 0
-        fcntl.flock(serial, fcntl.LOCK_EX)
-        new_serial = int(current) + 1
-        os.write(serial, '%02s' % new_serial)
-        os.close(serial)
+            os.write(serial, '%02s' % new_serial)
+        finally:
+            os.close(serial)
         return new_serial
 
     def get_approved_nodes(self, org=None):
@@ -381,7 +388,7 @@ class CertController(DbMixin):
             del now
             del nowPlusYear
 
-            if is_signed:
+            if is_signed and kwargs.get('approve', True):
                 db_node = self.db.query(Node).join(Org).filter(
                     Node.name == node, Org.name == ca).first()
 
@@ -587,11 +594,9 @@ class CertController(DbMixin):
                 if os.path.exists(cert_fn):
                     ser_no = open(cert_fn).read().strip()
                     assert int(ser_no)
-                    # Update CRL file
-                    crl_file = open(os.path.join(self.ca_path, 'crl'), 'w')
-                    fcntl.flock(crl_file, fcntl.LOCK_EX)
-                    crl_file.write('%s\n' % ser_no)
-                    crl_file.close()
+                    # Update CRL journal
+                    CrlJournal(os.path.join(self.ca_path, 'crl')).append(
+                        ser_no)
                     yield DATA, "Removing signed certificate for %s " % node
                     os.unlink(cert_fn)
                 issued_fn = os.path.join(
@@ -610,6 +615,16 @@ class CertController(DbMixin):
                     self.db.delete(node)
                     self.db.commit()
 
+    @yield_wrap
+    def compact_crl(self, **kwargs):
+        crl_file = os.path.join(self.ca_path, 'crl')
+        if not os.path.exists(crl_file):
+            yield NOTE, "No CRL file found"
+            return
+        yield TAG, "Compacting CRL"
+        before, after = CrlJournal(crl_file).compact()
+        yield DATA, "%s entries, %s unique serials" % (before, after)
+
     @yield_wrap
     def clear_req(self, nodes, **kwargs):
         if not isinstance(nodes, (list, tuple)):
@@ -709,11 +724,13 @@ basicConstraints = CA:true
         subca_csr_file = os.path.join(ca_dir, ca + ".csr")
         subca_crt_file = os.path.join(ca_dir, ca + ".ca.crt")
 
-        subca_key = m.EVP.PKey()
-        subca_rsa = m.RSA.gen_key(kwargs.get('key_size', 2048),
-                                  65537,
-                                  lambda: True)
-        subca_key.assign_rsa(subca_rsa)
+        subca_key = kwargs.get('key')
+        if not subca_key:
+            subca_key = m.EVP.PKey()
+            subca_rsa = m.RSA.gen_key(kwargs.get('key_size', 2048),
+                                      65537,
+                                      lambda: True)
+            subca_key.assign_rsa(subca_rsa)
 
         subca_csr = m.X509.Request()
         try:
@@ -1256,7 +1273,7 @@ class UserController(DbMixin):
         self.db.add(org)
         self.db.commit()
         ccont = CertController(self.config)
-        for _type, line in ccont.create_ca(name):
+        for _type, line in ccont.create_ca(name, key=ccont.key_pool.take()):
             yield _type, line
         yield DATA, "Added"
 
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+import errno
+import fcntl
+import logging
+import M2Crypto as m
+from M2Crypto import threading as m2threading
+import os
+from threading import Event, Lock, Thread
+import uuid
+
+LOG = logging.getLogger('KeyPool')
+
+# Pre-generated keys kept ready
+POOL_SIZE = 5
+# Seconds between the pool checks, take() triggers a check right away
+REFILL_INTERVAL = 60
+
+
+class KeyPool(object):
+
+    """
+    Directory of pre-generated org CA keys, so creating an org does not
+    wait for RSA key generation.
+
+    A key is claimed with an atomic rename, so it is handed out only
+    once, also between the processes sharing the directory. Each process
+    runs a refill thread, started on first use (after forking), which
+    tops the pool up to `size` keys. The refills of the processes are
+    serialized with a lock file.
+    """
+
+    _pools = {}
+    _lock = Lock()
+
+    def __init__(self, path, size=POOL_SIZE, key_size=2048, passphrase=''):
+        self.path = path
+        self.size = size
+        self.key_size = key_size
+        self.passphrase = passphrase
+        self._wakeup = Event()
+        self._pid = None
+
+    @classmethod
+    def get(cls, path, **kwargs):
+        # One pool (and refill thread) per directory in the process
+        with cls._lock:
+            pool = cls._pools.get(path)
+            if not pool:
+                pool = cls._pools[path] = KeyPool(path, **kwargs)
+            return pool
+
+    def _pass_cb(self, *args):
+        return self.passphrase
+
+    def _keys(self):
+        try:
+            return [f for f in os.listdir(self.path) if f.endswith('.key')]
+        except OSError:
+            return []
+
+    def take(self):
+        # Returns an unused EVP.PKey, None if the pool is empty
+        self.start()
+        try:
+            for name in self._keys():
+                key_file = os.path.join(self.path, name)
+                claimed = '%s.%s' % (key_file, uuid.uuid4().hex)
+                try:
+                    os.rename(key_file, claimed)
+                except OSError, err:
+                    if err.errno == errno.ENOENT:
+                        # Taken by another process
+                        continue
+                    raise
+                try:
+                    with open(claimed) as f:
+                        return m.EVP.load_key_string(f.read(),
+                                                     callback=self._pass_cb)
+                except Exception, ex:
+                    LOG.exception(ex)
+                finally:
+                    os.unlink(claimed)
+            LOG.warn("Key pool %s is empty" % self.path)
+            return None
+        finally:
+            self._wakeup.set()
+
+    def fill(self):
+        # Generates the missing keys, returns the number of keys added
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        lock = os.open(os.path.join(self.path, '.lock'),
+                       os.O_RDWR | os.O_CREAT, 0o600)
+        added = 0
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for name in os.listdir(self.path):
+                if name.endswith('.tmp'):
+                    # Left by a refill which did not complete
+                    os.unlink(os.path.join(self.path, name))
+            while len(self._keys()) < self.size:
+                self._generate()
+                added += 1
+        finally:
+            os.close(lock)
+        return added
+
+    def _generate(self):
+        key = m.EVP.PKey()
+        key.assign_rsa(m.RSA.gen_key(self.key_size, 65537,
+                                     lambda *args: None))
+        if self.passphrase:
+            pem = key.as_pem(callback=self._pass_cb)
+        else:
+            pem = key.as_pem(cipher=None)
+        name = uuid.uuid4().hex
+        tmp_file = os.path.join(self.path, name + '.tmp')
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.write(fd, pem)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        # Visible to take() only when complete
+        os.rename(tmp_file, os.path.join(self.path, name + '.key'))
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            m2threading.init()
+            self._wakeup.set()
+            thread = Thread(target=self._refill)
+            thread.daemon = True
+            thread.start()
+
+    def _refill(self):
+        while True:
+            self._wakeup.wait(REFILL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                added = self.fill()
+                if added:
+                    LOG.info("Added %s keys to pool %s" % (added, self.path))
+            except Exception, ex:
+                LOG.exception(ex)
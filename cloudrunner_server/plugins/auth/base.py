@@ -13,6 +13,8 @@
 #  *******************************************************/
 
 import abc
+from threading import Lock
+import time
 
 
 class NodeVerifier(object):
@@ -22,3 +24,60 @@ class NodeVerifier(object):
     @abc.abstractmethod
     def verify(self, node, subject, **kwargs):
         pass
+
+
+class TTLCache(object):
+
+    """
+    Thread safe map of values expiring `ttl` seconds after they were set.
+    Meant to be shared by the verifier instances, which are created for
+    each request.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (value, expires)
+        self._items = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[1] <= time.time():
+                del self._items[key]
+                return default
+            return item[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            if key not in self._items and len(self._items) >= self.max_size:
+                self._purge(now)
+            self._items[key] = (value, now + self.ttl)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return item[0] if item else None
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def _purge(self, now):
+        expired = [k for k, v in self._items.items() if v[1] <= now]
+        for key in expired:
+            del self._items[key]
+        if len(self._items) >= self.max_size:
+            # Still full, start over
+            self._items.clear()
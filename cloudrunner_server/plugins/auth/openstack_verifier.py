@@ -13,6 +13,8 @@
 #  *******************************************************/
 
 import logging
+from threading import Lock
+import time
 from keystoneclient.v2_0 import client as k
 from novaclient.v1_1 import client as n
 
@@ -20,9 +22,27 @@ from cloudrunner_server.plugins.auth.base import NodeVerifier
 
 LOG = logging.getLogger('OpenStackVerifier')
 
+# Seconds between full reloads of the server index
+INDEX_TTL = 300
+# Min seconds between reloads for servers missing in the index
+MISS_INTERVAL = 10
+
 
 class OpenStackVerifier(NodeVerifier):
 
+    """
+    Resolves the tenant of the node from the server id in the CSR.
+    The servers of all tenants are indexed once and the index is
+    shared by the verifier instances, it is reloaded every
+    `auth_index_ttl` seconds, or sooner for unknown (new) servers.
+    """
+
+    # server id -> (server name, tenant name)
+    _index = {}
+    _loaded = 0
+    _checked = 0
+    _lock = Lock()
+
     def __init__(self, config):
         self.config = config
 
@@ -32,6 +52,7 @@ class OpenStackVerifier(NodeVerifier):
         self.admin_tenant = config.auth_admin_tenant or 'admin'
         self.strict_check = config.auth_strict_check
         self.timeout = int(config.auth_timeout or 5)
+        self.index_ttl = int(config.auth_index_ttl or INDEX_TTL)
 
     def _get_token(self):
         # Create token
@@ -43,39 +64,54 @@ class OpenStackVerifier(NodeVerifier):
         token = keystone.auth_token
         return token
 
-    def verify(self, node, subject, **kwargs):
-        try:
-            CN = subject.CN
-            OU = subject.OU
+    def _load_index(self):
+        keystone = k.Client(token=self._get_token(),
+                            auth_url=self.ADMIN_AUTH_URL,
+                            tenant_name=self.admin_tenant,
+                            timeout=self.timeout)
 
-            keystone = k.Client(token=self._get_token(),
-                                auth_url=self.ADMIN_AUTH_URL,
-                                tenant_name=self.admin_tenant,
-                                timeout=self.timeout)
+        tenants = dict((t.id, t.name) for t in keystone.tenants.list())
 
-            tenants = keystone.tenants.list()
+        conn = n.Client(self.admin_user, self.admin_pass,
+                        self.admin_tenant, self.ADMIN_AUTH_URL,
+                        service_type="compute",
+                        timeout=self.timeout)
 
-            conn = n.Client(self.admin_user, self.admin_pass,
-                            self.admin_tenant, self.ADMIN_AUTH_URL,
-                            service_type="compute",
-                            timeout=self.timeout)
+        index = {}
+        for server in conn.servers.list(True,
+                                        search_opts={'all_tenants': True}):
+            tenant = tenants.get(server.tenant_id)
+            if tenant:
+                index[server.id] = (server.name, tenant)
+        return index
+
+    def _lookup(self, server_id):
+        cls = OpenStackVerifier
+        with cls._lock:
+            now = time.time()
+            stale = now - cls._loaded > self.index_ttl
+            if (stale or server_id not in cls._index) and \
+                    now - cls._checked > MISS_INTERVAL:
+                # Also limits the reloads while the cloud API is failing
+                cls._checked = now
+                cls._index = self._load_index()
+                cls._loaded = now
+                LOG.info("Loaded %s servers" % len(cls._index))
+            return cls._index.get(server_id)
 
-            for server in conn.servers.list(True,
-                                            search_opts={'all_tenants': True}):
-                if self.strict_check:
-                    # Perform strict check by hostname and ID
-                    if server.name != CN:
-                        continue
-                if server.id == OU:
-                    tenant = filter(
-                        lambda t: t.id == server.tenant_id, tenants)
-                    if tenant:
-                        name = tenant[0].name
-                        LOG.info("Tenant [%s] matched for server %s" % (
-                            name, node))
-                        return name
+    def verify(self, node, subject, **kwargs):
+        try:
+            server = self._lookup(subject.OU)
         except Exception, e:
             LOG.error(e)
             return None
 
-        return None
+        if not server:
+            return None
+        name, tenant = server
+        if self.strict_check:
+            # Perform strict check by hostname and ID
+            if name != subject.CN:
+                return None
+        LOG.info("Tenant [%s] matched for server %s" % (tenant, node))
+        return tenant
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+from mock import patch
+
+from cloudrunner_server.plugins.auth.base import TTLCache
+from cloudrunner_server.tests import base
+
+
+class TestTTLCache(base.BaseTestCase):
+
+    @patch('cloudrunner_server.plugins.auth.base.time')
+    def test_expire(self, _time):
+        _time.time.return_value = 1000
+        cache = TTLCache(60)
+        cache.set('key1', 'org1')
+        cache.set('key2', 'org2')
+        self.assertEqual(cache.get('key1'), 'org1')
+
+        _time.time.return_value = 1059
+        cache.set('key2', 'org3')
+        _time.time.return_value = 1060
+        self.assertIsNone(cache.get('key1'))
+        self.assertEqual(cache.get('key2'), 'org3')
+        self.assertEqual(cache.keys(), ['key2'])
+
+        self.assertEqual(cache.pop('key2'), 'org3')
+        self.assertIsNone(cache.pop('key2'))
+        self.assertEqual(len(cache), 0)
+
+    @patch('cloudrunner_server.plugins.auth.base.time')
+    def test_max_size(self, _time):
+        _time.time.return_value = 1000
+        cache = TTLCache(60, max_size=3)
+        cache.set('key1', 1)
+        _time.time.return_value = 1030
+        cache.set('key2', 2)
+        cache.set('key3', 3)
+
+        # Expired items are dropped first
+        _time.time.return_value = 1070
+        cache.set('key4', 4)
+        self.assertEqual(sorted(cache.keys()), ['key2', 'key3', 'key4'])
+
+        cache.set('key5', 5)
+        self.assertEqual(cache.keys(), ['key5'])
@@ -13,6 +13,16 @@
 #  *******************************************************/
 
 import abc
+import logging
+from Queue import Queue, Empty
+from threading import Thread
+
+LOG = logging.getLogger('Logger')
+
+# Max messages passed to log_batch() at once
+LOG_BATCH = 200
+# Messages waiting in a partition, receiving blocks when full
+LOG_QUEUE_SIZE = 10000
 
 
 class LoggerPluginBase(object):
@@ -30,3 +40,60 @@ class LoggerPluginBase(object):
     @abc.abstractmethod
     def log(self, msg):
         pass
+
+    def log_batch(self, msgs):
+        # The messages of a session are passed in order
+        for msg in msgs:
+            self.log(msg)
+
+
+class LogPartitions(object):
+
+    """
+    Runs the logger on `count` threads. Messages are assigned to a thread
+    by session id, so the messages of a session are logged in order and
+    the sessions are logged in parallel. Each thread passes the messages
+    queued meanwhile to log_batch() at once.
+    """
+
+    def __init__(self, logger, count, batch_size=LOG_BATCH):
+        self.logger = logger
+        self.batch_size = batch_size
+        self.queues = [Queue(LOG_QUEUE_SIZE) for i in range(count)]
+        self.threads = []
+
+    def start(self):
+        for queue in self.queues:
+            thread = Thread(target=self._run, args=(queue,))
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, msg):
+        session_id = getattr(msg, 'session_id', None) or ''
+        self.queues[hash(session_id) % len(self.queues)].put(msg)
+
+    def stop(self):
+        # Logs the queued messages before exiting
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self, queue):
+        stopped = False
+        while not stopped:
+            msgs = [queue.get()]
+            while len(msgs) < self.batch_size:
+                try:
+                    msgs.append(queue.get_nowait())
+                except Empty:
+                    break
+            if None in msgs:
+                stopped = True
+                msgs = [msg for msg in msgs if msg is not None]
+            if not msgs:
+                continue
+            try:
+                self.logger.log_batch(msgs)
+            except Exception, ex:
+                LOG.exception(ex)
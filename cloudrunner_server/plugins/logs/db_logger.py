@@ -1,9 +1,8 @@
-from functools import wraps
 import json
 import logging
 import redis
 from sqlalchemy import create_engine, event
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import joinedload, scoped_session, sessionmaker
 
 from cloudrunner_server.api.model import *  # noqa
 from cloudrunner_server.plugins.logs.base import LoggerPluginBase
@@ -13,19 +12,8 @@ from cloudrunner_server.util.db import checkout_listener
 
 LOG = logging.getLogger('DB LOGGER')
 
-
-def wrap_error(f):
-    @wraps(f)
-    def wrapper(*args):
-        try:
-            self = args[0]
-            res = f(*args)
-            self.db.commit()
-            return res
-        except Exception, ex:
-            LOG.exception(ex)
-            self.db.rollback()
-    return wrapper
+# Messages stored in the DB, the rest go to the cache only
+DB_CONTROLS = ('NODERESULTS', 'FINISHEDMESSAGE', 'ENDMESSAGE')
 
 
 class DbLogger(LoggerPluginBase):
@@ -38,78 +26,123 @@ class DbLogger(LoggerPluginBase):
         self.r = redis.Redis(host=host, port=port, db=0)
 
     def set_context_from_config(self, recreate=None, **configuration):
-        session = scoped_session(sessionmaker())
         engine = create_engine(self.db_path, **configuration)
         if 'mysql+pymysql://' in self.db_path:
             event.listen(engine, 'checkout', checkout_listener)
-        session.bind = engine
-        metadata.bind = session.bind
+        # Bound for the sessions of all logger threads
+        session = scoped_session(sessionmaker(bind=engine))
+        metadata.bind = engine
         if recreate:
             # For tests: re-create tables
             metadata.create_all(engine)
         self.db = session
 
-    def _finalize(self, msg):
-        session_id = msg.session_id
-        org = msg.org
-        result = msg.result
+    def _get_runs(self, msgs):
+        # Loads the runs of the batch with their tasks in one query,
+        # returns {(session_id, org): run}
+        session_ids = set(msg.session_id for msg in msgs)
+        query = self.db.query(Run, Org.name).join(Task, Run.task).join(
+            User, Org).filter(Run.uuid.in_(session_ids)).options(
+            joinedload(Run.task).joinedload(Task.group).joinedload(
+                TaskGroup.deployment),
+            joinedload(Run.task).joinedload(Task.runs))
+        return dict(((run.uuid, org), run) for run, org in query)
+
+    def _store(self, msgs):
+        # One transaction for the batch. If it fails, the messages
+        # are stored one by one, so only the failing one is lost
         try:
-            task = self.db.query(Task).join(User, Org).join(
-                Run, Task.runs).filter(
-                    Run.uuid == session_id, Org.name == org).one()
-            if task.group.deployment:
-                task.group.deployment.status = 'Running'
-            run = [r for r in task.runs if r.uuid == session_id][0]
-            success = True
-            run.exec_end = timestamp()
-            task.exec_end = timestamp()
-            if msg.env:
-                run.env_out = json.dumps(msg.env)
-            for node, ret in result.items():
-                success = success and (str(ret['ret_code']) == '0')
-                rnode = RunNode(name=node, exit_code=ret['ret_code'],
-                                as_user=ret['remote_user'], run=run)
-                self.db.add(rnode)
-            if success:
-                run.exit_code = 0
-            else:
-                run.exit_code = 1
-            if all([r.exit_code != -99 for r in task.runs]):
-                task.status = LOG_STATUS.Finished
-                task.exit_code = int(any([bool(r.exit_code)
-                                          for r in task.runs]))
-            self.db.add(run)
-            self.db.add(task)
+            runs = self._get_runs(msgs)
+            for msg in msgs:
+                run = runs.get((msg.session_id, msg.org))
+                if not run:
+                    LOG.error("Run %s not found in org %s" % (
+                        msg.session_id, msg.org))
+                    continue
+                if msg.control == 'NODERESULTS':
+                    self._store_results(msg, run)
+                elif msg.control == 'FINISHEDMESSAGE':
+                    self._finalize(msg, run)
+                else:
+                    self._end(msg, run.task)
             self.db.commit()
         except Exception, ex:
-            LOG.error(ex)
             self.db.rollback()
+            if len(msgs) == 1:
+                LOG.error(ex)
+                return
+            for msg in msgs:
+                self._store([msg])
+
+    def _finalize(self, msg, run):
+        # Summary of the node results, sent before in NodeResults chunks
+        result = msg.result or {}
+        task = run.task
+        run.exec_end = timestamp()
+        if msg.env:
+            run.env_out = json.dumps(msg.env)
+        run.exit_code = int(bool(result.get('failed')))
+        self._end(msg, task)
+
+    def _store_results(self, msg, run):
+        names = [ret['node'] for ret in msg.results]
+        # A resumed session sends again the nodes finished before
+        stored = set(name for (name,) in self.db.query(
+            RunNode.name).filter(RunNode.run_id == run.id,
+                                 RunNode.name.in_(names)))
+        rows = []
+        for ret in msg.results:
+            if ret['node'] in stored:
+                continue
+            stored.add(ret['node'])
+            rows.append(dict(name=ret['node'], exit_code=ret['ret_code'],
+                             as_user=ret['remote_user'], run_id=run.id))
+        if rows:
+            # One executemany for the chunk
+            self.db.execute(RunNode.__table__.insert(), rows)
+
+    def _end(self, msg, task):
+        if task.group.deployment:
+            task.group.deployment.status = 'Running'
+        task.exec_end = timestamp()
+        if all([r.exit_code != -99 for r in task.runs]):
+            task.status = LOG_STATUS.Finished
+            task.exit_code = int(any([bool(r.exit_code)
+                                      for r in task.runs]))
 
-    def _end(self, msg):
-        session_id = msg.session_id
-        org = msg.org
+    def log(self, msg):
+        self.log_batch([msg])
+
+    def log_batch(self, msgs):
+        # Messages of one partition, in order of arrival. DB changes are
+        # committed first, the events are published after them
+        db_msgs = [msg for msg in msgs if msg.control in DB_CONTROLS]
+        if db_msgs:
+            self._store(db_msgs)
+
+        events = []
+        for msg in msgs:
+            LOG.debug(msg)
+            try:
+                self._cache(msg, events)
+            except Exception, ex:
+                LOG.exception(ex)
+
+        pipe = self.r.pipeline(transaction=False)
+        published = set()
+        for channel, data in events:
+            # One update is enough for the log chunks of a session
+            if (channel, data) in published:
+                continue
+            published.add((channel, data))
+            pipe.publish(channel, data)
         try:
-            task = self.db.query(Task).join(User, Org).join(
-                Run, Task.runs).filter(
-                    Run.uuid == session_id, Org.name == org).one()
-            if task.group.deployment:
-                task.group.deployment.status = 'Running'
-            task.exec_end = timestamp()
-            if all([r.exit_code != -99 for r in task.runs]):
-                task.status = LOG_STATUS.Finished
-                task.exit_code = int(any([bool(r.exit_code)
-                                          for r in task.runs]))
-            self.db.add(task)
-            self.db.commit()
+            pipe.execute()
         except Exception, ex:
-            LOG.error(ex)
-            self.db.rollback()
-
-    @wrap_error
-    def log(self, msg):
-        LOG.debug(msg)
+            LOG.exception(ex)
 
-        if msg.control == "SYSMESSAGE":
+    def _cache(self, msg, events):
+        if msg.control in ("SYSMESSAGE", "PIPEMESSAGE"):
             if msg.stdout:
                 log = msg.stdout
                 io = 'O'
@@ -119,48 +152,29 @@ class DbLogger(LoggerPluginBase):
             else:
                 # Empty
                 return
+            node = msg.node if msg.control == "PIPEMESSAGE" else '--'
             with self.cache.writer(msg.org, msg.session_id) as cache:
-                cache.store_log('--', msg.ts, log, msg.user, io, ttl=None)
-            self.r.publish('task:update', msg.session_id)
+                cache.store_log(node, msg.ts, log, msg.user, io, ttl=None)
+            events.append(('task:update', msg.session_id))
 
-        if msg.control == "PIPEMESSAGE":
-            if msg.stdout:
-                log = msg.stdout
-                io = 'O'
-            elif msg.stderr:
-                log = msg.stderr
-                io = 'E'
-            else:
-                # Empty
-                return
-            with self.cache.writer(msg.org, msg.session_id) as cache:
-                cache.store_log(msg.node, msg.ts, log, msg.user, io, ttl=None)
-            self.r.publish('task:update', msg.session_id)
+        elif msg.control == "NODERESULTS":
+            events.append(('task:update', msg.session_id))
 
         elif msg.control == "FINISHEDMESSAGE":
-            self._finalize(msg)
-            result = {'exit_code': 0, 'total_time': 0}
-            for node, data in msg.result.items():
-                result['exit_code'] = int(bool(result['exit_code']
-                                               | data['ret_code']))
-                result['total_time'] = max(result['exit_code'],
-                                           data['elapsed'])
-                result.setdefault('nodes', []).append(
-                    dict(node=node, exit_code=data['ret_code'],
-                         elapsed=data['elapsed'], as_user=data['remote_user']))
             with self.cache.writer(msg.org, msg.session_id) as cache:
-                cache.store_meta(result, msg.ts)
+                cache.store_meta(msg.result, msg.ts)
                 cache.incr(msg.org, "logs")
-
-            msg = dict(id=msg.session_id, env=msg.env)
-            self.r.publish("task:end", json.dumps(msg))
+                cache.end_log()
+            events.append(("task:end", json.dumps(dict(id=msg.session_id,
+                                                       env=msg.env))))
 
         elif msg.control == "ENDMESSAGE":
-            self._end(msg)
-            self.r.publish("deployment:end", msg.session_id)
+            with self.cache.writer(msg.org, msg.session_id) as cache:
+                cache.end_log()
+            events.append(("deployment:end", msg.session_id))
 
         elif msg.control == "INITIALMESSAGE":
             with self.cache.writer(msg.org, msg.session_id) as cache:
                 cache.prepare_log(msg.user, msg.ts)
                 cache.incr(msg.org, "logs")
-            self.r.publish('task:start', msg.session_id)
+            events.append(('task:start', msg.session_id))
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+import json
+from mock import call, MagicMock, Mock
+from sqlalchemy.pool import StaticPool
+
+from cloudrunner_server.api.model import *  # noqa
+from cloudrunner_server.core.message import (EndMessage, FinishedMessage,
+                                             NodeResults, PipeMessage)
+from cloudrunner_server.tests import base
+
+cache = MagicMock()
+
+
+def result(node, ret_code=0):
+    return dict(node=node, ret_code=ret_code, remote_user='root')
+
+
+class TestDbLogger(base.BaseTestCase):
+
+    modules = dict(base.BaseTestCase.modules)
+    modules['cloudrunner_server.util.cache'] = cache
+
+    def setUp(self):
+        from cloudrunner_server.plugins.logs.db_logger import DbLogger
+        self.logger = DbLogger(Mock(db='sqlite://', redis=None))
+        self.logger.set_context_from_config(
+            recreate=True, poolclass=StaticPool,
+            connect_args={'check_same_thread': False})
+        self.logger.r = MagicMock()
+        self.pipe = self.logger.r.pipeline.return_value
+        self.cache = self.logger.cache
+        self.cache.reset_mock()
+
+        db = self.logger.db
+        tier = UsageTier(name='tier', title='Tier', users=5, deployments=5)
+        org = Org(name='MyOrg', enabled=True, tier=tier)
+        user = User(username='user', email='user@domain.com', org=org)
+        group = TaskGroup(deployment=Deployment(name='dep', owner=user))
+        task = Task(owner=user, group=group, status=LOG_STATUS.Running)
+        db.add_all([Run(uuid='S1', task=task, exit_code=-99),
+                    Run(uuid='S2', task=task, exit_code=-99)])
+        db.commit()
+
+    def tearDown(self):
+        self.logger.db.remove()
+
+    def test_log_batch(self):
+        self.logger.log_batch([
+            PipeMessage(session_id='S1', org='MyOrg', node='node1',
+                        stdout='out1', ts=1, user='user'),
+            NodeResults(session_id='S1', org='MyOrg',
+                        results=[result('node1'), result('node2', 1)]),
+            PipeMessage(session_id='S1', org='MyOrg', node='node3',
+                        stdout='out3', ts=2, user='user'),
+            # Sent again by a resumed session
+            NodeResults(session_id='S1', org='MyOrg',
+                        results=[result('node2', 1), result('node3')]),
+            FinishedMessage(session_id='S1', org='MyOrg', ts=3, user='user',
+                            result=dict(failed=1), env={'KEY': 'value'}),
+            NodeResults(session_id='S2', org='MyOrg',
+                        results=[result('node4')]),
+            FinishedMessage(session_id='S2', org='MyOrg', ts=4, user='user',
+                            result=dict(failed=0), env={}),
+            EndMessage(session_id='S2', org='MyOrg')])
+
+        db = self.logger.db
+        nodes = sorted((node.run.uuid, node.name, node.exit_code)
+                       for node in db.query(RunNode))
+        self.assertEqual(nodes, [('S1', 'node1', 0), ('S1', 'node2', 1),
+                                 ('S1', 'node3', 0), ('S2', 'node4', 0)])
+        runs = dict((run.uuid, run) for run in db.query(Run))
+        self.assertEqual(runs['S1'].exit_code, 1)
+        self.assertEqual(json.loads(runs['S1'].env_out), {'KEY': 'value'})
+        self.assertEqual(runs['S2'].exit_code, 0)
+        self.assertEqual(runs['S2'].exec_end, 123456789)
+        task = db.query(Task).one()
+        self.assertEqual(task.status, LOG_STATUS.Finished)
+        self.assertEqual(task.exit_code, 1)
+        self.assertEqual(task.group.deployment.status, 'Running')
+
+        # Output goes to the cache only
+        self.assertEqual(self.cache.writer.call_args_list[:2],
+                         [call('MyOrg', 'S1'), call('MyOrg', 'S1')])
+        writer = self.cache.writer.return_value.__enter__.return_value
+        self.assertCount(writer.store_log.call_args_list, 2)
+        self.assertCount(writer.end_log.call_args_list, 3)
+        # One update per session
+        self.assertEqual(self.pipe.publish.call_args_list, [
+            call('task:update', 'S1'),
+            call('task:end', json.dumps(dict(id='S1',
+                                             env={'KEY': 'value'}))),
+            call('task:update', 'S2'),
+            call('task:end', json.dumps(dict(id='S2', env={}))),
+            call('deployment:end', 'S2')])
+        self.pipe.execute.assert_called_once_with()
+
+    def test_log_batch_retry(self):
+        self.logger.log_batch([
+            NodeResults(session_id='S1', org='MyOrg',
+                        results=[result('node1')]),
+            # Fails the batch transaction
+            NodeResults(session_id='S1', org='MyOrg',
+                        results=[dict(node='node2')]),
+            # Not in the org
+            NodeResults(session_id='S2', org='MyOrg2',
+                        results=[result('node3')]),
+            FinishedMessage(session_id='S1', org='MyOrg', ts=1, user='user',
+                            result=dict(failed=0), env={})])
+
+        # Stored one by one, without the failed ones
+        db = self.logger.db
+        self.assertEqual([node.name for node in db.query(RunNode)],
+                         ['node1'])
+        runs = dict((run.uuid, run) for run in db.query(Run))
+        self.assertEqual(runs['S1'].exit_code, 0)
+        self.assertEqual(runs['S2'].exit_code, -99)
+        # S2 is still running
+        self.assertEqual(db.query(Task).one().status, LOG_STATUS.Running)
+        self.assertEqual(self.pipe.publish.call_args_list, [
+            call('task:update', 'S1'),
+            call('task:update', 'S2'),
+            call('task:end', json.dumps(dict(id='S1', env={})))])
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+from mock import Mock
+from threading import current_thread, Event
+
+from cloudrunner_server.plugins.logs.base import LogPartitions
+from cloudrunner_server.tests import base
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.batches = []
+        self.started = Event()
+        self.proceed = Event()
+
+    def log_batch(self, msgs):
+        self.started.set()
+        self.proceed.wait(5)
+        self.batches.append((current_thread().name, msgs))
+
+
+def message(session_id, seq):
+    return Mock(session_id=session_id, seq=seq)
+
+
+class TestLogPartitions(base.BaseTestCase):
+
+    def test_partitions(self):
+        logger = Logger()
+        partitions = LogPartitions(logger, 4, batch_size=10)
+        partitions.start()
+        # The first batch blocks its partition, the rest is queued
+        partitions.put(message('S0', 0))
+        logger.started.wait(5)
+        for seq in range(1, 50):
+            partitions.put(message('S%s' % (seq % 5), seq))
+        logger.proceed.set()
+        partitions.stop()
+
+        sessions = {}
+        for thread, msgs in logger.batches:
+            self.assertTrue(len(msgs) <= 10)
+            for msg in msgs:
+                sessions.setdefault(msg.session_id, []).append(
+                    (thread, msg.seq))
+        self.assertEqual(sorted(sessions), ['S0', 'S1', 'S2', 'S3', 'S4'])
+        for session_id, logged in sessions.items():
+            # Logged in order, by one thread
+            self.assertEqual(len(set(t for t, _ in logged)), 1)
+            seqs = [seq for _, seq in logged]
+            self.assertEqual(seqs, range(int(session_id[1:]), 50, 5))
+        # Queued messages were logged in batches
+        self.assertTrue(len(logger.batches) < 50)
+
+    def test_finish_after_output(self):
+        # What a finishing session relies on instead of a delay
+        logger = Logger()
+        logger.proceed.set()
+        partitions = LogPartitions(logger, 4, batch_size=3)
+        partitions.start()
+        for seq in range(20):
+            partitions.put(message('S1', seq))
+            partitions.put(message('S2', seq))
+        partitions.put(message('S1', 'FINISHED'))
+        partitions.put(message('S1', 'END'))
+        partitions.stop()
+
+        logged = [msg.seq for _, msgs in logger.batches for msg in msgs
+                  if msg.session_id == 'S1']
+        self.assertEqual(logged, range(20) + ['FINISHED', 'END'])
@@ -13,14 +13,21 @@
 #  *******************************************************/
 
 import abc
+import bisect
 from hashlib import md5
+import heapq
 import logging
+import random
+import re
 import time
 
 from cloudrunner.plugins.transport.base import TransportBackend
 
 LOG = logging.getLogger()
 
+# Same split as the node side target matcher
+TARGET_SPLIT = re.compile(r'\s+|,|;')
+
 
 class ServerTransportBackend(TransportBackend):
 
@@ -29,7 +36,7 @@ class ServerTransportBackend(TransportBackend):
         pass
 
     @abc.abstractmethod
-    def register_session(self, session_id):
+    def register_session(self, session_id, ident=None):
         pass
 
     @abc.abstractmethod
@@ -48,6 +55,32 @@ class ServerTransportBackend(TransportBackend):
     def subscribe_fanout(self, endpoint, sub_patterns=None, *args, **kwargs):
         pass
 
+    def resolve_targets(self, org, targets):
+        # Names of the live nodes matching targets,
+        # None if the backend cannot tell
+        return None
+
+
+def match_nodes(names, targets):
+    """
+    Matches node names against a target string, with the same rules
+    as the node side matcher. Returns None if the target has selectors,
+    which only the nodes can evaluate
+    """
+    patterns = []
+    for target in TARGET_SPLIT.split(targets):
+        if not target:
+            continue
+        if '=' in target or '$' in target:
+            return None
+        try:
+            patterns.append(re.compile('^%s$' % target.replace(
+                ".", "\\.").replace("*", ".*"), re.I))
+        except re.error:
+            return None
+    return set(name for name in names
+               if any(p.match(name) for p in patterns))
+
 
 class Node(object):
 
@@ -66,23 +99,28 @@ class Node(object):
 
 class Tenant(object):
 
+    # Seconds a node may lag behind the tenant refresh before it is expired
+    expire_grace = 15
+
     def __init__(self, name):
         self.name = str(name)
         m = md5()
         m.update(name)
         self.id = str(m.hexdigest())
         del m
-        self.nodes = []
+        # name -> Node
+        self.nodes = {}
+        # (refreshed, name) min-heap, stale entries are dropped lazily
+        self._expiry = []
         self.refresh()
 
     def __delitem__(self, node_id):
-        if node_id in self.nodes:
-            self.nodes.remove(node_id)
+        self.nodes.pop(node_id, None)
 
     def __repr__(self):
         _repr = '[%s] [%.f sec ago]\n' % (
             self.id, time.time() - self.refreshed)
-        for node in self.nodes:
+        for node in self.nodes.values():
             _repr = "%s%s\tLast seen: %.f sec ago\n" % (_repr, node.name,
                                                         node.last_seen)
         return _repr
@@ -90,40 +128,61 @@ class Tenant(object):
     def __eq__(self, _id):
         return self.id == _id
 
+    def node_topic(self, node):
+        # PUB topic of a single node, not prefixed by the org topic
+        return md5('%s:%s' % (self.id, node)).hexdigest()
+
     def push(self, node):
         new_node = False
-        if node not in self.nodes:
-            self.nodes.append(Node(node))
+        _node = self.nodes.get(node)
+        if _node is None:
+            _node = self.nodes[node] = Node(node)
             new_node = True
-        self.nodes[self.nodes.index(node)].refreshed = time.time()
+        _node.refreshed = time.time()
+        heapq.heappush(self._expiry, (_node.refreshed, _node.name))
+        if len(self._expiry) > 2 * len(self.nodes) + 64:
+            self._compact()
         return new_node
 
     def pop(self, node):
-        if node in self.nodes:
-            self.nodes.remove(Node(node))
+        self.nodes.pop(node, None)
 
     def refresh(self, adjust=0):
         self.refreshed = time.time() + adjust
 
     def update(self, node, usage):
-        self.nodes[self.nodes.index(node)].usage = usage
+        self.nodes[node].usage = usage
 
     def active_nodes(self, adjust=0):
-        return [node for node in self.nodes
+        return [node for node in self.nodes.values()
                 if node.refreshed + adjust > self.refreshed]
 
     def inactive_nodes(self):
-        active = self.active_nodes(adjust=15)
-        inactive_nodes = [item for item in self.nodes if item not in active]
-        for node in inactive_nodes:
-            self.pop(node)
+        deadline = self.refreshed - self.expire_grace
+        inactive_nodes = []
+        while self._expiry and self._expiry[0][0] <= deadline:
+            refreshed, name = heapq.heappop(self._expiry)
+            node = self.nodes.get(name)
+            if node is None or node.refreshed != refreshed:
+                # Node was refreshed or dropped after this entry
+                continue
+            inactive_nodes.append(self.nodes.pop(name))
         return inactive_nodes
 
+    def _compact(self):
+        self._expiry = [(node.refreshed, node.name)
+                        for node in self.nodes.values()]
+        heapq.heapify(self._expiry)
+
 
 class TenantDict(dict):
 
     def __init__(self, refresh=None, *args, **kwargs):
+        # Tenant.id -> name
+        self.ids = {}
         super(TenantDict, self).__init__(*args, **kwargs)
+        for name, tenant in self.items():
+            self.ids[tenant.id] = name
         self.refresh = refresh
 
     def __getitem__(self, key):
@@ -134,6 +193,30 @@ class TenantDict(dict):
             self.refresh()
             return super(TenantDict, self).__getitem__(key)
 
+    def __setitem__(self, key, tenant):
+        self._unindex(key)
+        super(TenantDict, self).__setitem__(key, tenant)
+        self.ids[tenant.id] = key
+
+    def __delitem__(self, key):
+        self._unindex(key)
+        super(TenantDict, self).__delitem__(key)
+
+    def pop(self, key, *default):
+        self._unindex(key)
+        return super(TenantDict, self).pop(key, *default)
+
+    def _unindex(self, key):
+        tenant = super(TenantDict, self).get(key)
+        if tenant is not None:
+            self.ids.pop(tenant.id, None)
+
+    def by_id(self, tenant_id):
+        name = self.ids.get(tenant_id)
+        if name is None:
+            return None
+        return super(TenantDict, self).get(name)
+
     def purge_expired(self):
         exp = []
         for item in self.values():
@@ -142,3 +225,187 @@ class TenantDict(dict):
                 exp.append((item.name, expired))
 
         return exp
+
+
+class HeartbeatScheduler(object):
+
+    """
+    Spreads tenant heartbeats over the heartbeat interval. Each tenant
+    gets a fixed slot in the interval, taken from its id, and is pinged
+    at slot + random jitter.
+    """
+
+    def __init__(self, interval, jitter=0):
+        self.interval = interval
+        self.jitter = min(jitter, interval / 2.)
+        # (fire time, slot time, tenant id) min-heap
+        self._queue = []
+        # tenant id -> time of last ping
+        self._scheduled = {}
+
+    def _slot(self, tenant_id):
+        return int(tenant_id[:8], 16) % 10000 / 10000. * self.interval
+
+    def _push(self, tenant_id, slot_time):
+        fire_time = slot_time + random.uniform(0, self.jitter)
+        heapq.heappush(self._queue, (fire_time, slot_time, tenant_id))
+
+    def sync(self, tenants, now=None):
+        # Schedule newly registered tenants in their next slot
+        now = now or time.time()
+        for tenant_id in tenants.ids.keys():
+            if tenant_id in self._scheduled:
+                continue
+            slot_time = now - now % self.interval + self._slot(tenant_id)
+            if slot_time <= now:
+                slot_time += self.interval
+            self._scheduled[tenant_id] = None
+            self._push(tenant_id, slot_time)
+
+    def next_due(self):
+        if not self._queue:
+            return None
+        return self._queue[0][0]
+
+    def due(self, tenants, now=None):
+        """
+        Returns [(tenant, since)] of tenants to ping now, where since is
+        the time passed from the previous ping of the tenant
+        """
+        now = now or time.time()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            _, slot_time, tenant_id = heapq.heappop(self._queue)
+            tenant = tenants.by_id(tenant_id)
+            if tenant is None:
+                # Un-registered tenant
+                self._scheduled.pop(tenant_id, None)
+                continue
+            last_ping = self._scheduled[tenant_id]
+            if last_ping is None:
+                since = self.interval
+            else:
+                since = now - last_ping
+            self._scheduled[tenant_id] = now
+            due.append((tenant, since))
+            slot_time += self.interval
+            while slot_time <= now:
+                # Skip slots missed while busy
+                slot_time += self.interval
+            self._push(tenant_id, slot_time)
+        return due
+
+
+class HashRing(object):
+
+    """
+    Consistent hash ring of master hosts. Each org is owned by the first
+    host point after the org hash, so adding or removing a host only
+    moves the orgs of that host.
+    """
+
+    def __init__(self, hosts=(), replicas=64):
+        self.replicas = replicas
+        self.hosts = set()
+        # sorted point hashes
+        self._points = []
+        # point hash -> host
+        self._owners = {}
+        for host in hosts:
+            self.add(host)
+
+    def __contains__(self, host):
+        return host in self.hosts
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def _hash(self, key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def add(self, host):
+        if host in self.hosts:
+            return False
+        self.hosts.add(host)
+        for i in range(self.replicas):
+            point = self._hash('%s-%s' % (host, i))
+            self._owners[point] = host
+            bisect.insort(self._points, point)
+        return True
+
+    def remove(self, host):
+        if host not in self.hosts:
+            return False
+        self.hosts.remove(host)
+        self._points = [point for point in self._points
+                        if self._owners[point] != host]
+        self._owners = dict((point, self._owners[point])
+                            for point in self._points)
+        return True
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        idx = bisect.bisect(self._points, self._hash(key))
+        return self._owners[self._points[idx % len(self._points)]]
+
+
+class OrgMasters(object):
+
+    """
+    Masters holding nodes of an org, as seen by the org owner from the
+    node messages forwarded to it. Entries expire after `expire` sec.
+    """
+
+    def __init__(self, expire):
+        self.expire = expire
+        # org -> {master host: last seen}
+        self.hosts = {}
+        # org -> {node: (master host, last seen)}
+        self.nodes = {}
+
+    def seen(self, org, host, node=None, now=None):
+        now = now or time.time()
+        self.hosts.setdefault(org, {})[host] = now
+        if node:
+            self.nodes.setdefault(org, {})[node.lower()] = (host, now)
+
+    def prune(self, now=None):
+        now = now or time.time()
+        for org, hosts in self.hosts.items():
+            for host, ts in hosts.items():
+                if now - ts > self.expire:
+                    hosts.pop(host)
+            if not hosts:
+                self.hosts.pop(org)
+        for org, nodes in self.nodes.items():
+            for node, (host, ts) in nodes.items():
+                if now - ts > self.expire:
+                    nodes.pop(node)
+            if not nodes:
+                self.nodes.pop(org)
+
+    def split(self, org, nodes, local, skip=None):
+        """
+        Returns {master host: nodes} to publish a job for `nodes` to.
+        A node seen on a master goes to that master only, other nodes
+        go to all masters of the org, including `local`. Nodes held by
+        `skip` are left out. With nodes=None (selectors) all masters get
+        the job as is, as {master host: None}
+        """
+        hosts = set(self.hosts.get(org, {}))
+        hosts.add(local)
+        hosts.discard(skip)
+        if nodes is None:
+            return dict((host, None) for host in hosts)
+        held = self.nodes.get(org, {})
+        split = {}
+        for node in nodes:
+            holder = held.get(node.lower())
+            if holder:
+                targets = [holder[0]] if holder[0] in hosts else []
+            else:
+                targets = hosts
+            for host in targets:
+                split.setdefault(host, []).append(node)
+        return split
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from mock import Mock
+import msgpack
+import zmq
+
+from cloudrunner_server.core.message import Envelope
+from cloudrunner_server.plugins.transport.tlszmq import (_EnvelopeContext,
+                                                         TLSZmqServerSocket)
+from cloudrunner_server.tests import base
+
+
+class TestEnvelope(base.BaseTestCase):
+
+    def test_pack_unpack(self):
+        envelope = Envelope.pack('session_id', 'node1', 'MyOrg', '\x00ab')
+        self.assertEqual(Envelope.unpack(envelope),
+                         ('session_id', 'node1', 'MyOrg', '\x00ab'))
+
+    def test_defaults(self):
+        envelope = Envelope.pack('_CTRL')
+        self.assertEqual(Envelope.unpack(envelope), ('_CTRL', '', '', ''))
+
+    def test_envelope_socket(self):
+        context = zmq.Context()
+        receiver = context.socket(zmq.DEALER)
+        receiver.bind('inproc://envelope')
+        sender = _EnvelopeContext.shadow(context.underlying).socket(
+            zmq.DEALER)
+        sender.connect('inproc://envelope')
+
+        # Headers applied by the TLS server, peer from the certificate
+        hdr = dict(dest='session_id', ident='\x00ab', peer=u'node1',
+                   org=u'MyOrg')
+        data = msgpack.packb(hdr) + msgpack.packb([1]) + \
+            msgpack.packb(dict(hdr, dest='_CTRL')) + msgpack.packb([2])
+        sender.send(data)
+
+        for dest, body in (('session_id', [1]), ('_CTRL', [2])):
+            self.assertTrue(receiver.poll(1000))
+            envelope, packed = receiver.recv_multipart()
+            self.assertEqual(Envelope.unpack(envelope),
+                             (dest, 'node1', 'MyOrg', '\x00ab'))
+            unpacker = msgpack.Unpacker()
+            unpacker.feed(packed)
+            self.assertEqual(unpacker.unpack()['dest'], dest)
+            self.assertEqual(unpacker.unpack(), body)
+
+        sender.close()
+        receiver.close()
+        context.term()
+
+    def test_unicode_subject(self):
+        server = TLSZmqServerSocket(None, 'inproc://ssl-worker', None, None)
+        server.conns['\x00ab'] = Mock(node=None, org=None)
+        x509 = Mock()
+        x509.get_serial_number.return_value = 0xCAFE
+        x509.get_subject.return_value = Mock(CN=u'n\xf6de', O=u'\xd6rg')
+
+        for i in range(2):
+            self.assertEqual(server._update_conn('\x00ab', x509),
+                             ('n\xc3\xb6de', '\xc3\x96rg'))
+        # Read once per certificate
+        self.assertEqual(x509.get_subject.call_count, 1)
+        self.assertEqual(server.conns['\x00ab'].node, 'n\xc3\xb6de')
+
+        TLSZmqServerSocket.CRL.add(0xCAFE)
+        try:
+            self.assertEqual(server._update_conn('\x00ab', x509),
+                             (None, None))
+            self.assertIsNone(server.conns['\x00ab'].node)
+        finally:
+            TLSZmqServerSocket.CRL.discard(0xCAFE)
+
+        context = zmq.Context()
+        receiver = context.socket(zmq.DEALER)
+        receiver.bind('inproc://envelope-unicode')
+        sender = _EnvelopeContext.shadow(context.underlying).socket(
+            zmq.DEALER)
+        sender.connect('inproc://envelope-unicode')
+
+        hdr = dict(dest='session_id', ident='\x00ab', peer=u'n\xf6de',
+                   org=u'\xd6rg')
+        sender.send(msgpack.packb(hdr) + msgpack.packb([1]))
+        self.assertTrue(receiver.poll(1000))
+        envelope, packed = receiver.recv_multipart()
+        self.assertEqual(Envelope.unpack(envelope),
+                         ('session_id', 'n\xc3\xb6de', '\xc3\x96rg',
+                          '\x00ab'))
+        self.assertEqual(packed, msgpack.packb(hdr) + msgpack.packb([1]))
+
+        sender.close()
+        receiver.close()
+        context.term()
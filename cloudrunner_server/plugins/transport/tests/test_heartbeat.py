@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from cloudrunner_server.plugins.transport.base import (HeartbeatScheduler,
+                                                       Tenant, TenantDict)
+from cloudrunner_server.tests import base
+
+
+class TestHeartbeatScheduler(base.BaseTestCase):
+
+    def _tenants(self, count):
+        tenants = TenantDict()
+        for i in range(count):
+            name = 'Org%s' % i
+            tenants[name] = Tenant(name)
+        return tenants
+
+    def test_staggered(self):
+        tenants = self._tenants(100)
+        sched = HeartbeatScheduler(30)
+        sched.sync(tenants, now=3000)
+
+        fired = []
+        for tick in range(1, 31):
+            fired.append(len(sched.due(tenants, now=3000 + tick)))
+        # every tenant is pinged once per interval
+        self.assertEqual(sum(fired), 100)
+        # and pings are spread over the interval
+        self.assertTrue(max(fired) < 20)
+
+    def test_jitter(self):
+        tenants = self._tenants(1)
+        sched = HeartbeatScheduler(30, jitter=100)
+        self.assertEqual(sched.jitter, 15)
+        sched.sync(tenants, now=3000)
+        self.assertTrue(3000 < sched.next_due() <= 3030 + 15)
+
+    def test_since_last_ping(self):
+        tenants = self._tenants(1)
+        sched = HeartbeatScheduler(30)
+        sched.sync(tenants, now=3000)
+        first = sched.next_due()
+
+        due = sched.due(tenants, now=first)
+        self.assertEqual(due, [(tenants['Org0'], 30)])
+        self.assertEqual(sched.next_due(), first + 30)
+
+        # Missed slots are skipped
+        due = sched.due(tenants, now=first + 75)
+        self.assertEqual(due, [(tenants['Org0'], 75)])
+        self.assertEqual(sched.next_due(), first + 90)
+
+    def test_unregistered(self):
+        tenants = self._tenants(2)
+        sched = HeartbeatScheduler(30)
+        sched.sync(tenants, now=3000)
+        del tenants['Org1']
+
+        due = sched.due(tenants, now=3030)
+        self.assertEqual(due, [(tenants['Org0'], 30)])
+        self.assertCount(sched._queue, 1)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from cloudrunner_server.plugins.transport.base import HashRing, OrgMasters
+from cloudrunner_server.tests import base
+
+ORGS = ['org%s' % i for i in range(1000)]
+
+
+class TestHashRing(base.BaseTestCase):
+
+    def test_owner(self):
+        self.assertIsNone(HashRing().owner('org1'))
+
+        ring = HashRing(['master1', 'master2', 'master3'])
+        owners = dict((org, ring.owner(org)) for org in ORGS)
+        # Same mapping on every master
+        ring2 = HashRing(['master3', 'master1', 'master2'])
+        self.assertEqual(owners,
+                         dict((org, ring2.owner(org)) for org in ORGS))
+
+        # Orgs are spread over all masters
+        for host in ('master1', 'master2', 'master3'):
+            self.assertTrue(owners.values().count(host) > 200)
+
+    def test_rebalance(self):
+        ring = HashRing(['master1', 'master2', 'master3'])
+        owners = dict((org, ring.owner(org)) for org in ORGS)
+
+        self.assertTrue(ring.remove('master2'))
+        self.assertFalse(ring.remove('master2'))
+        self.assertFalse('master2' in ring)
+        for org in ORGS:
+            if owners[org] != 'master2':
+                # Only the orgs of the removed master move
+                self.assertEqual(ring.owner(org), owners[org])
+            else:
+                self.assertNotEqual(ring.owner(org), 'master2')
+
+        self.assertTrue(ring.add('master2'))
+        self.assertEqual(owners,
+                         dict((org, ring.owner(org)) for org in ORGS))
+
+
+class TestOrgMasters(base.BaseTestCase):
+
+    def test_shared_node(self):
+        # master1 owns the org, node1 is held by both masters and its
+        # messages arrive through master2
+        masters = OrgMasters(expire=30)
+        masters.seen('org1', 'master2', 'Node1', now=100)
+
+        # Job from master2, published there to node1
+        self.assertEqual(
+            masters.split('org1', ['node1'], 'master1', skip='master2'),
+            {})
+        # Job on the owner, node1 gets it from master2 only
+        self.assertEqual(
+            masters.split('org1', ['node1', 'node2'], 'master1',
+                          skip='master1'),
+            {'master2': ['node1', 'node2']})
+
+    def test_split(self):
+        masters = OrgMasters(expire=30)
+        masters.seen('org1', 'master2', 'node1', now=100)
+        masters.seen('org1', 'master2', 'node2', now=100)
+        masters.seen('org1', 'master3', 'node3', now=100)
+
+        self.assertEqual(
+            masters.split('org1', ['node1', 'node2', 'node4'], 'master1',
+                          skip='master2'),
+            {'master1': ['node4'], 'master3': ['node4']})
+        self.assertEqual(
+            masters.split('org1', ['node1', 'node3'], 'master1',
+                          skip='master1'),
+            {'master2': ['node1'], 'master3': ['node3']})
+        # Selectors go to all masters
+        self.assertEqual(
+            masters.split('org1', None, 'master1', skip='master3'),
+            {'master1': None, 'master2': None})
+
+    def test_prune(self):
+        masters = OrgMasters(expire=30)
+        masters.seen('org1', 'master2', 'node1', now=100)
+        masters.seen('org1', 'master3', now=120)
+        masters.prune(now=140)
+        self.assertEqual(masters.hosts, {'org1': {'master3': 120}})
+        self.assertEqual(masters.nodes, {})
+        # node1 is not known anymore, every master of the org gets it
+        self.assertEqual(
+            masters.split('org1', ['node1'], 'master1', skip='master1'),
+            {'master3': ['node1']})
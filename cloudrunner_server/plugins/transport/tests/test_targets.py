@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from cloudrunner_server.plugins.transport.base import match_nodes, Tenant
+from cloudrunner_server.tests import base
+
+NODES = ['web1', 'Web2', 'db1', 'db.prod']
+
+
+class TestTargets(base.BaseTestCase):
+
+    def test_match_nodes(self):
+        self.assertEqual(match_nodes(NODES, 'web1'), set(['web1']))
+        self.assertEqual(match_nodes(NODES, 'WEB*'), set(['web1', 'Web2']))
+        self.assertEqual(match_nodes(NODES, 'web1, db1;missing'),
+                         set(['web1', 'db1']))
+        # Dots are not wildcards
+        self.assertEqual(match_nodes(NODES, 'db.prod dbxprod'),
+                         set(['db.prod']))
+        self.assertEqual(match_nodes(NODES, 'missing'), set())
+
+    def test_selectors(self):
+        # Evaluated by the nodes only
+        self.assertIsNone(match_nodes(NODES, 'web1 os=linux'))
+        self.assertIsNone(match_nodes(NODES, '$NEXT_NODE'))
+        self.assertIsNone(match_nodes(NODES, 'web[1'))
+
+    def test_node_topic(self):
+        tenant = Tenant('org1')
+        topic = tenant.node_topic('web1')
+        self.assertEqual(topic, Tenant('org1').node_topic('web1'))
+        self.assertNotEqual(topic, tenant.node_topic('web2'))
+        self.assertNotEqual(topic, Tenant('org2').node_topic('web1'))
+        # Nodes subscribed to the org topic do not get it
+        self.assertFalse(topic.startswith(tenant.id))
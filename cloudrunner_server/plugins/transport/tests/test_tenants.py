@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+from mock import patch
+
+from cloudrunner_server.plugins.transport.base import Tenant, TenantDict
+from cloudrunner_server.tests import base
+
+
+class TestTenants(base.BaseTestCase):
+
+    def test_push_update(self):
+        tenant = Tenant('MyOrg')
+        self.assertTrue(tenant.push('node1'))
+        self.assertFalse(tenant.push('node1'))
+        self.assertTrue(tenant.push('node2'))
+        tenant.update('node1', {'cpu': 1})
+        self.assertEqual(tenant.nodes['node1'].usage, {'cpu': 1})
+        self.assertCount(tenant.nodes, 2)
+
+        tenant.pop('node2')
+        tenant.pop('node3')
+        self.assertEqual(tenant.nodes.keys(), ['node1'])
+
+    @patch('cloudrunner_server.plugins.transport.base.time')
+    def test_purge_expired(self, _time):
+        _time.time.return_value = 1000
+        tenants = TenantDict()
+        tenants['MyOrg'] = Tenant('MyOrg')
+        tenants['MyOrg'].push('node1')
+        tenants['MyOrg'].push('node2')
+        tenants['MyOrg'].push('node3')
+
+        _time.time.return_value = 1030
+        tenants['MyOrg'].push('node2')
+        tenants['MyOrg'].pop('node3')
+        tenants['MyOrg'].refresh(adjust=-10)
+
+        expired = tenants.purge_expired()
+        self.assertEqual(len(expired), 1)
+        self.assertEqual(expired[0][0], 'MyOrg')
+        self.assertEqual([n.name for n in expired[0][1]], ['node1'])
+        self.assertEqual(tenants['MyOrg'].nodes.keys(), ['node2'])
+        self.assertEqual(tenants.purge_expired(), [])
+
+    def test_tenant_id_index(self):
+        tenants = TenantDict()
+        tenants['MyOrg'] = Tenant('MyOrg')
+        tenants['MyOrg2'] = Tenant('MyOrg2')
+        org_id = tenants['MyOrg'].id
+
+        self.assertEqual(tenants.by_id(org_id).name, 'MyOrg')
+        self.assertIsNone(tenants.by_id('missing'))
+
+        tenants.pop('MyOrg')
+        self.assertIsNone(tenants.by_id(org_id))
+        del tenants['MyOrg2']
+        self.assertEqual(tenants.ids, {})
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+from mock import Mock, patch
+import time
+
+from cloudrunner_server.plugins.transport.base import Tenant, TenantDict
+from cloudrunner_server.plugins.transport.zmq_transport import (
+    ZmqTransport, tls_worker_count)
+from cloudrunner_server.tests import base
+
+
+class TestZmqTransport(base.BaseTestCase):
+
+    def setUp(self):
+        # Only the state used by the tested methods
+        self.transport = ZmqTransport.__new__(ZmqTransport)
+        self.transport.proxies = None
+        self.transport.heartbeat_timeout = 30
+        self.transport.started = time.time() - 60
+        self.transport.tenants = TenantDict(refresh=Mock())
+        self.transport.tenants['org1'] = Tenant('org1')
+        self.transport.node_topics = {}
+        self.transport.subscribed = set()
+        self.tenant = self.transport.tenants['org1']
+        self.tenant.push('web1')
+        self.tenant.push('web2')
+
+    def test_resolve_targets(self):
+        resolve = self.transport.resolve_targets
+        self.assertEqual(resolve('org1', 'web*'), set(['web1', 'web2']))
+        self.assertEqual(resolve('org1', 'web2 db1'), set(['web2']))
+        # No live match, the nodes match the target
+        self.assertIsNone(resolve('org1', 'db1'))
+        self.assertIsNone(resolve('org2', 'web1'))
+
+    def test_resolve_targets_cold(self):
+        # Nodes did not report since the start
+        self.transport.started = time.time() - 10
+        self.assertIsNone(self.transport.resolve_targets('org1', 'web1'))
+
+    def test_forget_node(self):
+        topic = self.tenant.node_topic('web1')
+        self.transport.node_topics[topic] = time.time()
+        self.transport.node_topics[self.tenant.node_topic('web2')] = 1
+        self.transport.subscribed.add(topic)
+
+        self.transport._forget_node('org1', 'web1')
+        self.transport._forget_node('org2', 'web1')
+        self.assertEqual(self.transport.node_topics.keys(),
+                         [self.tenant.node_topic('web2')])
+        # Dropped by the unsubscribe event only
+        self.assertEqual(self.transport.subscribed, set([topic]))
+
+    def _hb(self, peer, control):
+        msg = Mock(control=control, usage={})
+        msg.hdr.org = 'org1'
+        msg.hdr.peer = peer
+        return msg
+
+    def test_heartbeats_last_occurrence(self):
+        self.transport.db = Mock()
+        self.transport.ccont = Mock()
+        self.transport.node_registered_queue = Mock()
+
+        self.transport.heartbeats([self._hb('web3', 'HBR'),
+                                   self._hb('web3', 'QUIT'),
+                                   self._hb('web3', 'HBR')])
+        self.assertIn('web3', self.tenant.nodes)
+
+        self.transport.heartbeats([self._hb('web1', 'HBR'),
+                                   self._hb('web1', 'PING'),
+                                   self._hb('web1', 'QUIT')])
+        self.assertNotIn('web1', self.tenant.nodes)
+        self.assertEqual(self.transport.node_registered_queue.send.call_count,
+                         1)
+
+    @patch('cloudrunner_server.plugins.transport.zmq_transport.cpu_count')
+    def test_tls_worker_count(self, cpu_count):
+        cpu_count.return_value = 1
+        self.assertEqual(tls_worker_count(Mock(tls_worker_count=None)), 1)
+        cpu_count.return_value = 4
+        self.assertEqual(tls_worker_count(Mock(tls_worker_count=None)), 4)
+        self.assertEqual(tls_worker_count(Mock(tls_worker_count='2')), 2)
+        cpu_count.side_effect = NotImplementedError
+        self.assertEqual(tls_worker_count(Mock(tls_worker_count=None)), 1)
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+TLS worker process of Router.tls_balancer(). Started as a new program,
+not forked, so it doesn't inherit the contexts, DB engines and threads
+of the dispatcher:
+
+    python -m cloudrunner_server.plugins.transport.tls_worker \
+        CONFIG NODE_URI PROC_URI
+"""
+
+import logging
+import os
+from os import path as p
+import signal
+import sys
+from threading import Event, Thread
+import zmq
+
+from cloudrunner import LOG_LOCATION
+from cloudrunner.util.config import Config
+from cloudrunner.util.logconfig import configure_loggers
+
+from cloudrunner_server.plugins.transport.tlszmq import watch_crl
+from cloudrunner_server.plugins.transport.zmq_transport import \
+    tls_server_socket
+
+LOG = logging.getLogger('TLS Worker')
+
+
+def watch_parent(ppid, stop_event, interval=1):
+    # Not a child of the dispatcher any more, it was killed
+    while not stop_event.wait(interval):
+        if os.getppid() != ppid:
+            LOG.error("Dispatcher %s exited, stopping" % ppid)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+def tls_worker(config, node_uri, proc_uri):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    context = zmq.Context()
+    node_sock = context.socket(zmq.DEALER)
+    node_sock.connect(node_uri)
+
+    stopped = Event()
+    crl_watcher = Thread(target=watch_crl, args=(
+        p.join(p.dirname(p.abspath(config.security.ca)), 'crl'), stopped))
+    crl_watcher.daemon = True
+    crl_watcher.start()
+    parent_watcher = Thread(target=watch_parent, args=(os.getppid(), stopped))
+    parent_watcher.daemon = True
+    parent_watcher.start()
+
+    tls = tls_server_socket(config, node_sock, proc_uri)
+    try:
+        tls.start()
+    except KeyboardInterrupt:
+        pass
+    except Exception, ex:
+        LOG.exception(ex)
+    stopped.set()
+    context.term()
+
+
+def main():
+    config_file, node_uri, proc_uri = sys.argv[1:4]
+    config = Config(config_file)
+    if config.verbose_level:
+        configure_loggers(getattr(logging, config.verbose_level, 'INFO'),
+                          LOG_LOCATION)
+    else:
+        configure_loggers(logging.DEBUG if config.verbose else logging.INFO,
+                          LOG_LOCATION)
+    tls_worker(config, node_uri, proc_uri)
+
+
+if __name__ == '__main__':
+    main()
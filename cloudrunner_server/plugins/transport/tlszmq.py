@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import logging
+import msgpack
+import os
+import zmq
+
+from cloudrunner.util import tlszmq
+
+from cloudrunner_server.core.message import Envelope
+from cloudrunner_server.util.crl import CrlJournal
+from cloudrunner_server.util.lru import LRUCache
+
+LOGS = logging.getLogger('TLSZmq Server')
+
+
+# crl file -> CrlJournal
+_journals = {}
+
+
+def load_crl(crl_file):
+    # Load newly revoked serial numbers into the shared CRL
+    journal = _journals.get(crl_file)
+    if journal is None:
+        journal = _journals[crl_file] = CrlJournal(
+            crl_file, serials=TLSZmqServerSocket.CRL)
+    return journal.read()
+
+
+def watch_crl(crl_file, stop_event, interval=2):
+    # Used by TLS worker processes, which don't get the
+    # revoke notifications of the main process
+    stat = None
+    while not stop_event.is_set():
+        try:
+            st = os.stat(crl_file)
+            _stat = (st.st_ino, st.st_size, st.st_mtime)
+            if _stat != stat:
+                load_crl(crl_file)
+                stat = _stat
+        except Exception, ex:
+            LOGS.error(ex)
+        stop_event.wait(interval)
+
+
+def _encode(value):
+    # Certificate CN/O are unicode with newer M2Crypto
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class EnvelopeSocket(zmq.Socket):
+
+    """
+    Processing socket of the TLS server. Sends each node message with
+    its routing envelope, as [Envelope, message] frames.
+    Message bodies are skipped, not unpacked.
+    """
+
+    # (dest, peer, org, ident) -> packed Envelope, shared by the TLS threads
+    _envelopes = LRUCache(4096)
+
+    def send(self, data, flags=0, *args, **kwargs):
+        if flags:
+            # A frame of a multipart message
+            return super(EnvelopeSocket, self).send(data, flags, *args,
+                                                    **kwargs)
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(data)
+        start = 0
+        while True:
+            try:
+                hdr = unpacker.unpack()
+                unpacker.skip()
+            except msgpack.OutOfData:
+                break
+            # The message is sent as packed, only its header is read
+            end = unpacker.tell()
+            key = tuple(hdr.get(field) or '' for field in
+                        ('dest', 'peer', 'org', 'ident'))
+            envelope = self._envelopes.get(key)
+            if envelope is None:
+                envelope = Envelope.pack(*[_encode(value) for value in key])
+                self._envelopes.set(key, envelope)
+            super(EnvelopeSocket, self).send(envelope, zmq.SNDMORE)
+            super(EnvelopeSocket, self).send(data[start:end])
+            start = end
+
+
+class _EnvelopeContext(zmq.Context):
+    _socket_class = EnvelopeSocket
+
+
+class TLSZmqServerSocket(tlszmq.TLSZmqServerSocket):
+
+    """
+    TLS server socket, which delivers node messages to the processing
+    socket as [Envelope, message] frames, one message per send.
+    """
+
+    # Revoked serials, a set for constant time checks on handshake
+    CRL = set()
+    # Certificate serial -> (CN, O), read once per node certificate
+    _subjects = LRUCache(4096)
+
+    def _update_conn(self, ident, x509):
+        # Called by the library loop for each message of a connection
+        conn = self.conns[ident]
+        serial = x509.get_serial_number() if x509 else None
+        if serial is None or serial in self.CRL:
+            conn.node = None
+            return None, None
+        subject = self._subjects.get(serial)
+        if subject is None:
+            subj = x509.get_subject()
+            subject = (_encode(subj.CN or ''), _encode(subj.O or ''))
+            self._subjects.set(serial, subject)
+        conn.node, conn.org = subject
+        return subject
+
+    def start(self):
+        # The library loop creates the processing socket from the context
+        # of zmq_socket. A shadow of that context makes it an
+        # EnvelopeSocket, the TLS handling is left to the library
+        context = self.zmq_socket.context
+        self.zmq_socket.context = _EnvelopeContext.shadow(context.underlying)
+        try:
+            super(TLSZmqServerSocket, self).start()
+        finally:
+            self.zmq_socket.context = context
@@ -12,33 +12,42 @@
 #  * without the express permission of CloudRunner.io
 #  *******************************************************/
 
-import fcntl
 import logging
-import os
+import msgpack
+from multiprocessing import cpu_count
 from os import path as p
-import signal
 from socket import gethostname
+from subprocess import Popen
+import sys
 from threading import Event
 from threading import Thread
 import time
+import zlib
 import zmq
 from zmq.eventloop import ioloop
 
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from cloudrunner.util.tlszmq import TLSZmqServerSocket
 from cloudrunner.plugins.transport.zmq_transport import (SockWrapper,
                                                          PollerWrapper)
 from cloudrunner.util.aes_crypto import Crypter
-from cloudrunner.util.shell import Timer
 
 from cloudrunner_server.core.message import *  # noqa
 from cloudrunner_server.plugins.transport.base import (ServerTransportBackend,
-                                                       Tenant, TenantDict)
+                                                       Tenant, TenantDict,
+                                                       HashRing,
+                                                       HeartbeatScheduler,
+                                                       OrgMasters,
+                                                       match_nodes)
+from cloudrunner_server.plugins.transport.tlszmq import (TLSZmqServerSocket,
+                                                         load_crl)
 from cloudrunner_server.api.model import metadata, Node, Org
 from cloudrunner_server.master.functions import CertController
 from cloudrunner_server.util.db import checkout_listener
+from cloudrunner_server.util.inotify import (Inotify, IN_CREATE, IN_DELETE,
+                                             IN_MOVED_FROM, IN_MOVED_TO,
+                                             IN_Q_OVERFLOW)
 
 LOGR = logging.getLogger('ZMQ ROUTER')
 LOGA = logging.getLogger('ZMQ ACCESS')
@@ -49,6 +58,9 @@ LOGPUB = logging.getLogger('ZMQ PUBLISH')
 LOGL.setLevel(logging.ERROR)
 LOGN.setLevel(logging.ERROR)
 
+# Max heartbeats applied in one poll cycle
+HB_BATCH_SIZE = 5000
+
 
 class Pipe(object):
 
@@ -141,6 +153,12 @@ class ZmqTransport(ServerTransportBackend):
             self.master_pub_uri
         )
 
+        # Control sockets of the native proxies, see _proxy()
+        self.proxy_controls = dict(
+            (bus, 'inproc://%s-control' % bus)
+            for bus in ('requests', 'logger', 'admin_nodes',
+                        'scheduler', 'user_input'))
+
         proxy_pub_port = config.proxy_pub_port or 5553
 
         self.endpoints = {
@@ -157,6 +175,8 @@ class ZmqTransport(ServerTransportBackend):
             self.config.add_section('proxy', 'Proxy')
             for (host, proxy) in self.config.proxy.items():
                 self.proxies[host] = proxy.strip()
+        # Org owners, other masters are added as they connect
+        self.ring = HashRing([self.host])
 
         self.router = Router(self.config, self.context,
                              self.buses, self.endpoints, self.running,
@@ -164,7 +184,10 @@ class ZmqTransport(ServerTransportBackend):
         self.crypter = Crypter()
         self.subca_dir = p.join(
             p.dirname(p.abspath(self.config.security.ca)), 'org')
-        self._watch_dir('CD', self.subca_dir, callback=self._cert_changed)
+        self.watcher = Inotify()
+        self.watcher.watch(self.subca_dir,
+                           IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM,
+                           self._org_changed)
 
         # Check for crl file
         crl_file = p.join(
@@ -177,13 +200,20 @@ class ZmqTransport(ServerTransportBackend):
         self.cert_dir = p.join(
             p.dirname(p.abspath(self.config.security.ca)), 'nodes')
         # Watch deletes, which occur on revoke
-        self._watch_dir('D', self.cert_dir, callback=self._nodes_changed)
+        self.watcher.watch(self.cert_dir, IN_DELETE, self._nodes_changed)
 
         # init
         self.db = None
         self.db_path = config.db
         self.heartbeat_timeout = int(self.config.heartbeat_timeout or 30)
+        self.heartbeat_jitter = float(self.config.heartbeat_jitter or 1)
         self.tenants = TenantDict(refresh=self._cert_changed)
+        # Nodes report within a heartbeat interval after the start
+        self.started = time.time()
+        # Per node PUB topic -> last time its Init was sent,
+        # and the topics with a live subscriber
+        self.node_topics = {}
+        self.subscribed = set()
 
     def set_context_from_config(self, **configuration):
         session = scoped_session(sessionmaker())
@@ -194,39 +224,12 @@ class ZmqTransport(ServerTransportBackend):
         metadata.bind = session.bind
         self.db = session
 
-    def _watch_dir(self, mode, _dir, callback):
-        cert_fd = os.open(_dir, 0)
-        fcntl.fcntl(cert_fd, fcntl.F_SETSIG, 0)
-        watch_mode = fcntl.DN_MULTISHOT
-        if 'C' in mode:
-            watch_mode |= fcntl.DN_CREATE
-        if 'D' in mode:
-            watch_mode |= fcntl.DN_DELETE
-        if 'M' in mode:
-            watch_mode |= fcntl.DN_MODIFY
-
-        fcntl.fcntl(cert_fd, fcntl.F_NOTIFY, watch_mode)
-        signal.signal(signal.SIGIO, callback)
-
-    def _nodes_changed(self, wait=True, *args):
+    def _nodes_changed(self, *args):
 
         def read():
-            crl_file = p.join(
-                p.dirname(p.abspath(self.config.security.ca)), 'crl')
-            fd = open(crl_file, 'r')
-            CRL_LIST = [line for line in fd.read().split('\n') if line]
-            for cert_serial in CRL_LIST:
-                try:
-                    ser_no = int(cert_serial)
-                    if ser_no not in TLSZmqServerSocket.CRL:
-                        TLSZmqServerSocket.CRL.append(ser_no)
-                except ValueError, er:
-                    LOGR.exception(er)
-
-            fd.close()
+            load_crl(p.join(
+                p.dirname(p.abspath(self.config.security.ca)), 'crl'))
 
-        if wait:
-            time.sleep(1)  # wait 1 sec for file closing
         try:
             read()
         except Exception, ex:
@@ -256,8 +259,32 @@ class ZmqTransport(ServerTransportBackend):
             if org.name not in self.tenants:
                 self.ccont.restore_org_keys(org.name)
 
-    def register_session(self, session_id):
-        self.managed_sessions[session_id] = True
+    def _org_changed(self, path, name, mask):
+        # Org CA cert added/removed, reload only the affected tenant
+        if mask & IN_Q_OVERFLOW:
+            self._cert_changed()
+            return
+        if not name.endswith('.ca.crt'):
+            return
+        org = name[:-len('.ca.crt')]
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            if org not in self.tenants:
+                LOGR.warn("Registering tenant %s" % org)
+                self.tenants[org] = Tenant(org)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if org in self.tenants:
+                LOGR.warn("Un-registering tenant %s" % org)
+                self.tenants.pop(org)
+            enabled = self.db.query(Org).filter(
+                Org.name == org, Org.enabled == True).first()  # noqa
+            if enabled:
+                # Restored file will register the tenant again
+                self.ccont.restore_org_keys(org)
+
+    def register_session(self, session_id, ident=None):
+        # Node messages for the session are routed to ident,
+        # a session loop socket serving many sessions
+        self.managed_sessions[session_id] = ident or session_id
 
     def unregister_session(self, session_id):
         try:
@@ -265,6 +292,29 @@ class ZmqTransport(ServerTransportBackend):
         except:
             pass
 
+    def resolve_targets(self, org, targets):
+        if self.proxies and self.ring.owner(org) != self.host:
+            # Nodes of the org report to another master
+            return None
+        tenant = self.tenants.get(org)
+        if tenant is None:
+            return None
+        if time.time() - self.started < self.heartbeat_timeout:
+            # Registry is not complete yet
+            return None
+        nodes = match_nodes(list(tenant.nodes), targets)
+        if not nodes:
+            # Not reported (yet), the nodes match the target themselves
+            return None
+        return nodes
+
+    def _forget_node(self, org, node):
+        # Node dropped or expired, its topic gets a new Init when it
+        # is back. The subscription is removed by the unsubscribe event
+        tenant = self.tenants.get(org)
+        if tenant is not None:
+            self.node_topics.pop(tenant.node_topic(node), None)
+
     def configure(self, overwrite=False, **kwargs):
         pass
 
@@ -273,7 +323,8 @@ class ZmqTransport(ServerTransportBackend):
 
     def prepare(self):
         self._cert_changed()
-        self._nodes_changed(wait=False)
+        self._nodes_changed()
+        Thread(target=self.watcher.run, args=(self.running,)).start()
         # Run router devices
         self.router.start()
 
@@ -283,31 +334,7 @@ class ZmqTransport(ServerTransportBackend):
             router.bind(self.buses.requests.publish)
             worker_proxy = self.context.socket(zmq.DEALER)
             worker_proxy.bind(self.buses.requests.consume)
-            poller = zmq.Poller()
-            poller.register(router, zmq.POLLIN)
-            poller.register(worker_proxy, zmq.POLLIN)
-
-            while not self.running.is_set():
-                try:
-                    socks = dict(poller.poll(500))
-                    if router in socks:
-                        frames = router.recv_multipart()
-                        worker_proxy.send_multipart(frames)
-                    if worker_proxy in socks:
-                        frames = worker_proxy.recv_multipart()
-                        router.send_multipart(frames)
-                except zmq.ZMQError, err:
-                    if self.context.closed or \
-                            getattr(err, 'errno', 0) == zmq.ETERM or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSOCK:
-                        # System interrupt
-                        break
-                    else:
-                        raise err
-                except KeyboardInterrupt:
-                    break
-            router.close()
-            worker_proxy.close()
+            self._proxy('requests', router, worker_proxy)
             LOGR.info("Exited requests queue")
 
         def logger_queue():
@@ -316,73 +343,27 @@ class ZmqTransport(ServerTransportBackend):
             log_proxy.bind(self.buses.logger.publish)
             log_proxy_fwd = self.context.socket(zmq.DEALER)
             log_proxy_fwd.bind(self.buses.logger.consume)
-            # Logger PUB forwarder
+            # Logger PUB forwarder, receives a copy of each log message
             log_pub_fwd = self.context.socket(zmq.PUB)
+            log_pub_fwd.setsockopt(zmq.LINGER, 0)
             log_pub_fwd.bind(self.buses.logger_fwd.publish)
             LOGL.info("Logger publishing at %s" %
                       self.buses.logger_fwd.publish)
-            while not self.running.is_set():
-                try:
-                    if not log_proxy.poll(500):
-                        continue
-                    frames = log_proxy.recv()
-                    log_proxy_fwd.send(frames)
-                    log_pub_fwd.send(frames)
-                    # zmq.device(zmq.FORWARDER, log_proxy, log_proxy_fwd)
-                except zmq.ZMQError, err:
-                    if self.context.closed or \
-                            getattr(err, 'errno', 0) == zmq.ETERM or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSOCK or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSUP:
-                        # System interrupt
-                        break
-                    LOGL.exception(err)
-                    continue
-                except KeyboardInterrupt:
-                    break
-                except Exception, ex:
-                    LOGL.exception(ex)
-                    continue
-
-            log_proxy.close()
-            log_proxy_fwd.close()
-            log_pub_fwd.close(0)
+            self._proxy('logger', log_proxy, log_proxy_fwd,
+                        capture=log_pub_fwd)
             LOGL.info("Exited logger queue")
 
         def admin_nodes():
-            # Admin nodes registration forwarder
+            # Admin nodes registration forwarder,
+            # publishes [org, node] frames as sent by heartbeat()
             admin_proxy = self.context.socket(zmq.DEALER)
             admin_proxy.bind(self.buses.admin_nodes.publish)
-            # Logger PUB forwarder
             admin_pub_fwd = self.context.socket(zmq.PUB)
+            admin_pub_fwd.setsockopt(zmq.LINGER, 0)
             admin_pub_fwd.bind(self.buses.admin_fwd.publish)
             LOGN.info("Admin nodes publishing at %s" %
                       self.buses.admin_fwd.publish)
-            while not self.running.is_set():
-                try:
-                    if not admin_proxy.poll(500):
-                        continue
-                    frames = admin_proxy.recv()
-                    msg = M.build(frames)
-                    LOGN.info("Notifying new node: %s" % [msg.org, msg.name])
-                    admin_pub_fwd.send_multipart([msg.org, msg.name])
-                except zmq.ZMQError, err:
-                    if self.context.closed or \
-                            getattr(err, 'errno', 0) == zmq.ETERM or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSOCK or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSUP:
-                        # System interrupt
-                        break
-                    LOGN.exception(err)
-                    continue
-                except KeyboardInterrupt:
-                    break
-                except Exception, ex:
-                    LOGN.exception(ex)
-                    continue
-
-            admin_proxy.close()
-            admin_pub_fwd.close(0)
+            self._proxy('admin_nodes', admin_proxy, admin_pub_fwd)
             LOGN.info("Exited admin nodes queue")
 
         def scheduler_queue():
@@ -391,47 +372,17 @@ class ZmqTransport(ServerTransportBackend):
             sched_proxy.bind(self.buses.scheduler.publish)
             sched_proxy_fwd = self.context.socket(zmq.DEALER)
             sched_proxy_fwd.bind(self.buses.scheduler.consume)
-            while not self.running.is_set():
-                try:
-                    zmq.device(zmq.QUEUE, sched_proxy, sched_proxy_fwd)
-                except zmq.ZMQError, err:
-                    if self.context.closed or \
-                            getattr(err, 'errno', 0) == zmq.ETERM or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSOCK or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSUP:
-                        # System interrupt
-                        break
-                    LOGR.exception(err)
-                    continue
-                except KeyboardInterrupt:
-                    break
-
-            sched_proxy.close()
-            sched_proxy_fwd.close()
+            self._proxy('scheduler', sched_proxy, sched_proxy_fwd)
             LOGR.info("Exited scheduler queue")
 
         def user_input_queue():
-            uinput_service = self.context.socket(zmq.ROUTER)
+            # DEALER frontend: no sender identity is prepended,
+            # so the first frame routes directly to the session
+            uinput_service = self.context.socket(zmq.DEALER)
             uinput_service.bind(self.buses['user_input'].publish)
             uinput_proxy = self.context.socket(zmq.ROUTER)
             uinput_proxy.bind(self.buses['user_input'].consume)
-            while not self.running.is_set():
-                try:
-                    frames = uinput_service.recv_multipart()
-                    frames.pop(0)
-                    uinput_proxy.send_multipart(frames)
-                except zmq.ZMQError, err:
-                    if self.context.closed or \
-                            getattr(err, 'errno', 0) == zmq.ETERM or \
-                            getattr(err, 'errno', 0) == zmq.ENOTSOCK:
-                        break
-                    else:
-                        raise err
-                except KeyboardInterrupt:
-                    break
-
-            uinput_service.close()
-            uinput_proxy.close()
+            self._proxy('user_input', uinput_service, uinput_proxy)
             LOGR.info("Exited user_input queue")
 
         Thread(target=requests_queue).start()
@@ -461,12 +412,73 @@ class ZmqTransport(ServerTransportBackend):
 
         self.node_registered_queue = self.publish_queue('admin_nodes')
 
+    def _proxy(self, name, frontend, backend, capture=None):
+        # Runs a native zmq proxy, frames never enter python.
+        # Stopped by sending TERMINATE to the control socket
+        control = self.context.socket(zmq.PAIR)
+        control.bind(self.proxy_controls[name])
+        try:
+            zmq.proxy_steerable(frontend, backend, capture, control)
+        except zmq.ZMQError, err:
+            if not (self.context.closed or
+                    getattr(err, 'errno', 0) == zmq.ETERM or
+                    getattr(err, 'errno', 0) == zmq.ENOTSOCK or
+                    getattr(err, 'errno', 0) == zmq.ENOTSUP):
+                LOGR.exception(err)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            frontend.close()
+            backend.close()
+            if capture:
+                capture.close()
+            control.close()
+
+    def _stop_proxies(self):
+        for name, endpoint in self.proxy_controls.items():
+            control = self.context.socket(zmq.PAIR)
+            try:
+                control.connect(endpoint)
+                control.send('TERMINATE', zmq.NOBLOCK)
+            except zmq.ZMQError, err:
+                LOGR.debug("Cannot stop %s proxy: %s" % (name, err))
+            finally:
+                control.close(500)
+
+    def heartbeats(self, msgs):
+        """
+        Applies a batch of heartbeat requests, keeping only the last one
+        per node and type. The survivors are applied in the order of their
+        last occurrence, so [HBR, QUIT, HBR] leaves the node registered.
+        Returns the requests to be answered with Init
+        """
+        latest = {}
+        for i, msg in enumerate(msgs):
+            if isinstance(msg, Ident):
+                key = msg.hdr.ident
+            else:
+                key = (msg.hdr.org, msg.hdr.peer, msg.control)
+            latest[key] = (i, msg)
+        applied = sorted(latest.values(), key=lambda item: item[0])
+        LOGPUB.debug("HB batch: %s requests, %s applied" % (
+            len(msgs), len(applied)))
+
+        replies = []
+        for _, msg in applied:
+            try:
+                if self.heartbeat(msg) or isinstance(msg, Ident):
+                    replies.append(msg)
+            except Exception, ex:
+                LOGR.exception(ex)
+        return replies
+
     def heartbeat(self, msg):
         if msg.control == 'QUIT':
             LOGPUB.info("QUIT: Node %s dropped from %s" % (
                 msg.hdr.peer, msg.hdr.org))
             if msg.hdr.org in self.tenants:
                 self.tenants[msg.hdr.org].pop(msg.hdr.peer)
+                self._forget_node(msg.hdr.org, msg.hdr.peer)
             node = self.db.query(Node).join(Org).filter(
                 Node.name == msg.hdr.peer,
                 Org.name == msg.hdr.org).first()
@@ -476,11 +488,9 @@ class ZmqTransport(ServerTransportBackend):
         elif msg.hdr.org not in self.tenants:
             LOGPUB.warn("Unrecognized node: %s" % msg)
         elif msg.control == 'PING':
-            LOGPUB.info("PING from %s@%s" % (msg.hdr.peer, msg.hdr.org))
+            LOGPUB.debug("PING from %s@%s" % (msg.hdr.peer, msg.hdr.org))
             try:
-                new_node = NodeRegistration(org=msg.hdr.org,
-                                            name=msg.hdr.peer)
-                self.node_registered_queue.send(new_node._)
+                self.node_registered_queue.send(msg.hdr.org, msg.hdr.peer)
             except zmq.ZMQError, err:
                 if self.context.closed or \
                         getattr(err, 'errno', 0) == zmq.ETERM or \
@@ -491,7 +501,7 @@ class ZmqTransport(ServerTransportBackend):
             except Exception, ex:
                 LOGPUB.error(ex)
         else:
-            LOGPUB.info("HB from %s@%s" % (msg.hdr.peer, msg.hdr.org))
+            LOGPUB.debug("HB from %s@%s" % (msg.hdr.peer, msg.hdr.org))
 
             is_new = self.tenants[msg.hdr.org].push(msg.hdr.peer)
             if msg.control == 'HBR':
@@ -535,13 +545,20 @@ class ZmqTransport(ServerTransportBackend):
         # Subscribe upstream for all feeds
         xsub_listener.send('\x01')
 
-        def _ping_nodes(*args):
+        def _ping_tenants(now):
+            expired = []
             try:
-                for name, tenant in self.tenants.items():
+                for tenant, since in scheduler.due(self.tenants, now):
                     # Set 1 refresh time back to avoid missing active nodes
-                    self.tenants[name].refresh(adjust=-self.heartbeat_timeout)
+                    tenant.refresh(adjust=-since)
+                    init_cache.pop(tenant.name, None)
                     xpub_listener.send_multipart(
                         [tenant.id, HB()._])
+                    inactive = tenant.inactive_nodes()
+                    if inactive:
+                        expired.append((tenant.name, inactive))
+                        for node in inactive:
+                            self._forget_node(tenant.name, node.name)
             except zmq.ZMQError, err:
                 if self.context.closed or \
                         getattr(err, 'errno', 0) == zmq.ETERM or \
@@ -550,9 +567,8 @@ class ZmqTransport(ServerTransportBackend):
             except Exception, ex:
                 LOGPUB.error(ex)
 
-            tens = self.tenants.purge_expired()
             try:
-                for (org, ts) in tens:
+                for (org, ts) in expired:
                     for t in ts:
                         node = self.db.query(Node).join(Org).filter(
                             Node.name == t.name,
@@ -573,6 +589,50 @@ class ZmqTransport(ServerTransportBackend):
                              "Restart of nodes might be needed" %
                              org_name)
 
+        # org -> packed Init body, rebuilt on every ping of the org
+        init_cache = {}
+
+        def pack_init(topic, org):
+            msg = Init(topic, org, self.crypter.key, self.crypter.iv)
+            return msgpack.packb(msg.values())
+
+        def init_reply(org, ident):
+            body = init_cache.get(org)
+            if body is None:
+                body = init_cache[org] = pack_init(self.tenants[org].id, org)
+            # Same layout as M.pack(), with a per node header
+            return msgpack.packb(dict(ident=ident, dest='')) + body
+
+        def node_init_reply(org, node, ident, now):
+            # Subscribes the node to its own topic, see publish_target().
+            # Sent until the node subscribes, once per heartbeat interval,
+            # the node answers every Init with a Ping
+            topic = self.tenants[org].node_topic(node)
+            if topic in self.subscribed or \
+                    now - self.node_topics.get(topic, 0) < \
+                    self.heartbeat_timeout:
+                return None
+            self.node_topics[topic] = now
+            return msgpack.packb(dict(ident=ident, dest='')) + \
+                pack_init(topic, org)
+
+        def publish_target(msg, org_uid):
+            nodes = getattr(msg, 'nodes', None)
+            if nodes is None:
+                xpub_listener.send_multipart([org_uid, Crypto(process(msg))._])
+                return
+            msg.kw.remove('nodes')
+            tenant = self.tenants.by_id(org_uid)
+            topics = [tenant.node_topic(node) for node in nodes]
+            if not self.subscribed.issuperset(topics):
+                # Some nodes did not subscribe to their own topic
+                topics = [org_uid]
+            packed = Crypto(process(msg))._
+            for topic in topics:
+                xpub_listener.send_multipart([topic, packed])
+            LOGPUB.debug("Job %s published to %s topics" % (msg.job_id,
+                                                            len(topics)))
+
         def process(msg):
             msg.hdr.clear()
             if self.crypter:
@@ -580,13 +640,21 @@ class ZmqTransport(ServerTransportBackend):
             else:
                 return msg._
 
-        timer = Timer(self.heartbeat_timeout, _ping_nodes)
-        timer.start()
+        scheduler = HeartbeatScheduler(self.heartbeat_timeout,
+                                       self.heartbeat_jitter)
+        synced = 0
         LOGPUB.info("Heartbeat at %s sec" % self.heartbeat_timeout)
 
         while not self.running.is_set():
             try:
                 socks = dict(poller.poll(1000))
+                now = time.time()
+                if now - synced >= 1:
+                    scheduler.sync(self.tenants, now)
+                    synced = now
+                next_ping = scheduler.next_due()
+                if next_ping is not None and next_ping <= now:
+                    _ping_tenants(now)
                 if not socks:
                     continue
                 if zmq.POLLERR in socks.values():
@@ -596,37 +664,37 @@ class ZmqTransport(ServerTransportBackend):
                     packet = xpub_listener.recv_multipart()
                     action = packet[0][0]
                     target = packet[0][1:]
-                    if action == b'\x01' and target:
-
-                        if target not in self.tenants.values():
+                    if target in self.node_topics or \
+                            target in self.subscribed:
+                        if action == b'\x01':
+                            self.subscribed.add(target)
+                        else:
+                            self.subscribed.discard(target)
+                    elif action == b'\x01' and target:
+                        tenant = self.tenants.by_id(target)
+                        if tenant is None:
                             # Send welcome message
                             xpub_listener.send_multipart([target,
                                                           Welcome()._])
                         else:
-                            tenant = [(t_key, t_val) for t_key, t_val in
-                                      self.tenants.items()
-                                      if t_val == target][0][0]
                             LOGPUB.info(
-                                'Started publishing on %s' % tenant)
+                                'Started publishing on %s' % tenant.name)
                             xpub_listener.send_multipart(
                                 [target, HB()._])
                     elif action == b'\x00':
                         # Node de-registered
                         LOGPUB.debug('Stopped publishing to %s' %
                                      target)
-                        if target in self.tenants.values():
+                        tenant = self.tenants.by_id(target)
+                        if tenant is not None:
                             # Active node dropped,
                             # force tenant nodes to reload
-                            for tenant in self.tenants.values():
-                                if tenant == target:
-                                    LOGPUB.info("Node dropped from %s" %
-                                                tenant.name)
-                                    # Refresh HeartBeat
-                                    self.tenants[tenant.name].refresh(
-                                        adjust=-self.heartbeat_timeout)
-                                    xpub_listener.send_multipart(
-                                        [target, HB()._])
-                                    break
+                            LOGPUB.info("Node dropped from %s" %
+                                        tenant.name)
+                            # Refresh HeartBeat
+                            tenant.refresh(adjust=-self.heartbeat_timeout)
+                            xpub_listener.send_multipart(
+                                [target, HB()._])
                 if xsub_listener in socks:
                     packed = xsub_listener.recv()
                     LOGPUB.debug("XSUB packet %s" % packed)
@@ -636,56 +704,49 @@ class ZmqTransport(ServerTransportBackend):
                         org_name = msg.hdr.org
                         org_uid = translate(org_name)
                         if org_uid:
-                            xpub_listener.send_multipart(
-                                [org_uid, Crypto(process(msg))._])
+                            publish_target(msg, org_uid)
                             if pub_proxy:
-                                # Forward to other masters
-                                pub_proxy.send(
-                                    Fwd(org_name, packed)._)
-                                LOGPUB.debug(
-                                    "PUB FWD %s" % ([org_name] + packed))
-
-                    elif isinstance(msg, Fwd):
-                        # Received forwarded packet?
-                        org_name = msg.hdr.org
-                        org_uid = translate(org_name)
-                        if org_uid:
-                            xpub_listener.send_multipart(
-                                [org_uid, Crypto(process(msg))._])
+                                # Forward to masters with nodes of the org,
+                                # see proxy_replicator()
+                                pub_proxy.send_multipart(
+                                    ['PUB', org_name, packed])
+                                LOGPUB.debug("PUB FWD %s" % org_name)
 
                 if heartbeat in socks:
-                    packed = heartbeat.recv()
-                    req = M.build(packed)
-
-                    if not req:
-                        LOGPUB.warn("Invalid HB request: %s" % req)
-                        continue
+                    # Drain all pending heartbeats and apply them at once
+                    reqs = []
+                    while len(reqs) < HB_BATCH_SIZE:
+                        try:
+                            packed = heartbeat.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        req = M.build(packed)
+                        if not req:
+                            LOGPUB.warn("Invalid HB request: %s" % req)
+                        elif isinstance(req, (HBR, Ident, Ping, Quit)):
+                            reqs.append(req)
 
-                    if isinstance(req, (HBR, Ident, Ping, Quit)):
+                    for req in self.heartbeats(reqs):
                         try:
-                            if self.heartbeat(req) or isinstance(req, Ident):
-                                msg = Init(self.tenants[req.hdr.org].id,
-                                           req.hdr.org,
-                                           self.crypter.key,
-                                           self.crypter.iv)
-                                msg.header(ident=req.hdr.ident)
-                                node_reply_queue.send(msg._)
+                            node_reply_queue.send(
+                                init_reply(req.hdr.org, req.hdr.ident))
+                            packed = node_init_reply(
+                                req.hdr.org, req.hdr.peer, req.hdr.ident,
+                                now)
+                            if packed:
+                                node_reply_queue.send(packed)
                         except Exception, ex:
                             LOGR.exception(ex)
-                    elif pub_proxy:
-                        # Also notify other masters
-                        pub_proxy.send(Fwd(req.org, 'HB')._)
                 if pub_proxy in socks:
-                    packed = pub_proxy.recv()
+                    # Job published by another master
+                    _, org_name, packed = pub_proxy.recv_multipart()
                     msg = M.build(packed)
-                    if not isinstance(msg, Fwd):
+                    if not isinstance(msg, JobTarget):
                         continue
-                    # Received forwarded packet?
-                    org_name = msg.dest.org
                     org_uid = translate(org_name)
                     if org_uid:
-                        xpub_listener.send_multipart(
-                            [org_uid, Crypto(process(msg))._])
+                        # Only the nodes held here, see proxy_replicator()
+                        publish_target(msg, org_uid)
 
             except zmq.ZMQError, err:
                 if self.context.closed or \
@@ -701,7 +762,6 @@ class ZmqTransport(ServerTransportBackend):
             except Exception, ex:
                 LOGPUB.exception(ex)
 
-        timer.stop()
         if pub_proxy:
             pub_proxy.close(0)
         node_reply_queue.close()
@@ -711,20 +771,28 @@ class ZmqTransport(ServerTransportBackend):
         LOGPUB.info("Exited PUBSUB thread")
 
     def proxy_replicator(self):
-        # self -> other masters
+        """
+        Forwards traffic of orgs between masters. Each org is owned by
+        one master on the hash ring:
+        - node messages (IN) for sessions not managed here go to the owner
+        - the owner sends replies (OUT) to the master where the node is
+          connected, and jobs (PUB) to the masters with nodes of the org,
+          each with the nodes it holds
+        Frames on the wire are [host topic, verb, origin host, org, ...]
+        """
         poller = zmq.Poller()
 
+        def topic(host):
+            return '%s\0' % host
+
         # proxy publisher
         pub_proxy = self.context.socket(zmq.XPUB)
         pub_proxy.bind(self.endpoints['replicator'])
         poller.register(pub_proxy, zmq.POLLIN)
 
-        # proxy receiver
+        # proxy receiver, only frames addressed to this master
         pub_proxy_sub = self.context.socket(zmq.SUB)
-        verbs = ['SYNC', 'HB', 'PUB', 'IN', 'OUT']
-        for verb in verbs:
-            pub_proxy_sub.setsockopt(zmq.SUBSCRIBE, verb)
-        pub_proxy_sub.setsockopt(zmq.SUBSCRIBE, self.host)
+        pub_proxy_sub.setsockopt(zmq.SUBSCRIBE, topic(self.host))
 
         # proxy <-> router <-> proxy
         router_proxy = self.context.socket(zmq.DEALER)
@@ -744,71 +812,104 @@ class ZmqTransport(ServerTransportBackend):
                 LOGR.error(ex)
         poller.register(pub_proxy_sub, zmq.POLLIN)
 
-        # Send nodes
-        def sync():
-            for tenant in self.tenants.values():
-                for node in tenant.nodes:
-                    pub_proxy.send(HB()._)
-        sync()
-        pub_proxy.send('SYNC')
+        expire = self.heartbeat_timeout * 3
+        # Masters and nodes of the orgs owned here
+        org_masters = OrgMasters(expire)
+        # node ident -> (master host, last seen)
+        remote_idents = {}
+        pruned = time.time()
+
+        def send(host, verb, org, *payload):
+            pub_proxy.send_multipart([topic(host), verb, self.host, org] +
+                                     list(payload), copy=False)
+
+        def publish(org, packed, origin):
+            # Each master gets the job for the nodes it holds, the
+            # origin master has published it already
+            msg = M.build(packed)
+            nodes = getattr(msg, 'nodes', None)
+            for host, host_nodes in org_masters.split(
+                    org, nodes, self.host, skip=origin).items():
+                body = packed
+                if host_nodes is not None:
+                    msg.nodes = host_nodes
+                    body = msg._
+                if host == self.host:
+                    pubsub_proxy.send_multipart(['PUB', org, body])
+                else:
+                    send(host, 'PUB', org, body)
 
         while not self.running.is_set():
             try:
                 socks = dict(poller.poll(1000))
+                now = time.time()
+                if now - pruned > self.heartbeat_timeout:
+                    org_masters.prune(now)
+                    for ident, (host, ts) in remote_idents.items():
+                        if now - ts > expire:
+                            remote_idents.pop(ident)
+                    pruned = now
                 if not socks:
                     continue
+
                 if pub_proxy in socks:
+                    # Other masters (un)subscribe with their host name
                     flag = pub_proxy.recv()
                     _type = flag[0]
-                    tag = flag[1:]
-                    if tag not in verbs:
-                        if _type == b'\x00':
-                            # Disconnect
-                            LOGR.info("Proxy %s disconnected" % tag)
-                        if _type == b'\x01' and tag not in self.proxies:
-                            LOGR.info("Reconnecting to proxy: %s" % tag)
-                            try:
-                                pub_proxy_sub.connect('tcp://%s' % proxy)
-                                LOGR.info(
-                                    "Connected to proxy: %s" % proxy)
-                            except Exception, ex:
-                                LOGR.error(ex)
+                    host = flag[1:].rstrip('\0')
+                    if host in self.proxies:
+                        if _type == b'\x00' and self.ring.remove(host):
+                            LOGR.info("Proxy %s disconnected, "
+                                      "rebalancing orgs" % host)
+                        elif _type == b'\x01' and self.ring.add(host):
+                            LOGR.info("Proxy %s connected, "
+                                      "rebalancing orgs" % host)
 
                 if pub_proxy_sub in socks:
-                    packets = pub_proxy_sub.recv_multipart()
-                    msg = Fwd.build(**packets)
-                    if not msg:
-                        LOGPUB.warning("Unknown fwd message: %s" % packets)
+                    frames = pub_proxy_sub.recv_multipart()
+                    if len(frames) < 5:
+                        LOGR.warn("Unknown fwd message: %s" % frames[:4])
                         continue
-                    target = msg.control
-                    if target == 'SYNC':
-                        sync()
-                    elif target == 'HB':
-                        # Heartbeat
-                        req = HB.build()
-                        if not req:
-                            LOGR.warn("Invalid HB request: %s" % packets)
+                    verb, origin, org = frames[1:4]
+                    if verb == 'IN':
+                        dest, ident, packed = frames[4:]
+                        org_masters.seen(org, origin,
+                                         peek_header(packed).get('peer'),
+                                         now)
+                        remote_idents[ident] = (origin, now)
+                        router_proxy.send_multipart(['IN', dest, packed])
+                    elif verb == 'OUT':
+                        router_proxy.send_multipart(['OUT', frames[4]])
+                    elif verb == 'PUB':
+                        if self.ring.owner(org) == self.host:
+                            publish(org, frames[4], origin)
                         else:
-                            self.heartbeat(req)
-                    elif target == 'PUB':
-                        # Publish job
-                        packets.insert(1, 'FWD')
-                        # ------------
-                        pubsub_proxy.send_multipart(packets)
-                    elif target in ['IN', 'OUT']:
-                        router_proxy.send_multipart([target] + packets)
+                            pubsub_proxy.send_multipart(
+                                ['PUB', org, frames[4]])
 
                 if router_proxy in socks:
-                    # ------------
-                    fwd_packets = router_proxy.recv_multipart()
-                    LOGR.debug("fwd packets: %s" % fwd_packets)
-                    pub_proxy.send_multipart(fwd_packets)
+                    frames = router_proxy.recv_multipart(copy=False)
+                    verb = frames[0].bytes
+                    if verb == 'IN':
+                        # Node message for a session not managed here
+                        org = frames[1].bytes
+                        owner = self.ring.owner(org)
+                        if owner != self.host:
+                            send(owner, 'IN', org, *frames[2:])
+                    elif verb == 'OUT':
+                        # Reply to a node connected to another master?
+                        ident = peek_header(frames[1].bytes).get('ident')
+                        route = remote_idents.get(ident)
+                        if route:
+                            send(route[0], 'OUT', '', frames[1])
 
                 if pubsub_proxy in socks:
-                    # ------------
-                    pubsub_packets = pubsub_proxy.recv_multipart()
-                    LOGR.debug("pubsub fwd packets: %s" % pubsub_packets)
-                    pub_proxy.send_multipart(pubsub_packets)
+                    _, org, packed = pubsub_proxy.recv_multipart()
+                    owner = self.ring.owner(org)
+                    if owner != self.host:
+                        send(owner, 'PUB', org, packed)
+                    else:
+                        publish(org, packed, self.host)
 
             except zmq.ZMQError, err:
                 if self.context.closed or \
@@ -890,10 +991,52 @@ class ZmqTransport(ServerTransportBackend):
             sock._sock.close()
         self.node_registered_queue.close()
         self.running.set()
+        self._stop_proxies()
         self.router.close()
         self.context.term()
 
 
+def peek_header(packed):
+    # Unpack only the header of a packed message
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(packed)
+    try:
+        return unpacker.unpack()
+    except msgpack.OutOfData:
+        return {}
+
+
+def tls_worker_count(config):
+    # One TLS process per CPU, unless configured. On a single CPU the
+    # TLS thread stays in the dispatcher process
+    if config.tls_worker_count:
+        return int(config.tls_worker_count)
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def tls_server_socket(config, sock, proc_socket_uri):
+    verify_loc = []
+    verify_loc.append(config.security.ca)
+    # ca_path = os.path.dirname(os.path.abspath(config.security.ca))
+    # org_dir = os.path.join(ca_path, 'org')
+    # for (dir, _, files) in os.walk(org_dir):
+    #     for _file in files:
+    #         if _file.endswith('.ca.crt'):
+    #             verify_loc.append(os.path.join(dir, _file))
+
+    return TLSZmqServerSocket(
+        sock,
+        proc_socket_uri,
+        config.security.server_cert,
+        config.security.server_key,
+        config.security.ca,
+        verify_func=verify_loc,
+        cert_password=config.security.cert_pass)
+
+
 class Router(Thread):
 
     """
@@ -909,6 +1052,7 @@ class Router(Thread):
         self.running = event
         self.proxies = proxies
         self.ssl_worker_uri = 'inproc://ssl-worker'
+        self.tls_workers = tls_worker_count(config)
 
     def router_worker(self):
         # Collects all IN_MESSAGES and routes them
@@ -941,20 +1085,30 @@ class Router(Thread):
             router_proxy.bind(self.endpoints['router_fwd'])
             poller.register(router_proxy, zmq.POLLIN)
 
-        def do_ssl_msg(msg):
-
-            if not msg.hdr.peer and msg.hdr.dest != ADMIN_TOWER:
+        # node ident -> last message time, the nodes connected here.
+        # Replies to other idents are routed by the replicator
+        local_idents = {}
+        expire = int(self.config.heartbeat_timeout or 30) * 3
+        pruned = time.time()
+
+        def do_ssl_msg(envelope, payload):
+            dest, peer, org, ident = Envelope.unpack(envelope)
+            if router_proxy and ident:
+                local_idents[ident] = time.time()
+            if not peer and dest != ADMIN_TOWER:
                 # Anonymous accessing data feed
-                LOGR.error('NOT AUTHORIZED: %s : %r' % (msg.hdr.peer, msg))
+                LOGR.error('NOT AUTHORIZED: %s : %r' % (peer, dest))
                 return
 
-            LOGR.debug(
-                "Routing to: %r" % msg.route())
-            router.send_multipart(msg.route())
-            if router_proxy and msg.hdr.dest not in \
+            LOGR.debug("Routing to: %r" % dest)
+            router.send_multipart(
+                [ZmqTransport.managed_sessions.get(dest, dest), payload],
+                copy=False)
+            if router_proxy and dest != ADMIN_TOWER and dest not in \
                     ZmqTransport.managed_sessions:
-                router_proxy.send_multipart(
-                    ["IN", msg.hdr.dest, msg._])
+                # The org owner might manage the session
+                router_proxy.send_multipart(["IN", org, dest, ident, payload],
+                                            copy=False)
 
         socks = {}
         while not self.running.is_set():
@@ -969,47 +1123,59 @@ class Router(Thread):
                 LOGR.exception(ex)
                 continue
             try:
+                if router_proxy and time.time() - pruned > expire:
+                    pruned = time.time()
+                    for ident, ts in local_idents.items():
+                        if pruned - ts > expire:
+                            local_idents.pop(ident)
+
                 for sock in socks:
                     # INCOMING #############
                     if sock == ssl_worker:
 
-                        data = ssl_worker.recv()
-                        msgs = M.parse(data)
-                        for msg in msgs:
-                            LOGR.debug("Msg recv: %r, %r" % (msg, msg.hdr))
-                            do_ssl_msg(msg)
+                        # [envelope, message], the message is not parsed
+                        frames = ssl_worker.recv_multipart(copy=False)
+                        if len(frames) != 2:
+                            LOGR.warn("Invalid SSL worker packet")
+                            continue
+                        do_ssl_msg(frames[0].bytes, frames[1])
 
                     # REPLIES #############
                     if sock == reply_router:
-                        packed = reply_router.recv()
-                        msg = M.parse(packed)[0]
-                        LOGR.debug("OUT-MSG reply: %r" % msg._)
-                        ssl_worker.send(msg._)
-
-                        if router_proxy:
-                            if msg.hdr.dest not in [ADMIN_TOWER]:
-                                router_proxy.send_multipart(
-                                    ["OUT"] + msg.forward())
+                        # Passed as is, the TLS socket reads the header
+                        packed = reply_router.recv(copy=False)
+                        if not router_proxy or peek_header(
+                                packed.bytes).get('ident') in local_idents:
+                            ssl_worker.send(packed, copy=False)
+                        else:
+                            # Connected to another master, the org owner
+                            # knows which one
+                            router_proxy.send_multipart(["OUT", packed],
+                                                        copy=False)
 
                     # ROUTER PROXY #############
                     if router_proxy and router_proxy == sock:
                         fwd_packet = router_proxy.recv_multipart()
-                        LOGR.debug("FWD %s" % fwd_packet)
-                        direction = fwd_packet.pop(0)
+                        direction = fwd_packet[0]
+                        LOGR.debug("FWD %s" % direction)
                         if direction == "IN":
-                            sess_id = fwd_packet[0]
-                            if (sess_id == HEARTBEAT and
-                                fwd_packet[4] != 'IDENT') or \
-                                    sess_id in \
-                                    ZmqTransport.managed_sessions:
-                                router.send_multipart(fwd_packet)
+                            _, dest, packed = fwd_packet
+                            if dest == HEARTBEAT:
+                                # Nodes of owned orgs, Init is sent by
+                                # the master where the node is connected
+                                if not isinstance(M.build(packed), Ident):
+                                    router.send_multipart([dest, packed])
+                            elif dest in ZmqTransport.managed_sessions:
+                                router.send_multipart(
+                                    [ZmqTransport.managed_sessions[dest],
+                                     packed])
                         elif direction == "OUT":
-                            fwd_msg = Fwd.build(**fwd_packet)
-                            if fwd_msg:
-                                sid = fwd_msg.data[0]
-                                if sid not in \
-                                        ZmqTransport.managed_sessions:
-                                    ssl_worker.send_multipart(fwd_packet)
+                            ident = peek_header(fwd_packet[1]).get('ident')
+                            if ident in local_idents:
+                                ssl_worker.send(fwd_packet[1])
+                            else:
+                                LOGR.debug("Reply to a node not connected "
+                                           "here: %r" % ident)
 
             except zmq.ZMQError, zerr:
                 if zerr.errno == zmq.ETERM or zerr.errno == zmq.ENOTSUP \
@@ -1026,35 +1192,108 @@ class Router(Thread):
 
         LOGR.info("Exited router worker")
 
+    def tls_balancer(self):
+        # Spreads node connections over the TLS worker processes.
+        # Each peer identity is pinned to one worker, which holds its
+        # TLS state. Worker output is bridged to the ssl-worker bus
+        ssl_worker = self.context.socket(zmq.DEALER)
+        ssl_worker.connect(self.ssl_worker_uri)
+
+        poller = zmq.Poller()
+        poller.register(self.repl_sock, zmq.POLLIN)
+        poller.register(ssl_worker, zmq.POLLIN)
+
+        node_socks = []
+        proc_socks = []
+        workers = []
+        for i in range(self.tls_workers):
+            node_uri = "ipc://%s/tls-worker-%s.sock" % (
+                self.config.sock_dir, i)
+            proc_uri = "ipc://%s/tls-proc-%s.sock" % (
+                self.config.sock_dir, i)
+            node_sock = self.context.socket(zmq.DEALER)
+            node_sock.bind(node_uri)
+            proc_sock = self.context.socket(zmq.DEALER)
+            proc_sock.bind(proc_uri)
+            poller.register(node_sock, zmq.POLLIN)
+            poller.register(proc_sock, zmq.POLLIN)
+            node_socks.append(node_sock)
+            proc_socks.append(proc_sock)
+
+            # A new program, a fork would copy the contexts, DB engines
+            # and lock states of the threads running here
+            worker = Popen([sys.executable, '-m',
+                            'cloudrunner_server.plugins.transport.tls_worker',
+                            self.config._fn, node_uri, proc_uri],
+                           close_fds=True)
+            workers.append(worker)
+        LOGR.info("Started %s TLS workers" % self.tls_workers)
+
+        def pin(ident):
+            return (zlib.crc32(ident) & 0xffffffff) % self.tls_workers
+
+        while not self.running.is_set():
+            try:
+                socks = dict(poller.poll(1000))
+                if self.repl_sock in socks:
+                    # [ident, encrypted data] from node
+                    frames = self.repl_sock.recv_multipart(copy=False)
+                    if len(frames) == 2:
+                        node_socks[pin(frames[0].bytes)].send_multipart(
+                            frames, copy=False)
+                    else:
+                        LOGR.warn("Invalid data recvd")
+
+                if ssl_worker in socks:
+                    # Reply to node, pinned by the header ident
+                    frames = ssl_worker.recv_multipart(copy=False)
+                    ident = peek_header(frames[-1].bytes).get('ident')
+                    if ident:
+                        proc_socks[pin(ident)].send(frames[-1], copy=False)
+                    else:
+                        LOGR.warn("Reply without ident, dropping")
+
+                for i in range(self.tls_workers):
+                    if node_socks[i] in socks:
+                        self.repl_sock.send_multipart(
+                            node_socks[i].recv_multipart(copy=False),
+                            copy=False)
+                    if proc_socks[i] in socks:
+                        ssl_worker.send_multipart(
+                            proc_socks[i].recv_multipart(copy=False),
+                            copy=False)
+            except zmq.ZMQError, zerr:
+                if zerr.errno == zmq.ETERM or zerr.errno == zmq.ENOTSUP \
+                        or zerr.errno == zmq.ENOTSOCK:
+                    # System interrupt
+                    break
+                LOGR.exception(zerr)
+            except KeyboardInterrupt:
+                break
+            except Exception, ex:
+                LOGR.exception(ex)
+
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+        for sock in node_socks + proc_socks:
+            sock.close(0)
+        ssl_worker.close()
+        LOGR.info("Exited TLS balancer")
+
     def run(self):
         """ Run response processing thread """
         # Socket to receive replies
         self.repl_sock = self.context.socket(zmq.ROUTER)
         self.repl_sock.bind(self.endpoints['node_reply'])
+        self.master_repl = None
         threads = []
 
         t = Thread(target=self.router_worker)
         threads.append(t)
         t.start()
 
-        verify_loc = []
-        verify_loc.append(self.config.security.ca)
-        # ca_path = os.path.dirname(os.path.abspath(self.config.security.ca))
-        # org_dir = os.path.join(ca_path, 'org')
-        # for (dir, _, files) in os.walk(org_dir):
-        #     for _file in files:
-        #         if _file.endswith('.ca.crt'):
-        #             verify_loc.append(os.path.join(dir, _file))
-
-        self.master_repl = TLSZmqServerSocket(
-            self.repl_sock,
-            self.ssl_worker_uri,
-            self.config.security.server_cert,
-            self.config.security.server_key,
-            self.config.security.ca,
-            verify_func=verify_loc,
-            cert_password=self.config.security.cert_pass)
-
         def master():
             # Runs the SSL Thread
             while not self.running.is_set():
@@ -1070,14 +1309,20 @@ class Router(Thread):
                 except Exception, ex:
                     LOGR.exception(ex)
 
-        t = Thread(target=master)
+        if self.tls_workers > 1:
+            t = Thread(target=self.tls_balancer)
+        else:
+            self.master_repl = tls_server_socket(self.config, self.repl_sock,
+                                                 self.ssl_worker_uri)
+            t = Thread(target=master)
         t.start()
         threads.append(t)
 
         for thread in threads:
             thread.join()
 
-        self.master_repl.terminate()
+        if self.master_repl:
+            self.master_repl.terminate()
         self.repl_sock.close()
         LOGR.info("Exited router device threads")
 
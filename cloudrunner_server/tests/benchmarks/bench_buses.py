@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Messages/sec through the dispatcher buses, python loop vs native proxy.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_buses [messages]
+"""
+
+import sys
+from threading import Thread
+import time
+import zmq
+
+
+def python_loop(ctx, frontend, backend, capture, control, strip_ident):
+    # Former ZmqTransport loop: poll, recv, re-send
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(control, zmq.POLLIN)
+    while True:
+        socks = dict(poller.poll(500))
+        if control in socks:
+            control.recv()
+            break
+        if frontend in socks:
+            frames = frontend.recv_multipart()
+            if strip_ident:
+                frames.pop(0)
+            backend.send_multipart(frames)
+            if capture:
+                capture.send_multipart(frames)
+
+
+def native_proxy(ctx, frontend, backend, capture, control, strip_ident):
+    zmq.proxy_steerable(frontend, backend, capture, control)
+
+
+BUSES = [
+    # name, frontend, backend, capture, consumer
+    ('requests', zmq.ROUTER, zmq.DEALER, False, zmq.DEALER),
+    ('logger', zmq.DEALER, zmq.DEALER, True, zmq.DEALER),
+    ('admin_nodes', zmq.DEALER, zmq.PUB, False, zmq.SUB),
+    ('user_input', zmq.DEALER, zmq.ROUTER, False, zmq.DEALER),
+]
+
+
+def run(ctx, device, bus, count):
+    name, front_type, back_type, has_capture, cons_type = bus
+    strip_ident = False
+    if device is python_loop and bus[0] == 'user_input':
+        # The python loop used a ROUTER frontend and dropped the identity
+        front_type, strip_ident = zmq.ROUTER, True
+
+    name = '%s-%s' % (name, device.__name__)
+    frontend = ctx.socket(front_type)
+    frontend.bind('inproc://bench-%s-front' % name)
+    backend = ctx.socket(back_type)
+    backend.setsockopt(zmq.SNDHWM, 0)
+    backend.bind('inproc://bench-%s-back' % name)
+    capture = None
+    if has_capture:
+        capture = ctx.socket(zmq.PUB)
+        capture.setsockopt(zmq.SNDHWM, 0)
+        capture.bind('inproc://bench-%s-capture' % name)
+    control = ctx.socket(zmq.PAIR)
+    control.bind('inproc://bench-%s-control' % name)
+
+    consumer = ctx.socket(cons_type)
+    if cons_type == zmq.SUB:
+        consumer.setsockopt(zmq.SUBSCRIBE, '')
+    if bus[0] == 'user_input':
+        consumer.setsockopt(zmq.IDENTITY, 'session')
+    consumer.connect('inproc://bench-%s-back' % name)
+    producer = ctx.socket(zmq.DEALER)
+    producer.setsockopt(zmq.SNDHWM, 0)
+    producer.connect('inproc://bench-%s-front' % name)
+
+    thread = Thread(target=device, args=(ctx, frontend, backend, capture,
+                                         control, strip_ident))
+    thread.start()
+    time.sleep(.2)
+
+    def produce():
+        frames = ['session', 'x' * 200]
+        for i in range(count):
+            producer.send_multipart(frames)
+    sender = Thread(target=produce)
+
+    start = time.time()
+    sender.start()
+    for i in range(count):
+        consumer.recv_multipart()
+    elapsed = time.time() - start
+    sender.join()
+
+    stop = ctx.socket(zmq.PAIR)
+    stop.connect('inproc://bench-%s-control' % name)
+    stop.send('TERMINATE')
+    thread.join()
+    for sock in (frontend, backend, capture, control, consumer, producer,
+                 stop):
+        if sock:
+            sock.close(0)
+    return count / elapsed
+
+
+def main(count=100000):
+    count = int(count)
+    ctx = zmq.Context()
+    print "%-12s %14s %14s" % ("bus", "python msg/s", "proxy msg/s")
+    for bus in BUSES:
+        before = run(ctx, python_loop, bus, count)
+        after = run(ctx, native_proxy, bus, count)
+        print "%-12s %14.0f %14.0f" % (bus[0], before, after)
+    ctx.term()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Bytes received per master over the replicator PUB/SUB links, for a
+fixed cluster wide load of node messages, when broadcasting to every
+master vs forwarding to the org owner on the hash ring only.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_federation [msgs]
+"""
+
+import random
+import sys
+import time
+import zmq
+
+from cloudrunner_server.plugins.transport.base import HashRing
+
+ORGS = ['org%s' % i for i in range(1000)]
+PAYLOAD = 'x' * 200
+
+
+def run(ctx, masters, count, ring_mode):
+    hosts = ['master%s' % i for i in range(masters)]
+    ring = HashRing(hosts)
+    pubs, subs = {}, {}
+    for host in hosts:
+        pub = ctx.socket(zmq.PUB)
+        pub.setsockopt(zmq.SNDHWM, 0)
+        port = pub.bind_to_random_port('tcp://127.0.0.1')
+        pubs[host] = (pub, port)
+        sub = ctx.socket(zmq.SUB)
+        sub.setsockopt(zmq.RCVHWM, 0)
+        # Former replicator subscribed to every verb
+        sub.setsockopt(zmq.SUBSCRIBE, '%s\0' % host if ring_mode else '')
+        subs[host] = sub
+    for host in hosts:
+        for other in hosts:
+            if other != host:
+                subs[host].connect('tcp://127.0.0.1:%s' % pubs[other][1])
+    time.sleep(.5)
+
+    # The same cluster wide load, spread over the masters
+    expected = 0
+    random.seed(1)
+    for i in range(count):
+        host = hosts[i % masters]
+        org = random.choice(ORGS)
+        if ring_mode:
+            owner = ring.owner(org)
+            if owner == host:
+                continue
+            topic = '%s\0' % owner
+            expected += 1
+        else:
+            topic = 'IN'
+            expected += masters - 1
+        pubs[host][0].send_multipart([topic, 'IN', host, org, 'session',
+                                      'ident', PAYLOAD])
+
+    poller = zmq.Poller()
+    for sub in subs.values():
+        poller.register(sub, zmq.POLLIN)
+    received = dict((host, 0) for host in hosts)
+    sockets = dict((sub, host) for host, sub in subs.items())
+    got = 0
+    while got < expected:
+        socks = dict(poller.poll(2000))
+        if not socks:
+            break
+        for sub in socks:
+            frames = sub.recv_multipart()
+            received[sockets[sub]] += sum(len(f) for f in frames)
+            got += 1
+
+    for pub, _ in pubs.values():
+        pub.close(0)
+    for sub in subs.values():
+        sub.close(0)
+    return sum(received.values()) / float(masters), got == expected
+
+
+def main(count=100000):
+    count = int(count)
+    ctx = zmq.Context()
+    print "%-8s %18s %18s" % ("masters", "broadcast KB/mst", "ring KB/mst")
+    for masters in (2, 3, 4, 6, 8):
+        before, ok1 = run(ctx, masters, count, False)
+        after, ok2 = run(ctx, masters, count, True)
+        print "%-8s %18.0f %18.0f%s" % (
+            masters, before / 1024, after / 1024,
+            '' if ok1 and ok2 else ' (messages lost)')
+    ctx.term()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
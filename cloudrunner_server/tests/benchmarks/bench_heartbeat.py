@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Heartbeat throughput of the tenant node registry.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_heartbeat [nodes ...]
+"""
+
+import sys
+import time
+
+from cloudrunner_server.plugins.transport.base import Tenant, TenantDict
+
+
+def run(node_count, intervals=3):
+    tenants = TenantDict()
+    tenant = tenants['BenchOrg'] = Tenant('BenchOrg')
+    names = ['node-%06d' % i for i in range(node_count)]
+    usage = {'cpu': 1, 'mem': 1}
+
+    start = time.time()
+    for _ in range(intervals):
+        tenant.refresh(adjust=-30)
+        for name in names:
+            tenant.push(name)
+            tenant.update(name, usage)
+        tenants.purge_expired()
+    elapsed = time.time() - start
+    return node_count * intervals / elapsed
+
+
+def main(*args):
+    counts = [int(arg) for arg in args] or [10000, 50000]
+    for count in counts:
+        print "%6d nodes: %10.0f heartbeats/sec" % (count, run(count))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Dispatcher restart time with the session journal: replay and compact
+a journal with `live` running task queues, written before `done`
+finished ones.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_journal [live] [done]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from cloudrunner_server.dispatcher.journal import SessionJournal
+
+NODES = ['node%s' % i for i in range(10)]
+
+
+def write_queue(journal, task_id, finish):
+    sessions = [dict(session_id='%s-%s' % (task_id, step), task_id=task_id,
+                     step_id=step, user='user',
+                     task={'targets': NODES, 'body': 'hostname\n' * 20},
+                     remote_user_map={'org': 'DEFAULT',
+                                      'roles': {'*': 'root'}},
+                     timeout=60, parent=None, kwargs={})
+                for step in range(3)]
+    journal.queue(task_id, 'user', 'DEFAULT', {'ENV': 'x'}, sessions)
+    session_id = sessions[0]['session_id']
+    journal.record('start', session_id)
+    for node in NODES:
+        journal.record('node', session_id, node,
+                       dict(status='STARTED', remote_user='root',
+                            router_id=node, data={}))
+    if finish:
+        journal.record('end', session_id, {'ENV': 'y'})
+        journal.record('done', task_id)
+
+
+def main(live=1000, done=50000):
+    live, done = int(live), int(done)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'session.journal')
+        journal = SessionJournal(path, batch_size=1000)
+        # Live queues first, the journal is compacted while running
+        for i in range(live):
+            write_queue(journal, i, False)
+        for i in range(done):
+            write_queue(journal, live + i, True)
+        journal.close()
+        size = os.path.getsize(path)
+
+        start = time.time()
+        journal = SessionJournal(path)
+        queues = journal.load()
+        loaded = time.time()
+        journal.compact()
+        end = time.time()
+        print "%-8s %-8s %10s %10s %10s %12s" % (
+            "live", "done", "MB", "load ms", "compact ms", "MB after")
+        print "%-8s %-8s %10.1f %10.0f %10.0f %12.1f" % (
+            len(queues), done, size / 1024. / 1024,
+            (loaded - start) * 1000, (end - loaded) * 1000,
+            os.path.getsize(path) / 1024. / 1024)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
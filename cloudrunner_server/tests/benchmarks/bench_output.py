@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Logger messages per job for chatty jobs: every node prints a line each
+5 ms for a second, run through a SessionEngine with in-process nodes.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_output [nodes]
+"""
+
+import sys
+import time
+
+from cloudrunner_server.core.message import Finished, M, Ready, StdOut
+from cloudrunner_server.dispatcher.session import JobSession
+from cloudrunner_server.tests.benchmarks.bench_session import (Manager, ORG,
+                                                               Sock)
+
+LINES = 200
+INTERVAL = .005
+LINE = 'Installing : package-1.0.0-1.el7.x86_64    [%4d/%4d]\n'
+
+
+class ChattyManager(Manager):
+
+    def __init__(self, nodes):
+        super(ChattyManager, self).__init__()
+        self.nodes = ['node%s' % i for i in range(nodes)]
+        self.pipes = 0
+        self.engine.job_done = Sock(self.logger)
+
+    def resolve_targets(self, org, targets):
+        return set(self.nodes)
+
+    def logger(self, packed):
+        if M.build(packed).control == 'PIPEMESSAGE':
+            self.pipes += 1
+
+    def send(self, node, msg, delay=0):
+        msg.hdr.peer = node
+        msg.hdr.org = ORG
+        msg.hdr.ident = node
+        msg.hdr.dest = self.session.session_id
+        self.engine.call_later(delay, self.session.on_message, msg)
+
+    def node_target(self, packed):
+        for node in self.nodes:
+            self.send(node, Ready(self.session.session_id))
+
+    def node_job(self, packed):
+        node = M.build(packed).hdr.ident
+        sid = self.session.session_id
+        for i in range(LINES):
+            self.send(node, StdOut(sid, sid, 'root', LINE % (i, LINES)),
+                      delay=i * INTERVAL)
+        self.send(node, Finished(sid, sid, 'root',
+                                 dict(ret_code=0, env={}, stdout='',
+                                      stderr='')),
+                  delay=LINES * INTERVAL)
+
+
+def main(nodes=500):
+    manager = ChattyManager(int(nodes))
+    engine = manager.engine
+    done = []
+    session = JobSession(manager, 'user', 'session-1', 1, 0,
+                         {'targets': manager.nodes, 'body': 'yum install'},
+                         {'org': ORG, 'roles': {'*': 'root'}}, None, None)
+    session.on_finish = lambda *args: done.append(time.time())
+    manager.session = session
+
+    start = time.time()
+    engine.add(session)
+    session.resume({})
+    while not done:
+        engine._run_calls()
+        engine._run_timers()
+        time.sleep(engine._timeout() / 1000.)
+    print "%-6s %12s %14s %10s" % ("nodes", "output lines", "pipe messages",
+                                   "time sec")
+    print "%-6s %12s %14s %10.1f" % (len(manager.nodes),
+                                     len(manager.nodes) * LINES,
+                                     manager.pipes, done[0] - start)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
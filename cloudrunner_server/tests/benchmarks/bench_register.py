@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Registration of a burst of nodes through the Admin control tower, with
+simulated CSRs: validation and signing sleep for the time they take on
+a real CA (key loads, file writes), the node records go to a SQLite DB.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_register \
+        [nodes] [workers] [sign ms]
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from mock import Mock
+from sqlalchemy import event
+
+from cloudrunner.core.exceptions import ConnectionError
+from cloudrunner_server.api.model import Org, UsageTier
+from cloudrunner_server.core.message import Register
+from cloudrunner_server.dispatcher import admin
+
+VALIDATE_MS = 2
+
+
+class SimCertController(object):
+
+    sign_ms = 20
+
+    def __init__(self, config):
+        pass
+
+    def validate_request(self, node, csr):
+        time.sleep(VALIDATE_MS / 1000.)
+        return True, node, 'org1', []
+
+    def can_approve(self, node):
+        return True
+
+    def sign_node(self, node, **kwargs):
+        time.sleep(self.sign_ms / 1000.)
+        return [], 'crt'
+
+    def build_cert_chain(self, node, org, csr):
+        return True, 'chain-%s' % node
+
+
+class Burst(object):
+
+    def __init__(self, nodes):
+        self.requests = []
+        for i in range(nodes):
+            req = Register('node%s' % i, 'CSR-%s' % i)
+            req.hdr.ident = 'ident-%s' % i
+            self.requests.append(req._)
+            if i % 10 == 0:
+                # Node retrying, while the first request is processed
+                self.requests.append(req._)
+        self.expected = nodes
+        self.replies = 0
+        self.done = None
+
+    def recv(self, timeout):
+        if self.requests:
+            return [self.requests.pop(0)]
+        if self.replies >= self.expected:
+            raise ConnectionError()
+        time.sleep(timeout / 1000.)
+
+    def send(self, packed):
+        self.replies += 1
+        if self.replies == self.expected:
+            self.done = time.time()
+
+    def close(self):
+        pass
+
+
+def main(nodes=1000, workers=8, sign_ms=20):
+    nodes, workers = int(nodes), int(workers)
+    logging.basicConfig(level=logging.ERROR)
+    SimCertController.sign_ms = float(sign_ms)
+    admin.CertController = SimCertController
+    tmp = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmp, 'bench.db')
+        config = Mock(db='sqlite:///%s' % db_file, register_workers=workers)
+        tower = admin.Admin(config, Mock())
+        # Savepoints need the transactions handled by SQLAlchemy
+        tower.set_context_from_config(
+            recreate=True,
+            creator=lambda: sqlite3.connect(db_file, isolation_level=None,
+                                            check_same_thread=False))
+        for name in ('begin', 'commit', 'rollback'):
+            event.listen(tower.db.bind, name,
+                         lambda conn, stmt=name.upper(): conn.execute(stmt))
+        tier = UsageTier(name='Bench', title='Bench', nodes=nodes)
+        tower.db.add(Org(name='org1', enabled=True, tier=tier))
+        tower.db.commit()
+
+        burst = Burst(nodes)
+        tower.backend.consume_queue.return_value = burst
+        tower.backend.publish_queue.return_value = burst
+        start = time.time()
+        tower.run()
+        took = (burst.done or time.time()) - start
+    finally:
+        shutil.rmtree(tmp)
+    print "%-6s %-8s %-8s %10s %10s" % ("nodes", "workers", "sign ms",
+                                        "total sec", "nodes/sec")
+    print "%-6s %-8s %-8s %10.1f %10.0f" % (nodes, workers, sign_ms, took,
+                                            nodes / took)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Size of the logger messages carrying the node results, and the memory
+held by the session, for a job finishing on a large fleet.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_results [nodes]
+"""
+
+import resource
+import sys
+import time
+
+from cloudrunner_server.core.message import Finished, M, Ready
+from cloudrunner_server.dispatcher.session import JobSession
+from cloudrunner_server.tests.benchmarks.bench_session import (Manager, ORG,
+                                                               Sock)
+
+
+class FleetManager(Manager):
+
+    def __init__(self, nodes):
+        super(FleetManager, self).__init__()
+        self.nodes = ['node%s' % i for i in range(nodes)]
+        self.messages = {}
+        self.engine.job_done = Sock(self.logger)
+
+    def resolve_targets(self, org, targets):
+        return set(self.nodes)
+
+    def logger(self, packed):
+        control = M.build(packed).control
+        count, largest = self.messages.get(control, (0, 0))
+        self.messages[control] = (count + 1, max(largest, len(packed)))
+
+    def send(self, node, msg):
+        msg.hdr.peer = node
+        msg.hdr.org = ORG
+        msg.hdr.ident = node
+        msg.hdr.dest = self.session.session_id
+        self.engine.call_soon(self.session.on_message, msg)
+
+    def node_target(self, packed):
+        for node in self.nodes:
+            self.send(node, Ready(self.session.session_id))
+
+    def node_job(self, packed):
+        node = M.build(packed).hdr.ident
+        sid = self.session.session_id
+        self.send(node, Finished(sid, sid, 'root',
+                                 dict(ret_code=0, env={},
+                                      stdout='', stderr='')))
+
+
+def main(nodes=20000):
+    manager = FleetManager(int(nodes))
+    engine = manager.engine
+    done = []
+    session = JobSession(manager, 'user', 'session-1', 1, 0,
+                         {'targets': manager.nodes, 'body': 'hostname'},
+                         {'org': ORG, 'roles': {'*': 'root'}}, None, None)
+    session.on_finish = lambda *args: done.append(time.time())
+    manager.session = session
+
+    start = time.time()
+    engine.add(session)
+    session.resume({})
+    while not done:
+        engine._run_calls()
+        engine._run_timers()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print "%-6s %-16s %8s %12s" % ("nodes", "message", "count",
+                                   "max bytes")
+    for control in ('NODERESULTS', 'FINISHEDMESSAGE'):
+        count, largest = manager.messages.get(control, (0, 0))
+        print "%-6s %-16s %8s %12s" % (len(manager.nodes), control,
+                                       count, largest)
+    print "time %.1f sec, max rss %s MB" % (done[0] - start, rss)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Time spent in UserMap on the Ready path: a role map with many rules,
+sessions on a large fleet, with each node sending Ready twice.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_roles \
+        [rules] [nodes] [sessions]
+"""
+
+import logging
+import sys
+import time
+
+from cloudrunner_server.dispatcher.session import UserMap
+
+
+def main(rules=200, nodes=20000, sessions=5):
+    rules, nodes, sessions = int(rules), int(nodes), int(sessions)
+    logging.basicConfig(level=logging.INFO, stream=open('/dev/null', 'w'))
+    role_map = dict(('rack%s-.*' % i, 'user%s' % i) for i in range(rules))
+    role_map['*'] = 'root'
+    names = ['rack%s-node%s' % (i % (rules * 2), i) for i in range(nodes)]
+
+    start = time.time()
+    for i in range(sessions):
+        user_map = UserMap(role_map, 'user')
+        for name in names + names:
+            user_map.select(name)
+    took = time.time() - start
+    print "%-6s %-6s %-8s %10s %14s" % ("rules", "nodes", "sessions",
+                                        "total ms", "per Ready us")
+    print "%-6s %-6s %-8s %10.0f %14.1f" % (
+        rules, nodes, sessions, took * 1000,
+        took * 1e6 / (nodes * 2 * sessions))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
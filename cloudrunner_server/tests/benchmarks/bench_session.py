@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+"""
+Latency from start to FinishedMessage of trivial jobs (one node,
+replying at once), run through a SessionEngine with in-process
+node replies.
+
+    python -m cloudrunner_server.tests.benchmarks.bench_session [runs]
+"""
+
+import sys
+import time
+
+from cloudrunner_server.core.message import Finished, Ready
+from cloudrunner_server.dispatcher.engine import SessionEngine
+from cloudrunner_server.dispatcher.session import JobSession
+from cloudrunner_server.plugins.transport.base import match_nodes
+
+NODE = 'node1'
+ORG = 'DEFAULT'
+
+
+class Sock(object):
+
+    def __init__(self, on_send=None):
+        self.on_send = on_send
+
+    def send(self, packed):
+        if self.on_send:
+            self.on_send(packed)
+
+
+class Manager(object):
+
+    discovery_timeout = 2
+    wait_timeout = 120
+    journal = None
+
+    def __init__(self):
+        self.engine = SessionEngine(self, 'sessions-bench')
+        self.engine.job_done = Sock()
+        self.engine.job_reply = Sock(self.node_job)
+        self.publisher = Sock(self.node_target)
+        self.session = None
+
+    def register_session(self, session_id, ident=None):
+        pass
+
+    def delete_session(self, session_id):
+        pass
+
+    def resolve_targets(self, org, targets):
+        return match_nodes([NODE], targets)
+
+    def reply(self, msg):
+        msg.hdr.peer = NODE
+        msg.hdr.org = ORG
+        msg.hdr.ident = NODE
+        msg.hdr.dest = self.session.session_id
+        self.engine.call_soon(self.session.on_message, msg)
+
+    def node_target(self, packed):
+        self.reply(Ready(self.session.session_id))
+
+    def node_job(self, packed):
+        sid = self.session.session_id
+        self.reply(Finished(sid, sid, 'root',
+                            dict(ret_code=0, env={}, stdout=NODE,
+                                 stderr='')))
+
+
+def run_job(manager, i):
+    engine = manager.engine
+    done = []
+    session = JobSession(manager, 'user', 'session-%s' % i, i, 0,
+                         {'targets': [NODE], 'body': 'hostname'},
+                         {'org': ORG, 'roles': {'*': 'root'}}, None, None)
+    session.on_finish = lambda *args: done.append(time.time())
+    manager.session = session
+
+    start = time.time()
+    engine.add(session)
+    session.resume({})
+    while not done:
+        engine._run_calls()
+        engine._run_timers()
+        time.sleep(engine._timeout() / 1000.)
+    return done[0] - start
+
+
+def main(runs=20):
+    runs = int(runs)
+    manager = Manager()
+    times = sorted(run_job(manager, i) for i in range(runs))
+    print "%-6s %12s %12s %12s" % ("runs", "p50 ms", "p90 ms", "max ms")
+    print "%-6s %12.1f %12.1f %12.1f" % (
+        runs, times[len(times) // 2] * 1000,
+        times[int(len(times) * .9)] * 1000, times[-1] * 1000)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
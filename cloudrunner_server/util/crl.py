@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import fcntl
+import logging
+import os
+
+LOG = logging.getLogger('CRL')
+
+
+class CrlJournal(object):
+
+    """
+    Append-only journal of revoked certificate serial numbers,
+    one serial per line.
+
+    Writers append and fsync each revocation. Readers keep an offset
+    cursor and only parse entries added since the previous read(),
+    into the `serials` set used for the TLS handshake checks.
+    compact() rewrites the file without duplicates and invalid lines,
+    readers detect the replaced file and reload it.
+    """
+
+    def __init__(self, path, serials=None):
+        self.path = path
+        if serials is None:
+            serials = set()
+        self.serials = serials
+        self.offset = 0
+        self.inode = None
+
+    def __contains__(self, serial):
+        return serial in self.serials
+
+    def __len__(self):
+        return len(self.serials)
+
+    def _lock(self, flags):
+        # Open and lock the current journal file. Re-open if it was
+        # replaced by compact() while waiting for the lock
+        while True:
+            fd = os.open(self.path, flags | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)
+
+    def append(self, *serials):
+        lines = ''.join('%d\n' % int(ser_no) for ser_no in serials)
+        fd = self._lock(os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, lines)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        # Load entries appended since the last read,
+        # returns the newly revoked serials
+        try:
+            crl = open(self.path, 'r')
+        except IOError:
+            return []
+        try:
+            st = os.fstat(crl.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # New or compacted file
+                return self._reload(crl, st.st_ino)
+            crl.seek(self.offset)
+            data = crl.read()
+        finally:
+            crl.close()
+        # Leave a partially written line for the next read
+        end = data.rfind('\n') + 1
+        self.offset += end
+        added = [ser_no for ser_no in self._parse(data[:end])
+                 if ser_no not in self.serials]
+        self.serials.update(added)
+        return added
+
+    def _reload(self, crl, inode):
+        data = crl.read()
+        end = data.rfind('\n') + 1
+        serials = set(self._parse(data[:end]))
+        added = list(serials - self.serials)
+        stale = self.serials - serials
+        # Update in place, the set is shared with the TLS sockets
+        self.serials.update(serials)
+        self.serials.difference_update(stale)
+        self.offset = end
+        self.inode = inode
+        return added
+
+    def _parse(self, data):
+        for line in data.split('\n'):
+            if not line:
+                continue
+            try:
+                yield int(line)
+            except ValueError:
+                LOG.error("Invalid CRL entry: %r" % line)
+
+    def compact(self):
+        # Rewrite the journal with unique serials only,
+        # returns (entries before, entries after)
+        tmp_file = '%s.compact' % self.path
+        fd = self._lock(os.O_RDONLY)
+        try:
+            with os.fdopen(os.dup(fd), 'r') as crl:
+                lines = [line for line in crl.read().split('\n') if line]
+            serials = sorted(set(self._parse('\n'.join(lines))))
+            with open(tmp_file, 'w') as tmp:
+                tmp.write(''.join('%d\n' % ser_no for ser_no in serials))
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.chmod(tmp_file, 0o644)
+            os.rename(tmp_file, self.path)
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                             os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        finally:
+            os.close(fd)
+        return len(lines), len(serials)
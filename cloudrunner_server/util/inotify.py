@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+
+LOG = logging.getLogger('Inotify')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event {int wd; uint32 mask; uint32 cookie; uint32 len;}
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class Inotify(object):
+
+    """
+    Minimal inotify(7) wrapper. Callbacks are invoked from the thread
+    calling run(), with the watched dir, the file name and the event mask.
+    On queue overflow all callbacks get IN_Q_OVERFLOW and an empty name.
+    """
+
+    def __init__(self):
+        self.libc = _load_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK))
+        # wd -> (dir, callback)
+        self.watches = {}
+
+    def watch(self, path, mask, callback):
+        wd = _check(self.libc.inotify_add_watch(
+            self.fd, ctypes.c_char_p(path), ctypes.c_uint32(mask)))
+        self.watches[wd] = (path, callback)
+        return wd
+
+    def read(self, timeout=1):
+        # Returns [(wd, mask, name)]
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def run(self, stop_event, timeout=1):
+        while not stop_event.is_set():
+            try:
+                events = self.read(timeout)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, let every watcher re-scan
+                    LOG.warn("Inotify queue overflow")
+                    watches = self.watches.values()
+                elif mask & IN_IGNORED or wd not in self.watches:
+                    continue
+                else:
+                    watches = [self.watches[wd]]
+                for path, callback in watches:
+                    try:
+                        callback(path, name, mask)
+                    except Exception, ex:
+                        LOG.exception(ex)
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import os
+import shutil
+import tempfile
+
+from cloudrunner_server.util.crl import CrlJournal
+from cloudrunner_server.tests import base
+
+
+class TestCrlJournal(base.BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.crl_file = os.path.join(self.dir, 'crl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_append_read(self):
+        writer = CrlJournal(self.crl_file)
+        reader = CrlJournal(self.crl_file)
+        self.assertEqual(reader.read(), [])
+
+        writer.append(2)
+        writer.append(3, 4)
+        self.assertEqual(sorted(reader.read()), [2, 3, 4])
+        self.assertTrue(3 in reader)
+
+        # Only new entries are parsed
+        offset = reader.offset
+        writer.append(5)
+        self.assertEqual(reader.read(), [5])
+        self.assertEqual(reader.offset, offset + 2)
+        self.assertEqual(reader.read(), [])
+
+        # Earlier revocations are kept
+        self.assertEqual(open(self.crl_file).read(), '2\n3\n4\n5\n')
+
+    def test_partial_line(self):
+        reader = CrlJournal(self.crl_file)
+        with open(self.crl_file, 'a') as crl:
+            crl.write('7\n12')
+        self.assertEqual(reader.read(), [7])
+        with open(self.crl_file, 'a') as crl:
+            crl.write('3\n')
+        self.assertEqual(reader.read(), [123])
+
+    def test_compact(self):
+        serials = set()
+        writer = CrlJournal(self.crl_file)
+        reader = CrlJournal(self.crl_file, serials=serials)
+        writer.append(3, 2, 3)
+        with open(self.crl_file, 'a') as crl:
+            crl.write('invalid\n')
+        writer.append(2)
+        self.assertEqual(sorted(reader.read()), [2, 3])
+
+        self.assertEqual(writer.compact(), (5, 2))
+        self.assertEqual(open(self.crl_file).read(), '2\n3\n')
+
+        # Reader picks up the compacted file, the set is updated in place
+        writer.append(8)
+        self.assertEqual(reader.read(), [8])
+        self.assertEqual(serials, set([2, 3, 8]))
+        self.assertTrue(reader.serials is serials)
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+
+import os
+import shutil
+import tempfile
+from threading import Event, Thread
+
+from cloudrunner_server.util.inotify import (Inotify, IN_CREATE, IN_DELETE,
+                                             IN_MOVED_TO)
+from cloudrunner_server.tests import base
+
+
+class TestInotify(base.BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_events(self):
+        inotify = Inotify()
+        events = []
+        inotify.watch(self.dir, IN_CREATE | IN_DELETE | IN_MOVED_TO,
+                      lambda path, name, mask: events.append((name, mask)))
+
+        open(os.path.join(self.dir, 'org1.ca.crt'), 'w').close()
+        os.rename(os.path.join(self.dir, 'org1.ca.crt'),
+                  os.path.join(self.dir, 'org2.ca.crt'))
+        os.unlink(os.path.join(self.dir, 'org2.ca.crt'))
+
+        stop = Event()
+        watcher = Thread(target=inotify.run, args=(stop, 0.1))
+        watcher.start()
+        for _ in range(50):
+            if len(events) == 3:
+                break
+            stop.wait(0.05)
+        stop.set()
+        watcher.join()
+
+        self.assertEqual(events, [('org1.ca.crt', IN_CREATE),
+                                  ('org2.ca.crt', IN_MOVED_TO),
+                                  ('org2.ca.crt', IN_DELETE)])
+        self.assertIsNone(inotify.fd)
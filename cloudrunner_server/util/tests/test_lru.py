@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# /*******************************************************
+#  * Copyright (C) 2013-2014 CloudRunner.io <info@cloudrunner.io>
+#  *
+#  * Proprietary and confidential
+#  * This file is part of CloudRunner Server.
+#  *
+#  * CloudRunner Server can not be copied and/or distributed
+#  * without the express permission of CloudRunner.io
+#  *******************************************************/
+from cloudrunner_server.util.lru import LRUCache
+from cloudrunner_server.tests import base
+
+
+class TestLRUCache(base.BaseTestCase):
+
+    def test_evict(self):
+        cache = LRUCache(3)
+        for i in range(3):
+            cache.set('S%s' % i, i)
+        self.assertEqual(cache.get('S0'), 0)
+
+        # S1 is the least recently used
+        cache.set('S3', 3)
+        self.assertFalse('S1' in cache)
+        self.assertEqual(cache.get('S1', -1), -1)
+        self.assertCount(cache, 3)
+
+        cache.set('S2', 20)
+        cache.set('S4', 4)
+        self.assertFalse('S0' in cache)
+        self.assertEqual(cache.get('S2'), 20)
+
+        self.assertEqual(cache.pop('S2'), 20)
+        self.assertIsNone(cache.pop('S2'))
+        self.assertEqual(sorted(cache._items), ['S3', 'S4'])